@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "Usage: %s <port> [<port> ...]" % sys.argv[0]
+    else:
+        logging.basicConfig(level=logging.INFO)
+        from server import asyncserver
+        print "Serving at http://localhost:%d/index.html" % int(sys.argv[1])
+        asyncserver.Serve([int(p) for p in sys.argv[1:]])
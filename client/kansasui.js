@@ -1973,10 +1973,14 @@ KansasUI.prototype.init = function(client, uuid, user, orient, gameid, gender, u
         }
     });
 
-    $("#kansas_typeahead").keypress(function() {
+    $("#kansas_typeahead").on("input", function() {
         that.searcher.handleQueryStringUpdate();
     });
 
+    $("#kansas_typeahead").closest("form").submit(function() {
+        that.searcher.submitQuery();
+    });
+
     /* Prevents search form from being submitted normally. */
     $("form").submit(function(event) {
         event.preventDefault();
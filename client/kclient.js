@@ -22,6 +22,11 @@
  *  to check latency:
  *      kclient.queueLatencyMillis();
  *
+ *  to resynchronize game state:
+ *      kclient.seqno() -> int, to pass as 'seqno' when reconnecting
+ *      kclient.checksum() -> int, compared against the server's
+ *      kclient.resync(seqno)
+ *
  *  See kclient._hooks for more information on adding hooks.
  *
  *  to query game state:
@@ -50,7 +55,7 @@
  *          .commit();
  */
 
-var kClientVersion = 166;  // keep in sync with config.py
+var kClientVersion = 168;  // keep in sync with config.py
 var versionRequired = kClientVersion;
 
 function doCheckPopup() {
@@ -82,7 +87,12 @@ function KansasClient(hostname, ip_port, kansas_ui, scope, sourceid) {
     this._game = {
         state: {},
         index: {},
+        seqno: undefined,
+        checksum: undefined,
+        resyncing: false,
+        presence: {},
     };
+    this._verifyTimer = null;
     var that = this;
     setInterval(function() {
         if (that._state == 'connected') {
@@ -153,6 +163,47 @@ KansasBulkMove.prototype.commit = function() {
     this.client.send("bulkmove", {moves: this.moves});
 }
 
+KansasClient.prototype.seqno = function() {
+    return this._game.seqno;
+}
+
+/* Sum of the crc32 of each card position, as computed by the server. */
+KansasClient.prototype.checksum = function() {
+    var sum = 0;
+    for (var id in this._game.index) {
+        var pos = this._game.index[id];
+        var orient = this._game.state.orientations[id];
+        sum = (sum + crc32(id + '|' + pos[0] + '|' + pos[1] + '|' + orient))
+            % 4294967296;
+    }
+    return sum;
+}
+
+/* Asks the server for the updates since seqno, or a full snapshot. State
+ * broadcasts are dropped until the reply, which includes them. */
+KansasClient.prototype.resync = function(seqno) {
+    this.ui.vlog(0, "resync from seqno " + seqno);
+    this._game.resyncing = true;
+    this.send("resync", {seqno: seqno});
+}
+
+/* Checks the state against the server checksum once updates quiesce. */
+KansasClient.prototype._scheduleVerify = function() {
+    var that = this;
+    clearTimeout(this._verifyTimer);
+    this._verifyTimer = setTimeout(function() {
+        if (that._state != 'connected' || that._game.checksum === undefined)
+            return;
+        if (that.queueLatencyMillis() > 0) {
+            that._scheduleVerify();
+        } else if (that.checksum() != that._game.checksum) {
+            that.ui.vlog(0, "checksum mismatch, local " + that.checksum()
+                + " != server " + that._game.checksum);
+            that.resync();
+        }
+    }, 1000);
+}
+
 KansasClient.prototype.futuresPending = function() {
     return Object.keys(this._futures).length;
 }
@@ -207,12 +258,14 @@ KansasClient.prototype.connect = function(callback) {
     this._state = 'opening';
     var that = this;
     this._futures = {};
+    this._handlers = this._eventHandlers(that);
     this._ws = $.websocket(
         "ws:///" + this.hostname + ":" + this.ip_port + "/kansas",
         { open: function() {
             that._ws.send("set_scope", {
                 "scope": that.scope,
                 "datasource": that.sourceid,
+                "encodings": KansasWire.supported(),
             });
             that._onOpen.call(that);
             if (callback) {
@@ -220,7 +273,8 @@ KansasClient.prototype.connect = function(callback) {
             }
           },
           close: function() { that._onClose.call(that); },
-          events: this._eventHandlers(that) });
+          decode: KansasWire.decode,
+          events: this._handlers });
     return this;
 }
 
@@ -342,6 +396,28 @@ KansasClient.prototype._onClose = function() {
     this._notify('disconnected', null, true);
 }
 
+var crcTable = null;
+
+/* Returns the crc32 of the utf-8 encoding of str, as an unsigned int. */
+function crc32(str) {
+    if (crcTable == null) {
+        crcTable = [];
+        for (var n = 0; n < 256; n++) {
+            var c = n;
+            for (var k = 0; k < 8; k++) {
+                c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+            }
+            crcTable[n] = c;
+        }
+    }
+    var bytes = unescape(encodeURIComponent(str));
+    var crc = -1;
+    for (var i = 0; i < bytes.length; i++) {
+        crc = (crc >>> 8) ^ crcTable[(crc ^ bytes.charCodeAt(i)) & 0xFF];
+    }
+    return (crc ^ -1) >>> 0;
+}
+
 /**
  * Utility that removes an element from an array.
  * Returns if the element was present in the array.
@@ -357,6 +433,58 @@ function removeFromArray(arr, item) {
 }
 
 KansasClient.prototype._eventHandlers = function(that) {
+
+    /* Wraps handlers of broadcasts that carry a state seqno, dropping
+     * ones already applied by a resume, or to be applied by a pending one.
+     * The server may have discarded earlier broadcasts before asking for a
+     * resync, so later ones must not advance the seqno. */
+    function stateUpdate(fn) {
+        return function(e) {
+            if (that._game.resyncing) {
+                return;
+            }
+            if (e.seqno !== undefined) {
+                if (that._game.seqno !== undefined
+                        && e.seqno <= that._game.seqno) {
+                    return;
+                }
+                that._game.seqno = e.seqno;
+            }
+            fn(e);
+            if (e.checksum !== undefined) {
+                that._game.checksum = e.checksum;
+                that._scheduleVerify();
+            }
+        }
+    }
+
+    /* Passes the players present, kept by pid, to the presence hook. */
+    function presenceChanged() {
+        var present = $.map(that._game.presence, function(p) { return p; });
+        that._notify('presence', present, true);
+    }
+
+    /* Handles either a full snapshot or the deltas since our seqno. */
+    function resume(e) {
+        that._state = 'connected';
+        that._game.resyncing = false;
+        if (e.data.deltas) {
+            var deltas = e.data.deltas;
+            for (var j = 0; j < deltas.length; j++) {
+                that._handlers[deltas[j].type](deltas[j]);
+            }
+            that._game.seqno = e.data.seqno;
+            that._game.checksum = e.data.checksum;
+            if (that.checksum() != that._game.checksum) {
+                that.resync();
+            }
+        } else {
+            that._game.seqno = e.data[1];
+            that._game.checksum = e.data[2];
+            that._reset(e.data[0]);
+        }
+    }
+
     return {
         _future_router: function(e) {
             if (that._futures[e.future_id]) {
@@ -385,18 +513,16 @@ KansasClient.prototype._eventHandlers = function(that) {
         },
         broadcast_resp: function(e) {
         },
-        connect_resp: function(e) {
-            that._state = 'connected';
-            that._reset(e.data[0]);
-        },
-        bulk_remove: function(e) {
+        connect_resp: resume,
+        resync_resp: resume,
+        bulk_remove: stateUpdate(function(e) {
             for (i in e.data) {
                 var id = e.data[i];
                 that._removeEntry(that.getPos(id), id);
             }
             that._notify('removed', e.data);
-        },
-        bulk_add: function(e) {
+        }),
+        bulk_add: stateUpdate(function(e) {
             var state = that._game.state;
             var added = [];
             for (i in e.data.cards) {
@@ -414,8 +540,8 @@ KansasClient.prototype._eventHandlers = function(that) {
                 that._game.index[add.id] = add.pos;
             }
             that._notify('added', {'cards': added, 'requestor': e.data.requestor});
-        },
-        bulkupdate: function(e) {
+        }),
+        bulkupdate: stateUpdate(function(e) {
             var stacksTouched = {};
 
             for (i in e.data) {
@@ -443,9 +569,25 @@ KansasClient.prototype._eventHandlers = function(that) {
             for (skey in stacksTouched) {
                 that._notify('stackchanged', JSON.parse(skey));
             }
+        }),
+        resync_required: function(e) {
+            that.resync(that._game.seqno);
         },
         presence: function(e) {
-            that._notify('presence', e.data, true);
+            that._game.presence = {};
+            for (i in e.data) {
+                that._game.presence[e.data[i].pid] = e.data[i];
+            }
+            presenceChanged();
+        },
+        presence_delta: function(e) {
+            for (i in e.data.left) {
+                delete that._game.presence[e.data.left[i]];
+            }
+            for (i in e.data.joined) {
+                that._game.presence[e.data.joined[i].pid] = e.data.joined[i];
+            }
+            presenceChanged();
         },
     };
 }
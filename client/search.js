@@ -3,12 +3,12 @@
 function KansasSearcher(client, preview_div_id, notfound_id, typeahead_id,
                         preview_cb, validate_cb, add_cardbox_callback) {
     this.client = client;
-    this.lastGet = 0;
-    this.lastTyped = 0;
     this.lastSent = "";
+    this.completions = [];
     this.preview_div = "#" + preview_div_id;
     this.notfound = "#" + notfound_id;
     this.typeahead = "#" + typeahead_id;
+    this.namelist = "#" + $(this.typeahead).attr("list");
     this.preview_callback = preview_cb;
     this.validate_callback = validate_cb;
     this.add_cardbox_callback = add_cardbox_callback;
@@ -17,46 +17,69 @@ function KansasSearcher(client, preview_div_id, notfound_id, typeahead_id,
 
 (function() {  /* begin namespace searcher */
 
-// The time to wait between queries, in milliseconds.
-var kMinWaitPeriod = 250;
 var kVisiblePreviewItems = 20;
 var kLoadPreviewItems = 120;
 
+/* Completes card names as the user types. Searching waits for submitQuery(),
+ * unless the user picks one of the completions. */
 KansasSearcher.prototype.handleQueryStringUpdate = function() {
+    var that = this;
+    var term = $(this.typeahead).val();
+    if (term == "") {
+        $(this.namelist).empty();
+        $(this.preview_div + " img").remove();
+        $(this.preview_div).hide();
+        $(this.notfound).hide();
+        return;
+    }
+    if ($.inArray(term, this.completions) >= 0) {
+        this.submitQuery();
+        return;
+    }
+    // The server's kCompletions sets how many names are returned.
+    this.client.callAsync("complete_name", {
+        "datasource": that.sourceid,
+        "term": term
+    }).then(function(v) { that.handleCompletions(v); });
+}
+
+KansasSearcher.prototype.handleCompletions = function(data) {
+    if (data.req.term != $(this.typeahead).val()) {
+        return;  // drop completions of what is no longer typed
+    }
+    this.completions = data.names;
+    var list = $(this.namelist).empty();
+    $.each(data.names, function(i, name) {
+        $("<option>").attr("value", name).appendTo(list);
+    });
+}
+
+KansasSearcher.prototype.submitQuery = function() {
     var that = this;
     var query = $(this.typeahead).val();
-    if ($.now() - this.lastGet > kMinWaitPeriod) {
-        this.lastGet = $.now();
-        this.lastSent = query;
-        this.client.ui.vlog(2, "sent immediate query '" + query + "'");
-        this.client.callAsync("query", {
-            "datasource": that.sourceid,
-            "term": query,
-            "limit": kLoadPreviewItems,
-            "tags": "immediate",
-            "allow_inexact": true
-        }).then(function(v) { that.handleQueryResponse(v); });
-    }
-    var timestamp = this.lastTyped = $.now();
+    if (query == this.lastSent) {
+        return;
+    }
+    this.lastSent = query;
+    this.client.ui.vlog(2, "sent query '" + query + "'");
+    this.client.callAsync("query", {
+        "datasource": that.sourceid,
+        "term": query,
+        "limit": kLoadPreviewItems,
+        "allow_inexact": true
+    }).then(function(v) { that.handleQueryResponse(v); });
+}
+
+KansasSearcher.prototype.fetchMore = function(term, cursor) {
     var that = this;
-    setTimeout(function() {
-        if (that.lastTyped == timestamp) {
-            that.lastGet = $.now();
-            query = $(that.typeahead).val();
-            if (query == that.lastSent) {
-                return;
-            }
-            that.lastSent = query;
-            that.client.ui.vlog(2, "sent delayed query '" + query + "'");
-            that.client
-                .callAsync("query", {
-                    "datasource": that.sourceid,
-                    "limit": kLoadPreviewItems,
-                    "term": query,
-                    "allow_inexact": true})
-                .then(function(v) { that.handleQueryResponse(v); });
-        }
-    }, kMinWaitPeriod);
+    this.client.ui.vlog(2, "sent query for more of '" + term + "'");
+    this.client.callAsync("query", {
+        "datasource": that.sourceid,
+        "term": term,
+        "limit": kLoadPreviewItems,
+        "cursor": cursor,
+        "allow_inexact": true
+    }).then(function(v) { that.handleQueryResponse(v); });
 }
 
 KansasSearcher.prototype.handleQueryResponse = function(data) {
@@ -72,7 +95,7 @@ KansasSearcher.prototype.handleQueryResponse = function(data) {
             $(this.preview_div + " img").remove();
             $(this.preview_div).hide();
             $(this.notfound).hide();
-        } else if (data.req.tags != "immediate") {
+        } else {
             $(this.notfound).show();
             $("#has_more").hide();
         }
@@ -163,8 +186,19 @@ KansasSearcher.prototype.previewItems = function(stream, meta, term, counts, dec
     if (meta && meta.server_latency) {
         this.client.ui.vlog(0, "Search latency at server: " + meta.server_latency);
     }
-    if (meta && meta.has_more) {
+    $("#has_more").unbind("click");
+    if (meta && meta.cursor) {
+        $("#has_more")
+            .text("more results...")
+            .prop("href", "#")
+            .click(function() {
+                that.fetchMore(term, meta.cursor);
+                return false;
+            })
+            .show();
+    } else if (meta && meta.has_more) {
         $("#has_more")
+            .text("full results...")
             .prop("href", meta.more_url)
             .show();
     } else {
@@ -147,7 +147,8 @@ function handleSocketClose(client) {
     console.log("WebSocket disconnected.");
     function connect_to_game() {
         if (connect_info != null) {
-            client.send("connect", connect_info);
+            client.send("connect",
+                $.extend({seqno: client.seqno()}, connect_info));
         }
     }
     setTimeout(function() { client.connect(connect_to_game); }, 1000);
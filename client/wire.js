@@ -0,0 +1,154 @@
+/**
+ * Decodes messages in the wire encoding negotiated with the server.
+ *
+ * Usage:
+ *
+ *  KansasWire.supported() -> list[str], features to offer in set_scope
+ *  KansasWire.decode(websocket_data) -> Promise of the decoded message
+ *
+ *  Text frames are JSON. Binary frames start with a flags byte, where
+ *  FLAG_DEFLATE means the body is raw deflate compressed and FLAG_MSGPACK
+ *  means the body is MessagePack rather than JSON.
+ */
+
+var KansasWire = (function() {  /* begin namespace wire */
+
+var FLAG_DEFLATE = 1;
+var FLAG_MSGPACK = 2;
+
+var utf8 = typeof TextDecoder != 'undefined' ? new TextDecoder() : null;
+
+function supported() {
+    var features = [];
+    if (utf8 && typeof Promise != 'undefined') {
+        features.push('msgpack');
+        if (canInflate()) {
+            features.push('deflate');
+        }
+    }
+    return features;
+}
+
+/* Older browsers have DecompressionStream without the raw format. */
+function canInflate() {
+    if (typeof DecompressionStream == 'undefined') {
+        return false;
+    }
+    try {
+        new DecompressionStream('deflate-raw');
+        return true;
+    } catch (e) {
+        return false;
+    }
+}
+
+function inflate(bytes) {
+    var stream = new Blob([bytes]).stream()
+        .pipeThrough(new DecompressionStream('deflate-raw'));
+    return new Response(stream).arrayBuffer().then(function(buf) {
+        return new Uint8Array(buf);
+    });
+}
+
+function parseBody(flags, bytes) {
+    if (flags & FLAG_MSGPACK) {
+        return unpack(bytes);
+    }
+    return JSON.parse(utf8.decode(bytes));
+}
+
+function decode(data) {
+    if (typeof data == 'string') {
+        return Promise.resolve(JSON.parse(data));
+    }
+    var bytes = new Uint8Array(data);
+    var flags = bytes[0];
+    var body = bytes.subarray(1);
+    if (flags & FLAG_DEFLATE) {
+        return inflate(body).then(function(inflated) {
+            return parseBody(flags, inflated);
+        });
+    }
+    return Promise.resolve(parseBody(flags, body));
+}
+
+/* Decodes the subset of MessagePack produced by server/wire.py. */
+function unpack(bytes) {
+    var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    var pos = 0;
+
+    function str(n) {
+        var s = utf8.decode(bytes.subarray(pos, pos + n));
+        pos += n;
+        return s;
+    }
+
+    function array(n) {
+        var out = new Array(n);
+        for (var i = 0; i < n; i++) {
+            out[i] = next();
+        }
+        return out;
+    }
+
+    function map(n) {
+        var out = {};
+        for (var i = 0; i < n; i++) {
+            var key = next();
+            out[key] = next();
+        }
+        return out;
+    }
+
+    function next() {
+        var b = bytes[pos++];
+        var v;
+        if (b < 0x80) return b;
+        if (b < 0x90) return map(b & 0x0f);
+        if (b < 0xa0) return array(b & 0x0f);
+        if (b < 0xc0) return str(b & 0x1f);
+        if (b >= 0xe0) return b - 0x100;
+        switch (b) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: v = bytes[pos]; pos += 1; return str(v);
+            case 0xc5: v = view.getUint16(pos); pos += 2; return str(v);
+            case 0xc6: v = view.getUint32(pos); pos += 4; return str(v);
+            case 0xca: v = view.getFloat32(pos); pos += 4; return v;
+            case 0xcb: v = view.getFloat64(pos); pos += 8; return v;
+            case 0xcc: v = bytes[pos]; pos += 1; return v;
+            case 0xcd: v = view.getUint16(pos); pos += 2; return v;
+            case 0xce: v = view.getUint32(pos); pos += 4; return v;
+            case 0xcf:
+                v = view.getUint32(pos) * 4294967296 + view.getUint32(pos + 4);
+                pos += 8;
+                return v;
+            case 0xd0: v = view.getInt8(pos); pos += 1; return v;
+            case 0xd1: v = view.getInt16(pos); pos += 2; return v;
+            case 0xd2: v = view.getInt32(pos); pos += 4; return v;
+            case 0xd3:
+                v = view.getInt32(pos) * 4294967296 + view.getUint32(pos + 4);
+                pos += 8;
+                return v;
+            case 0xd9: v = bytes[pos]; pos += 1; return str(v);
+            case 0xda: v = view.getUint16(pos); pos += 2; return str(v);
+            case 0xdb: v = view.getUint32(pos); pos += 4; return str(v);
+            case 0xdc: v = view.getUint16(pos); pos += 2; return array(v);
+            case 0xdd: v = view.getUint32(pos); pos += 4; return array(v);
+            case 0xde: v = view.getUint16(pos); pos += 2; return map(v);
+            case 0xdf: v = view.getUint32(pos); pos += 4; return map(v);
+        }
+        throw "msgpack: unsupported type byte " + b;
+    }
+
+    return next();
+}
+
+return {
+    supported: supported,
+    decode: decode,
+    unpack: unpack,
+};
+
+})();  /* end namespace wire */
@@ -0,0 +1,537 @@
+# Serves websocket clients and static files from a single event loop.
+#
+# Sockets are multiplexed with asyncore, so an idle connection costs no
+# thread. Requests may block on locks, leveldb or urllib2, so they are served
+# by a small executor, at most one at a time per connection to keep order.
+
+from server import config
+from server import metrics
+from server import workers
+
+import asyncore
+import base64
+import binascii
+import collections
+import email.utils
+import hashlib
+import importlib
+import logging
+import mimetypes
+import os
+import socket
+import struct
+import threading
+import urllib
+
+kWebSocketGUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+kMaxHeaderBytes = 16384
+# Peers trusted to name the client they relay in X-Forwarded-For, as the
+# router does for workers.
+kTrustedProxies = ['127.0.0.1', '::1']
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+# URL prefix -> directory, searched in order.
+STATIC_ROOTS = [
+    ('/' + os.path.basename(config.kCachePath) + '/', config.kCachePath),
+    ('/', '.'),
+]
+
+# Path of the plain-text metrics page.
+STATS_PATH = '/stats'
+
+# Path -> handler module, as pywebsocket maps /kansas to kansas_wsh.py. They
+# are imported by Serve(), so that other handlers need not load the games.
+WEBSOCKET_HANDLERS = {
+    '/kansas': 'server.kansas_wsh',
+}
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class Loop(object):
+    """An asyncore socket map, plus callbacks posted from other threads."""
+
+    def __init__(self):
+        self.map = {}
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+        self._signalled = False
+        self._trigger = _Trigger(self)
+
+    def call_soon_threadsafe(self, fn, *args):
+        with self._lock:
+            self._calls.append((fn, args))
+            if self._signalled:
+                return
+            self._signalled = True
+        self._trigger.pull()
+
+    def run(self):
+        asyncore.loop(timeout=30, use_poll=True, map=self.map)
+
+    def _run_calls(self):
+        with self._lock:
+            calls = self._calls
+            self._calls = collections.deque()
+            self._signalled = False
+        for fn, args in calls:
+            try:
+                fn(*args)
+            except Exception, e:
+                logging.exception(e)
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """Wakes the loop by writing to a pipe it polls."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._rfd, self._wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._rfd, map=loop.map)
+        os.close(self._rfd)
+
+    def pull(self):
+        os.write(self._wfd, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(512)
+        except OSError:
+            pass
+        self.loop._run_calls()
+
+
+class Server(asyncore.dispatcher):
+    """Accepts connections on one port."""
+
+    def __init__(self, loop, executor, port, handlers):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.executor = executor
+        self.handlers = handlers
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('', port))
+        self.listen(1024)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            sock, addr = pair
+            Connection(self.loop, self.executor, sock, addr, self.handlers)
+
+    def handle_error(self):
+        logging.exception("Error accepting connection")
+
+
+class _Connection(object):
+    def __init__(self, remote_addr):
+        self.remote_addr = remote_addr
+
+
+class _Request(object):
+    """The subset of a pywebsocket request that handlers rely on."""
+
+    def __init__(self, connection, ws_stream):
+        self.connection = connection
+        self.ws_stream = ws_stream
+
+
+class _Broadcast(str):
+    """An output frame that may be discarded if the client falls behind."""
+
+
+class WebSocketStream(object):
+    """Stands in for a pywebsocket stream. Sends are buffered by the
+       connection and may be called from any thread."""
+
+    nonblocking = True
+
+    def __init__(self, conn, remote_addr):
+        self._conn = conn
+        self._request = _Request(_Connection(remote_addr), self)
+
+    def send_message(self, message, binary=False, broadcast=False):
+        """Sends a message, which may be discarded by discard_pending() if
+           it is a broadcast."""
+        if type(message) is unicode:
+            message = message.encode('utf-8')
+        self._conn.write(_EncodeFrame(
+            OP_BINARY if binary else OP_TEXT, message), broadcast=broadcast)
+
+    def close_connection(self, wait_response=True):
+        self._conn.shutdown(1000)
+
+    def backlog(self):
+        """Returns the number of broadcasts not yet written to the socket."""
+        return self._conn.backlog()
+
+    def pending(self):
+        """Returns the number of frames not yet written to the socket."""
+        return self._conn.pending()
+
+    def discard_pending(self):
+        self._conn.discard_pending()
+
+    def __repr__(self):
+        return '<WebSocketStream %s:%d>' % self._conn.addr[:2]
+
+
+class Connection(asyncore.dispatcher):
+    """Serves HTTP requests on a socket until it is upgraded to a websocket.
+
+       Only the loop thread touches the socket. Other threads append to
+       the output queue and wake the loop."""
+
+    def __init__(self, loop, executor, sock, addr, handlers):
+        asyncore.dispatcher.__init__(self, sock, map=loop.map)
+        self.loop = loop
+        self.executor = executor
+        self.addr = addr
+        self.handlers = handlers
+        self._inbuf = ''
+        self._out = collections.deque()
+        self._broadcasts = 0
+        self._out_lock = threading.RLock()
+        self._closing = False
+        self._closed = False
+        self._on_read = self._read_http
+        # Websocket state.
+        self.stream = None
+        self._module = None
+        self._handler = None
+        self._fragments = []
+        self._fragment_op = None
+        self._inbox = collections.deque()
+        self._inbox_lock = threading.Lock()
+        self._busy = False
+
+    # Output, callable from any thread.
+
+    def write(self, data, close=False, broadcast=False):
+        with self._out_lock:
+            if self._closed or self._closing:
+                raise ConnectionClosed()
+            if broadcast:
+                data = _Broadcast(data)
+                self._broadcasts += 1
+            self._out.append(data)
+            self._closing = close
+        self.loop.call_soon_threadsafe(self._flush)
+
+    def shutdown(self, status):
+        """Sends a websocket close frame, then closes the socket."""
+        try:
+            self.write(_EncodeFrame(OP_CLOSE, struct.pack('!H', status)),
+                       close=True)
+        except ConnectionClosed:
+            pass
+
+    def backlog(self):
+        return self._broadcasts
+
+    def pending(self):
+        return len(self._out)
+
+    def discard_pending(self):
+        """Discards queued broadcasts, other than one partly sent."""
+        with self._out_lock:
+            self._out = collections.deque(
+                data for data in self._out if type(data) is not _Broadcast)
+            self._broadcasts = 0
+
+    # Loop thread only.
+
+    def _flush(self):
+        if not self._closed and self.writable():
+            self.handle_write()
+
+    def readable(self):
+        return not self._closing
+
+    def writable(self):
+        return bool(self._out) or self._closing
+
+    def handle_write(self):
+        with self._out_lock:
+            while self._out:
+                data = self._out[0]
+                sent = self.send(data)
+                if sent and type(data) is _Broadcast:
+                    self._broadcasts -= 1
+                if sent < len(data):
+                    # The rest of a partly sent frame is never discarded.
+                    self._out[0] = data[sent:]
+                    return
+                self._out.popleft()
+            closing = self._closing
+        if closing:
+            self.handle_close()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self._inbuf += data
+        while self._inbuf and not self._closing and self._on_read():
+            pass
+
+    def handle_close(self):
+        with self._out_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.close()
+        if self.stream:
+            self._enqueue(None)
+
+    def handle_error(self):
+        logging.exception("Error serving %s", self.addr)
+        self.handle_close()
+
+    # HTTP.
+
+    def _read_http(self):
+        """Consumes one request head from the input, returning False if it
+           is incomplete."""
+
+        end = self._inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(self._inbuf) > kMaxHeaderBytes:
+                self._respond(400, 'Bad Request', close=True)
+            return False
+        head, self._inbuf = self._inbuf[:end], self._inbuf[end + 4:]
+        lines = head.split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            self._respond(400, 'Bad Request', close=True)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        path = urllib.unquote(target.split('?', 1)[0])
+        keepalive = (version == 'HTTP/1.1'
+                     and headers.get('connection', '').lower() != 'close')
+
+        if headers.get('upgrade', '').lower() == 'websocket':
+            self._upgrade(path, headers)
+        elif method in ('GET', 'HEAD') and path == STATS_PATH:
+            self._serve_stats(method == 'HEAD', keepalive)
+        elif method in ('GET', 'HEAD'):
+            self._serve_file(path, headers, method == 'HEAD', keepalive)
+        else:
+            self._respond(405, 'Method Not Allowed', close=True)
+        return not self._closing
+
+    def _respond(self, code, reason, headers=(), body='', close=False,
+                 head_only=False):
+        lines = ['HTTP/1.1 %d %s' % (code, reason)]
+        lines.extend('%s: %s' % h for h in headers)
+        lines.append('Content-Length: %d' % len(body))
+        if close:
+            lines.append('Connection: close')
+        data = '\r\n'.join(lines) + '\r\n\r\n'
+        if not head_only:
+            data += body
+        self.write(data, close=close)
+
+    def _serve_stats(self, head_only, keepalive):
+        self._respond(
+            200, 'OK',
+            [('Content-Type', 'text/plain'), ('Cache-Control', 'no-cache')],
+            metrics.Text(), close=not keepalive, head_only=head_only)
+
+    def _serve_file(self, path, headers, head_only, keepalive):
+        for prefix, root in STATIC_ROOTS:
+            if path.startswith(prefix):
+                break
+        root = os.path.abspath(root)
+        filename = os.path.normpath(os.path.join(root, path[len(prefix):]))
+        if filename != root and not filename.startswith(root + os.sep):
+            self._respond(403, 'Forbidden', close=not keepalive)
+            return
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, 'index.html')
+        try:
+            with open(filename, 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                modified = email.utils.formatdate(mtime, usegmt=True)
+                if headers.get('if-modified-since') == modified:
+                    self._respond(304, 'Not Modified', close=not keepalive)
+                    return
+                body = f.read()
+        except IOError:
+            self._respond(404, 'Not Found', close=not keepalive)
+            return
+        ctype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self._respond(
+            200, 'OK', [('Content-Type', ctype), ('Last-Modified', modified)],
+            body, close=not keepalive, head_only=head_only)
+
+    # Websocket.
+
+    def _upgrade(self, path, headers):
+        key = headers.get('sec-websocket-key')
+        if path not in self.handlers or not key \
+                or headers.get('sec-websocket-version') != '13':
+            self._respond(400, 'Bad Request', close=True)
+            return
+        accept = base64.b64encode(hashlib.sha1(key + kWebSocketGUID).digest())
+        self.write('\r\n'.join([
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Accept: ' + accept,
+        ]) + '\r\n\r\n')
+        self._module = self.handlers[path]
+        self._handler = self._module.initHandler
+        remote_addr = self.addr
+        forwarded = headers.get('x-forwarded-for')
+        if forwarded and self.addr[0] in kTrustedProxies:
+            remote_addr = (forwarded.split(',')[-1].strip(),) + self.addr[1:]
+        self.stream = WebSocketStream(self, remote_addr)
+        self._on_read = self._read_frame
+
+    def _read_frame(self):
+        """Consumes one frame from the input, returning False if it is
+           incomplete."""
+
+        buf = self._inbuf
+        if len(buf) < 2:
+            return False
+        b0, b1 = ord(buf[0]), ord(buf[1])
+        fin, opcode = b0 & 0x80, b0 & 0x0f
+        length = b1 & 0x7f
+        pos = 2
+        if length == 126:
+            if len(buf) < 4:
+                return False
+            length, = struct.unpack('!H', buf[2:4])
+            pos = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return False
+            length, = struct.unpack('!Q', buf[2:10])
+            pos = 10
+        if not b1 & 0x80 or length > config.kMaxMessageBytes:
+            self._fail(1002 if not b1 & 0x80 else 1009)
+            return False
+        if len(buf) < pos + 4 + length:
+            return False
+        mask = buf[pos:pos + 4]
+        payload = _Unmask(buf[pos + 4:pos + 4 + length], mask)
+        self._inbuf = buf[pos + 4 + length:]
+
+        if opcode == OP_CLOSE:
+            self.shutdown(1000)
+        elif opcode == OP_PING:
+            self.write(_EncodeFrame(OP_PONG, payload))
+        elif opcode == OP_PONG:
+            pass
+        elif opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+            if opcode != OP_CONTINUATION:
+                self._fragment_op = opcode
+                self._fragments = []
+            elif self._fragment_op is None:
+                self._fail(1002)
+                return False
+            self._fragments.append(payload)
+            if sum(map(len, self._fragments)) > config.kMaxMessageBytes:
+                self._fail(1009)
+                return False
+            if fin:
+                message = ''.join(self._fragments)
+                if self._fragment_op == OP_TEXT:
+                    message = message.decode('utf-8')
+                self._fragment_op = None
+                self._fragments = []
+                self._enqueue(message)
+        else:
+            self._fail(1002)
+            return False
+        return True
+
+    def _fail(self, status):
+        logging.warning("Closing %s with status %d", self.addr, status)
+        self.shutdown(status)
+
+    def _enqueue(self, message):
+        """Queues a message for the handler, where None signals the close."""
+
+        with self._inbox_lock:
+            self._inbox.append(message)
+            if self._busy:
+                return
+            self._busy = True
+        self.executor.submit(self._serve)
+
+    def _serve(self):
+        """Serves the next queued message, then yields the executor thread
+           to other connections if more are waiting."""
+
+        with self._inbox_lock:
+            message = self._inbox.popleft()
+        if message is None:
+            logging.info("Socket closed")
+            self._handler.notify_closed(self.stream)
+        else:
+            self._handler = self._module.handle_message(
+                self._handler, self.stream, message)
+        with self._inbox_lock:
+            if not self._inbox:
+                self._busy = False
+                return
+        self.executor.submit(self._serve)
+
+
+def _EncodeFrame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _Unmask(data, mask):
+    """XORs data with the repeated mask, a whole int at a time."""
+
+    if not data:
+        return data
+    n = len(data)
+    key = (mask * (n // 4 + 1))[:n]
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify('%0*x' % (2 * n, value))
+
+
+def Serve(ports, handlers=WEBSOCKET_HANDLERS):
+    """Serves on each port until interrupted, with handlers mapping paths
+       to the names of websocket handler modules."""
+
+    modules = dict((path, importlib.import_module(name))
+                   for path, name in handlers.iteritems())
+    loop = Loop()
+    executor = workers.Pool(config.kExecutorThreads)
+    metrics.Gauge('executor_depth', executor.depth)
+    for port in ports:
+        Server(loop, executor, port, modules)
+        logging.info("Listening on port %d", port)
+    loop.run()
+
+
+# vim: ts=4 sw=4 et
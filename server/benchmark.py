@@ -0,0 +1,366 @@
+# Microbenchmarks for server hot paths.
+#
+# Usage: python server/benchmark.py [name_substring ...]
+#
+# Runs in a scratch directory, so that the relative paths in config refer to
+# a throwaway database and cache, and prints results as JSON. The localdb
+# datasource is given a synthetic catalog and image directory, so that no
+# downloads are needed and runs are comparable across machines.
+
+import csv
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def measure(name, fn, ops, **params):
+    """Times fn(), which performs ops operations, returning a result record."""
+
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    return {
+        'name': name,
+        'params': params,
+        'ops': ops,
+        'seconds': elapsed,
+        'us_per_op': 1e6 * elapsed / max(ops, 1),
+    }
+
+
+def makeGame(kansas_wsh, num_cards, num_stacks=1):
+    """Returns a game handler with num_cards spread over num_stacks."""
+
+    data = dict(kansas_wsh.BLANK_DECK)
+    data['board'] = dict((loc, range(loc, num_cards, num_stacks))
+                         for loc in range(num_stacks))
+    data['urls'] = dict((i, '/card/%d.jpg' % i) for i in range(num_cards))
+    data['urls_small'] = dict((i, '/card/%d@small.jpg' % i)
+                              for i in range(num_cards))
+    game = kansas_wsh.KansasGameHandler('bench', 'bench', 'pokerdb')
+    game.restore((data, 1000))
+    return game
+
+
+@benchmark
+def moveCard(kansas_wsh):
+    results = []
+    for size in [60, 600, 6000]:
+        state = makeGame(kansas_wsh, size)._state
+        def run():
+            # Deals the pile from the bottom, the worst case for lists.
+            for card in range(size):
+                state.moveCard(card, 'board', 1, -1)
+        results.append(measure('moveCard', run, size, stack_size=size))
+    return results
+
+
+@benchmark
+def buildIndex(kansas_wsh):
+    results = []
+    for size in [60, 600, 6000]:
+        state = makeGame(kansas_wsh, size, num_stacks=20)._state
+        def run():
+            for i in range(10):
+                state.buildIndex()
+        results.append(measure('buildIndex', run, 10 * size, cards=size))
+    return results
+
+
+@benchmark
+def gc(kansas_wsh):
+    results = []
+    for size in [60, 600, 6000]:
+        state = makeGame(kansas_wsh, size, num_stacks=20)._state
+        def run():
+            for i in range(10):
+                state.gc()
+        results.append(measure('gc', run, 10 * size, cards=size))
+    return results
+
+
+@benchmark
+def bulkmove(kansas_wsh):
+    results = []
+    for size in [60, 600, 6000]:
+        game = makeGame(kansas_wsh, size)
+        moves = [{
+            'card': card,
+            'dest_type': 'board',
+            'dest_key': 1,
+            'dest_orient': -1,
+        } for card in range(size)]
+        def run():
+            game.handle_bulkmove({'moves': moves}, None)
+        results.append(measure('bulkmove', run, size, stack_size=size))
+    return results
+
+
+@benchmark
+def decodeBulkmove(kansas_wsh):
+    results = []
+    for size in [60, 600, 6000]:
+        line = json.dumps({'moves': [{
+            'card': card,
+            'dest_type': 'board',
+            'dest_key': 1,
+            'dest_orient': -1,
+        } for card in range(size)]})
+        # Compares the bulkmove schema against escaping every field.
+        for name, check in [('schema', kansas_wsh.REQUESTS['bulkmove']),
+                            ('escaped', kansas_wsh.DEFAULT_REQUEST)]:
+            requests = [json.loads(line) for i in range(10)]
+            def run():
+                for request in requests:
+                    check(request)
+            results.append(measure(
+                'decodeBulkmove', run, 10 * size, moves=size, decoder=name))
+    return results
+
+
+@benchmark
+def snapshot(kansas_wsh):
+    from server import namespaces
+    results = []
+    for size in [60, 600, 6000]:
+        game = makeGame(kansas_wsh, size, num_stacks=20)
+        data = namespaces.BinaryPickle.dumps(game.snapshot())
+        def export():
+            for i in range(10):
+                game.snapshot()
+        def dumps():
+            for i in range(10):
+                namespaces.BinaryPickle.dumps(game.snapshot())
+        def loads():
+            for i in range(10):
+                game.restore(namespaces.BinaryPickle.loads(data))
+        def view():
+            for i in range(10):
+                json.dumps(game.view())
+        for name, fn in [('export', export), ('dumps', dumps),
+                         ('loads', loads), ('view_json', view)]:
+            results.append(measure(
+                'snapshot', fn, 10, cards=size, step=name, bytes=len(data)))
+    return results
+
+
+@benchmark
+def escape(kansas_wsh):
+    results = []
+    for size in [100, 1000, 10000]:
+        line = json.dumps({'cards': [{
+            'name': 'Card <%d> "quoted" & more' % i,
+            'loc': i,
+            'tags': ['a', 'b&c'],
+        } for i in range(size)]})
+        requests = [json.loads(line) for i in range(10)]
+        # Requests of unknown type, and broadcasts, are escaped throughout.
+        check = kansas_wsh.DEFAULT_REQUEST
+        def run():
+            for request in requests:
+                check(request)
+        results.append(measure('escape', run, 10 * size, entries=size))
+    return results
+
+
+@benchmark
+def namespace(kansas_wsh):
+    from server import namespaces
+    results = []
+    size = 10000
+    value = {'name': 'Card', 'img_url': '../localdb/Card.jpg', 'cost': 3}
+    for name, serializer in [('pickle', namespaces.pickle),
+                             ('binary', namespaces.BinaryPickle)]:
+        ns = namespaces.Namespace(
+            kansas_wsh.config.kDBPath, 'Bench' + name, serializer=serializer)
+        def put():
+            for i in range(size):
+                ns.Put(i, value)
+        def get():
+            for i in range(size):
+                ns.Get(i)
+        def iterate():
+            for k, v in ns:
+                pass
+        for op, fn in [('put', put), ('get', get), ('iterate', iterate)]:
+            results.append(measure(
+                'namespace', fn, size, op=op, serializer=name))
+    return results
+
+
+# Typical searches: a type, colors, costs, and combinations of them.
+QUERIES = [
+    'goblin',
+    'green creature',
+    'red 2 mana',
+    '1 to 3 cost dragon',
+    'cost<=2 blue instant',
+    'colorless artifact',
+    'dual',
+]
+
+
+@benchmark
+def localdbFetch(kansas_wsh):
+    from server import plugins
+    plugin = kansas_wsh.datasource._SOURCES['localdb']
+    results = []
+    for query in QUERIES:
+        for cached in [False, True]:
+            def run():
+                for i in range(10):
+                    if not cached:
+                        plugin.plans.clear()
+                    plugin.Fetch(query, exact=False, limit=100)
+            results.append(measure(
+                'localdbFetch', run, 10, query=query, cached=cached,
+                numpy=plugins.haveNumpy, catalog=len(plugin.catalog)))
+    names = random.Random(0).sample(sorted(plugin.fullnames.values()), 100)
+    def exact():
+        for name in names:
+            plugin.Fetch(name, exact=True)
+    results.append(measure(
+        'localdbFetch', exact, len(names), query='exact',
+        catalog=len(plugin.catalog)))
+    return results
+
+
+@benchmark
+def completeName(kansas_wsh):
+    plugin = kansas_wsh.datasource._SOURCES['localdb']
+    names = random.Random(0).sample(sorted(plugin.names), 100)
+    results = []
+    # Prefixes as typed, and the first letters of a later word.
+    for length in [1, 3, 6]:
+        prefixes = [name[:length] for name in names] + \
+            [name.split()[-1][:length] for name in names]
+        def run():
+            for prefix in prefixes:
+                plugin.CompleteName(prefix, 10)
+        results.append(measure(
+            'completeName', run, len(prefixes), length=length,
+            catalog=len(plugin.names)))
+    return results
+
+
+@benchmark
+def deckgen(kansas_wsh):
+    from server import plugins
+    catalog = plugins.Catalog
+    results = []
+    for term in ['goblin', 'dragon wizard']:
+        def run():
+            catalog.makeDecks(term, 4)
+        results.append(measure('makeDecks', run, 4, term=term))
+    names = random.Random(0).sample(sorted(catalog.byName), 20)
+    for num_cards in [0, 20]:
+        cards = dict((name, 2) for name in names[:num_cards // 2])
+        def run():
+            for i in range(10):
+                catalog.complete(cards)
+        results.append(measure('complete', run, 10, cards=num_cards))
+    return results
+
+
+# Words of synthetic card names and rules text.
+_SYLLABLES = ['ar', 'bel', 'cor', 'dra', 'en', 'fal', 'gor', 'hel', 'is',
+              'jor', 'kel', 'lum', 'mor', 'nar', 'or', 'pyr', 'quel', 'ros',
+              'sar', 'tor', 'ul', 'vor', 'wyn', 'zan']
+_SUBTYPES = ['Goblin', 'Elf', 'Dragon', 'Wizard', 'Soldier', 'Zombie',
+             'Beast', 'Spirit']
+_BASICS = [('Plains', 'W'), ('Island', 'U'), ('Swamp', 'B'),
+           ('Mountain', 'R'), ('Forest', 'G')]
+
+
+def makeCatalog(root, num_cards=3000, seed=0):
+    """Writes a catalog, classification and image directory of num_cards
+       random cards under root, where the localdb datasource expects them."""
+
+    rand = random.Random(seed)
+    words = sorted(set(
+        ''.join(rand.sample(_SYLLABLES, rand.randint(2, 3)))
+        for i in range(600)))
+    words = [w for w in words if len(w) > 3][:400]
+    rows = []
+    for name, color in _BASICS:
+        rows.append([name, 'Land', '', '', '', '{T}: Add {%s}.' % color,
+                     'Core', 'Common'])
+    names = set(row[0] for row in rows)
+    while len(rows) < num_cards:
+        name = ' '.join(w.capitalize() for w in rand.sample(words, 2))
+        if name in names:
+            continue
+        names.add(name)
+        text = ' '.join(rand.sample(words, 8))
+        kind = rand.random()
+        if kind < 0.05:
+            a, b = rand.sample(_BASICS, 2)
+            rows.append([name, 'Land', '', '', '',
+                         '{T}: Add {%s} or {%s}. %s' % (a[1], b[1], text),
+                         'Core', 'Rare'])
+            continue
+        generic = rand.randint(0, 5)
+        if kind < 0.15:
+            card_type, subtype, colors = 'Artifact', '', ''
+        else:
+            colors = rand.sample('WUBRG', 1 if rand.random() < 0.8 else 2)
+            if kind < 0.6:
+                card_type, subtype = 'Creature', rand.choice(_SUBTYPES)
+            else:
+                card_type, subtype = rand.choice(
+                    ['Instant', 'Sorcery', 'Enchantment']), ''
+        mana = '{%d}' % generic + ''.join('{%s}' % c for c in colors)
+        cost = generic + len(colors)
+        rows.append([name, card_type, subtype, mana, str(cost), text,
+                     'Core', rand.choice(['Common', 'Uncommon', 'Rare'])])
+    with open(os.path.join(root, 'mtg_info.txt'), 'wb') as f:
+        csv.writer(f, escapechar='\\').writerows(rows)
+    with open(os.path.join(root, 'classification.txt'), 'w') as f:
+        for row in rows:
+            f.write('0 %s\n' % row[0])
+    for row in rows:
+        open(os.path.join(root, 'localdb', row[0] + '.jpg'), 'w').close()
+
+
+def setup():
+    """Enters a scratch directory and returns the imported server module."""
+
+    root = tempfile.mkdtemp(prefix='kansas-bench-')
+    for d in ['run', 'localdb']:
+        os.makedirs(os.path.join(root, d))
+    makeCatalog(root)
+    os.chdir(os.path.join(root, 'run'))
+    logging.disable(logging.CRITICAL)
+    # Keeps catalog loading chatter out of the JSON output.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        from server import kansas_wsh
+    finally:
+        sys.stdout = stdout
+    return kansas_wsh
+
+
+def main(filters):
+    kansas_wsh = setup()
+    results = []
+    for fn in BENCHMARKS:
+        if not filters or any(f in fn.__name__ for f in filters):
+            results.extend(fn(kansas_wsh))
+    print json.dumps({'time': time.time(), 'results': results}, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
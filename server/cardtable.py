@@ -0,0 +1,155 @@
+# Implements compact storage of per-card attributes.
+
+import threading
+
+# Process-wide table of interned strings, such as image urls.
+_strings = []
+_string_ids = {}
+_lock = threading.Lock()
+
+
+def Intern(s):
+    """Returns the small int id of s in the process-wide string table."""
+
+    if s is None:
+        return -1
+    try:
+        return _string_ids[s]
+    except KeyError:
+        with _lock:
+            if s not in _string_ids:
+                _string_ids[s] = len(_strings)
+                _strings.append(s)
+            return _string_ids[s]
+
+
+def Lookup(string_id):
+    if string_id < 0:
+        return None
+    return _strings[string_id]
+
+
+class Card(object):
+    """Attributes of a single card, with strings held as interned ids."""
+
+    __slots__ = ('orient', 'url_id', 'small_url_id', 'back_url_id', 'title_id')
+
+    def __init__(self, orient=-1, url=None, small_url=None, back_url=None,
+                 title=None):
+        self.orient = orient
+        self.url_id = Intern(url)
+        self.small_url_id = Intern(small_url)
+        self.back_url_id = Intern(back_url)
+        self.title_id = Intern(title)
+
+    url = property(lambda self: Lookup(self.url_id))
+    small_url = property(lambda self: Lookup(self.small_url_id))
+    back_url = property(lambda self: Lookup(self.back_url_id))
+    title = property(lambda self: Lookup(self.title_id))
+
+
+# Maps the per-attribute dicts of the client protocol to Card slots.
+_VIEWS = [
+    ('urls', 'url_id'),
+    ('urls_small', 'small_url_id'),
+    ('back_urls', 'back_url_id'),
+    ('titles', 'title_id'),
+]
+
+VIEW_KEYS = ['orientations'] + [key for key, _ in _VIEWS]
+
+_ROW = 6
+
+
+class CardTable(object):
+    """Table of the cards in a game, keyed by int card id."""
+
+    def __init__(self):
+        self.cards = {}
+        self.highest_id = 0
+
+    def add(self, card_id, orient=-1, url=None, small_url=None,
+            back_url=None, title=None):
+        self.cards[card_id] = Card(orient, url, small_url, back_url, title)
+        self.highest_id = max(self.highest_id, card_id)
+        return card_id
+
+    def new(self, url, small_url):
+        """Returns the id of a newly allocated card."""
+        return self.add(self.highest_id + 1, url=url, small_url=small_url)
+
+    def remove(self, card_id):
+        del self.cards[card_id]
+
+    def ids(self):
+        return self.cards.keys()
+
+    def __getitem__(self, card_id):
+        return self.cards[card_id]
+
+    def __contains__(self, card_id):
+        return card_id in self.cards
+
+    def __len__(self):
+        return len(self.cards)
+
+    def view(self):
+        """Returns the attribute dicts used by the client protocol."""
+
+        view = dict((key, {}) for key in VIEW_KEYS)
+        orientations = view['orientations']
+        for card_id, card in self.cards.iteritems():
+            orientations[card_id] = card.orient
+            for key, slot in _VIEWS:
+                string_id = getattr(card, slot)
+                if string_id >= 0:
+                    view[key][card_id] = _strings[string_id]
+        return view
+
+    def pack(self):
+        """Returns a compact picklable form of the table. Strings are stored
+           once each, since interned ids are only valid in this process."""
+
+        strings = []
+        local_ids = {-1: -1}
+        rows = []
+        for card_id, card in self.cards.iteritems():
+            rows.append(card_id)
+            rows.append(card.orient)
+            for _, slot in _VIEWS:
+                string_id = getattr(card, slot)
+                if string_id not in local_ids:
+                    local_ids[string_id] = len(strings)
+                    strings.append(_strings[string_id])
+                rows.append(local_ids[string_id])
+        return {'strings': strings, 'rows': rows}
+
+    @classmethod
+    def unpack(cls, packed):
+        table = cls()
+        ids = [Intern(s) for s in packed['strings']]
+        rows = packed['rows']
+        for i in xrange(0, len(rows), _ROW):
+            card = Card(rows[i + 1])
+            for j, (_, slot) in enumerate(_VIEWS):
+                local_id = rows[i + 2 + j]
+                setattr(card, slot, ids[local_id] if local_id >= 0 else -1)
+            table.cards[rows[i]] = card
+            table.highest_id = max(table.highest_id, rows[i])
+        return table
+
+    @classmethod
+    def from_dicts(cls, data):
+        """Builds a table from the per-attribute dicts of the client
+           protocol, the format of snapshots saved by older servers."""
+
+        table = cls()
+        card_ids = set()
+        for key in VIEW_KEYS:
+            card_ids.update(data.get(key, {}))
+        for card_id in card_ids:
+            table.add(
+                card_id,
+                data.get('orientations', {}).get(card_id, -1),
+                *[data.get(key, {}).get(card_id) for key, _ in _VIEWS])
+        return table
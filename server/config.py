@@ -4,8 +4,24 @@ kSmallImageSize = (92, 131)
 kServingPrefix = ''
 kLocalServingAddress = 'http://localhost:8000/'
 kCachePath = '../cache'
-kClientVersion = 166
+kClientVersion = 168
 kDBPath = '../db'
+kCheckpointOps = 100
+kCheckpointSecs = 60
+kFlushIntervalSecs = 1.0
+kResyncWindow = 256
+kOutboxSize = 256
+kCoalesceMillis = 5
+kDeflateMinBytes = 1024
+kExecutorThreads = 8
+kWorkerThreads = 4
+kWorkerQueueSize = 64
+kActorThreads = 8
+kMaxMessageBytes = 1 << 22
+kKeepaliveSecs = 60
+kPresenceTickSecs = 5
+kWorkerStartSecs = 30
+kCompletions = 10
 
 if not os.path.exists(kCachePath):
     os.makedirs(kCachePath)
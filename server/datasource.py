@@ -2,6 +2,7 @@
 
 from server import config
 from server import imagecache
+from server import metrics
 from server import namespaces
 from server import plugins
 
@@ -40,13 +41,13 @@ def SampleDeck(source, term, num_decks):
     return _SOURCES[source].SampleDeck(term, num_decks)
 
 
-def _FindCards(source, name, exact, limit=None):
+def _FindCards(source, name, exact, limit=None, cursor=None):
     """Same as FindCards but skips caches."""
 
     if source not in _SOURCES:
         raise Exception("Source '%s' not found." % str(source))
 
-    return _SOURCES[source].Fetch(name, exact, limit)
+    return _SOURCES[source].Fetch(name, exact, limit, cursor)
 
 
 def Complete(source, cards):
@@ -56,7 +57,17 @@ def Complete(source, cards):
     return _SOURCES[source].Complete(cards)
 
 
-def Find(source, name, exact=False, limit=None):
+def CompleteName(source, prefix, limit=None):
+    """Returns names of cards completing prefix, for typeahead. These are
+       found fast enough to need no cache."""
+
+    if source not in _SOURCES:
+        raise Exception("Source '%s' not found." % str(source))
+
+    return _SOURCES[source].CompleteName(prefix, limit or config.kCompletions)
+
+
+def Find(source, name, exact=False, limit=None, cursor=None):
     """Returns (stream, meta), where
         stream is a list of
         {
@@ -64,17 +75,20 @@ def Find(source, name, exact=False, limit=None):
             'img_url': 'http://...',
             'info_url': 'http://...',
         }
-        and meta is a dictionary of extra attributes."""
+        and meta is a dictionary of extra attributes. If meta has a 'cursor',
+        passing it back returns the next page of results."""
 
-    key = str((str(source), str(name), bool(exact), str(limit)))
+    key = str((str(source), str(name), bool(exact), str(limit), str(cursor)))
     result = QueryCache.Get(key)
 
     if result is None:
         logging.info("Cache miss on '%s'", key)
-        result = _FindCards(source, name, exact, limit)
+        metrics.Count('query_cache_misses')
+        result = _FindCards(source, name, exact, limit, cursor)
         QueryCache.Put(key, result)
     else:
         logging.info("Cache HIT on '%s'", key)
+        metrics.Count('query_cache_hits')
 
     # Rewrites result stream to use cached images if possible.
     for card in result[0]:
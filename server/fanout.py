@@ -0,0 +1,189 @@
+# Implements non-blocking delivery of messages to websocket streams.
+
+from server import wire
+
+import collections
+import json
+import logging
+import Queue
+import threading
+
+# Sent in place of discarded messages when a client falls too far behind.
+RESYNC_REQUIRED = json.dumps({'type': 'resync_required'})
+
+_CLOSE = object()
+
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _Count(**deltas):
+    with _stats_lock:
+        _stats.update(deltas)
+
+
+def Stats():
+    """Returns counters of frames and bytes encoded versus sent."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class Frame(object):
+    """A message serialized once per wire encoding, then shared by every
+       outbox it is offered to rather than re-encoded per recipient."""
+
+    __slots__ = ('message', 'payloads')
+
+    def __init__(self, message, encodings=(wire.JSON,)):
+        self.message = message
+        self.payloads = {}
+        for encoding in set(encodings):
+            self.payloads[encoding] = wire.Encode(message, encoding)
+            _Count(frames_encoded=1,
+                   bytes_encoded=len(self.payloads[encoding][0]))
+
+    def encoded(self, encoding):
+        """Returns (payload, binary) for encoding."""
+        if encoding not in self.payloads:
+            self.payloads[encoding] = wire.Encode(self.message, encoding)
+        return self.payloads[encoding]
+
+
+def OutboxFor(stream, capacity, on_error=None):
+    """Returns an outbox suited to stream. Streams that buffer writes
+       themselves are flagged nonblocking, and need no writer thread."""
+
+    if getattr(stream, 'nonblocking', False):
+        return DirectOutbox(stream, capacity, on_error)
+    return Outbox(stream, capacity, on_error)
+
+
+class Outbox(object):
+    """A bounded queue of outbound messages for one stream, drained by a
+       dedicated writer thread so that a slow consumer only delays itself.
+
+       If the queue overflows, its pending messages are discarded in favor
+       of a request that the client resync, and on_error(stream) is called
+       if the stream fails."""
+
+    def __init__(self, stream, capacity, on_error=None):
+        self.stream = stream
+        self.on_error = on_error
+        self.overflows = 0
+        self._queue = Queue.Queue(capacity)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def offer(self, message):
+        """Enqueues a Frame or encoded message without blocking, returning
+           False on overflow."""
+
+        with self._lock:
+            if self._closed:
+                return False
+            try:
+                self._queue.put_nowait(message)
+                return True
+            except Queue.Full:
+                self.overflows += 1
+                self._discard()
+                self._queue.put_nowait(RESYNC_REQUIRED)
+                return False
+
+    def close(self, disconnect=False):
+        """Stops the writer once queued messages are sent."""
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._queue.full():
+                self._discard()
+            self._queue.put_nowait((_CLOSE, disconnect))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _discard(self):
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            try:
+                if type(message) is tuple and message[0] is _CLOSE:
+                    if message[1]:
+                        self.stream.close_connection(wait_response=False)
+                    return
+                binary = False
+                if type(message) is Frame:
+                    message, binary = message.encoded(
+                        wire.EncodingOf(self.stream))
+                self.stream.send_message(message, binary=binary)
+                _Count(messages_sent=1, bytes_sent=len(message))
+            except Exception, e:
+                logging.exception(e)
+                logging.warning("Removing broken stream %s", self.stream)
+                self.close()
+                if self.on_error:
+                    self.on_error(self.stream)
+                return
+
+
+class DirectOutbox(object):
+    """An Outbox for nonblocking streams, which are bounded by the number of
+       broadcasts still buffered in the stream itself. Only those are
+       discarded on overflow, so replies queued with them are still sent."""
+
+    def __init__(self, stream, capacity, on_error=None):
+        self.stream = stream
+        self.capacity = capacity
+        self.on_error = on_error
+        self.overflows = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def offer(self, message):
+        with self._lock:
+            if self._closed:
+                return False
+            if self.stream.backlog() >= self.capacity:
+                self.overflows += 1
+                self.stream.discard_pending()
+                self._send(RESYNC_REQUIRED)
+                return False
+            return self._send(message)
+
+    def close(self, disconnect=False):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if disconnect:
+                self.stream.close_connection(wait_response=False)
+
+    def depth(self):
+        return self.stream.backlog()
+
+    def _send(self, message):
+        binary = False
+        try:
+            if type(message) is Frame:
+                message, binary = message.encoded(wire.EncodingOf(self.stream))
+            self.stream.send_message(message, binary=binary, broadcast=True)
+            _Count(messages_sent=1, bytes_sent=len(message))
+            return True
+        except Exception, e:
+            logging.warning("Removing broken stream %s: %s", self.stream, e)
+            self._closed = True
+            if self.on_error:
+                threading.Thread(
+                    target=self.on_error, args=(self.stream,)).start()
+            return False
@@ -0,0 +1,148 @@
+# Implements persistence of games as checkpoints plus a journal of moves.
+
+from server import metrics
+
+import logging
+import threading
+import time
+
+
+def _SeqKey(seqno):
+    """Formats seqno so that lexicographic key order is numeric order."""
+    return '%012d' % seqno
+
+
+class GameStore(object):
+    """Persists the games of one scope.
+
+       Each game is stored as a full checkpoint of its snapshot, plus an
+       append-only journal of the operations applied since, keyed by seqno.
+       Writing a checkpoint truncates the journal of that game.
+
+       A small summary record is written alongside, so that games can be
+       listed without loading them."""
+
+    def __init__(self, games, journal, summaries):
+        self.games = games
+        self.journal = journal
+        self.summaries = summaries
+
+    def _log(self, gameid):
+        return self.journal.Subspace(gameid)
+
+    def Append(self, gameid, entries, summary):
+        """Journals [(seqno, entry)] and updates the summary of gameid."""
+        with self.games.Batch():
+            log = self._log(gameid)
+            for seqno, entry in entries:
+                log.Put(_SeqKey(seqno), entry)
+            self.summaries.Put(gameid, summary)
+
+    def Checkpoint(self, gameid, snapshot, summary):
+        with self.games.Batch():
+            self.games.Put(gameid, snapshot)
+            self._log(gameid).Clear()
+            self.summaries.Put(gameid, summary)
+
+    def Delete(self, gameid):
+        with self.games.Batch():
+            self.games.Delete(gameid)
+            self._log(gameid).Clear()
+            self.summaries.Delete(gameid)
+
+    def Load(self, gameid):
+        """Returns (snapshot, journal) of gameid, or None if not persisted."""
+
+        snapshot = self.games.Get(gameid)
+        if snapshot is None:
+            return None
+        return snapshot, self.Journal(gameid, snapshot[1])
+
+    def Summaries(self):
+        """Returns {gameid: summary} for each persisted game."""
+
+        summaries = dict(self.summaries)
+        for gameid in self.games.Keys():
+            if gameid not in summaries:
+                summaries[gameid] = {'last_used': 0}
+        return summaries
+
+    def Journal(self, gameid, after_seqno):
+        """Returns [(seqno, entry)] journaled after after_seqno, in order."""
+
+        return [(int(k), entry) for k, entry in self._log(gameid)
+                if int(k) > after_seqno]
+
+
+class Persister(threading.Thread):
+    """Write-behind persistence for games.
+
+       Games call mark_dirty() after mutating, and are flushed by calling
+       their flush() method from this thread at most once per interval,
+       so that callers never wait on serialization or disk."""
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._dirty = {}
+        self.flushes = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def mark_dirty(self, game):
+        with self._cond:
+            if game not in self._dirty:
+                self._dirty[game] = time.time()
+                self._cond.notify()
+
+    def forget(self, game):
+        """Drops any pending flush of game."""
+        with self._cond:
+            self._dirty.pop(game, None)
+
+    def flush_all(self):
+        with self._cond:
+            dirty, self._dirty = self._dirty, {}
+        for game, since in dirty.items():
+            self._flush(game, since)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'dirty': len(self._dirty),
+                'flushes': self.flushes,
+                'last_lag_ms': 1000 * self.last_lag,
+                'max_lag_ms': 1000 * self.max_lag,
+            }
+
+    def _flush(self, game, since):
+        try:
+            with metrics.Timer('save_ms'):
+                game.flush()
+        except Exception, e:
+            logging.exception(e)
+        lag = time.time() - since
+        metrics.Record('save_lag_ms', 1000 * lag)
+        with self._cond:
+            self.flushes += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                now = time.time()
+                due = [(game, since) for game, since in self._dirty.items()
+                       if now - since >= self.interval]
+                if not due:
+                    oldest = min(self._dirty.values())
+                    self._cond.wait(self.interval - (now - oldest))
+                    continue
+                for game, _ in due:
+                    del self._dirty[game]
+            for game, since in due:
+                self._flush(game, since)
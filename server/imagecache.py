@@ -1,6 +1,7 @@
 # Implements local caching of images.
 
 from server import config
+from server import metrics
 from server import namespaces
 
 import logging
@@ -22,7 +23,9 @@ def CachedIfPresent(url):
 
 
 def CachePeek(url):
-    return CacheMap.Get(url)
+    name = CacheMap.Get(url)
+    metrics.Count('cache_map_misses' if name is None else 'cache_map_hits')
+    return name
 
 
 def Cached(url, dont_fetch=False):
@@ -39,6 +42,7 @@ def Cached(url, dont_fetch=False):
 
     if not os.path.exists(path):
         logging.debug("cache miss: " + url)
+        metrics.Count('image_cache_misses')
 
         if dont_fetch:
             return None
@@ -50,5 +54,7 @@ def Cached(url, dont_fetch=False):
             f.write(imgdata)
 
         CacheMap.Put(url, name)
+    else:
+        metrics.Count('image_cache_hits')
 
     return path
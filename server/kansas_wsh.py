@@ -1,20 +1,30 @@
 # Implementation of Kansas websocket handler.
 
+from server import cardtable
 from server import config
 from server import datasource
+from server import fanout
+from server import gamestore
 from server import imagecache
+from server import metrics
 from server import namespaces
-
-import cgi
+from server import presence
+from server import schema
+from server import stacks
+from server import wire
+from server import workers
+
+import atexit
+import base64
 import collections
 import copy
 import json
 import logging
 import os
-import random
 import threading
 import time
 import urllib2
+import zlib
 
 try:
     import Image
@@ -24,15 +34,47 @@ except:
     haveImaging = False
 
 
-Games = namespaces.Namespace(config.kDBPath, 'Games', version=2)
+Games = namespaces.Namespace(
+    config.kDBPath, 'Games', version=2, serializer=namespaces.BinaryPickle)
+Journal = namespaces.Namespace(
+    config.kDBPath, 'Journal', version=0, serializer=namespaces.BinaryPickle)
+GameSummaries = namespaces.Namespace(
+    config.kDBPath, 'GameSummaries', version=0,
+    serializer=namespaces.BinaryPickle)
 ClientDB = namespaces.Namespace(config.kDBPath, 'ClientDB', version=2)
 GlobalDB = namespaces.Namespace(config.kDBPath, 'Global', version=0)
 
+# Namespaces holding the data of each scope, by name.
+SCOPE_DBS = {
+    'ClientDB': ClientDB,
+    'Games': Games,
+    'Journal': Journal,
+    'GameSummaries': GameSummaries,
+}
+
+
+# Fields of a player's presence that list_presence may reveal.
+PUBLIC_PRESENCE = ['pid', 'name', 'orient']
+
 
 def SubspaceKey(scope, sourceid):
     return "%s::%s" % (scope, sourceid)
 
 
+def CardChecksum(card, loc_type, loc, orient):
+    """Hashes the position of a card. The state checksum is the sum of these
+       mod 2**32, which clients can recompute to detect desync."""
+    key = u'%d|%s|%s|%d' % (card, loc_type, loc, orient)
+    return zlib.crc32(key.encode('utf-8')) & 0xffffffff
+
+
+def ScopedGameStore(subspaceKey):
+    return gamestore.GameStore(
+        Games.Subspace(subspaceKey),
+        Journal.Subspace(subspaceKey),
+        GameSummaries.Subspace(subspaceKey))
+
+
 class KansasRedirect(Exception):
     def __init__(self, msg, url):
         Exception.__init__(self, msg)
@@ -53,31 +95,40 @@ BLANK_DECK = {
 
 
 class CachingLoader(dict):
+    """Holds game data, with per-card attributes kept in self.cards.
+
+       Accepts both the packed 'cards' form written by export() and the
+       per-attribute dicts of the client protocol."""
+
     def __init__(self, values):
-        dict.__init__(self, copy.deepcopy(values))
-        if self['urls']:
-            self.highest_id = max(self['urls'].keys())
+        values = dict(values)
+        if 'cards' in values:
+            self.cards = cardtable.CardTable.unpack(values.pop('cards'))
         else:
-            self.highest_id = 0
+            self.cards = cardtable.CardTable.from_dicts(values)
+        for key in cardtable.VIEW_KEYS:
+            values.pop(key, None)
+        dict.__init__(self, copy.deepcopy(values))
 
         # The cached files are assumed served from this path by another server.
         self['resource_prefix'] = config.kServingPrefix
 
-    def new_card(self, front_url):
-        """Returns id of new card."""
+    def new_card(self, front_url, images=None):
+        """Returns id of new card, given images returned by fetch()."""
+
+        return self.cards.new(*(images or self.fetch(front_url)))
 
-        self.highest_id += 1
-        new_id = self.highest_id
-        large_path = self['urls'][new_id] = self.download(front_url)
+    def fetch(self, front_url):
+        """Returns paths of the cached large and small images for a card."""
+
+        large_path = self.download(front_url)
         small_path = os.path.join(
             config.kCachePath,
             os.path.basename(large_path)[:-4]
                 + ('@%dx%d.jpg' % config.kSmallImageSize))
         if not os.path.exists(small_path):
             small_path = self.resize(large_path, small_path)
-        self['urls_small'][new_id] = small_path
-        self['orientations'][new_id] = -1
-        return new_id
+        return large_path, small_path
 
     def download(self, suffix):
         url = urllib2.unquote(suffix)
@@ -106,13 +157,13 @@ class JSONOutput(object):
 
     def reply(self, datum):
         self.replied = True
-        self.stream.send_message(
-            json.dumps({
-                'type': self.reqtype + '_resp',
-                'data': datum,
-                'time': time.time(),
-                'future_id': self.future_id,
-            }), binary=False)
+        payload, binary = wire.Encode({
+            'type': self.reqtype + '_resp',
+            'data': datum,
+            'time': time.time(),
+            'future_id': self.future_id,
+        }, wire.EncodingOf(self.stream))
+        self.stream.send_message(payload, binary=binary)
 
 
 class KansasGameState(object):
@@ -121,16 +172,28 @@ class KansasGameState(object):
     def __init__(self, sourceid, data=None):
         self.data = CachingLoader(data or BLANK_DECK)
         self.data['default_back_url'] = datasource.BackUrl(sourceid)
+        for loc_type in ['board', 'hands']:
+            self.data[loc_type] = dict(
+                (loc, stacks.Stack(stack))
+                for loc, stack in self.data[loc_type].iteritems())
+        self.cards = self.data.cards
         self.index = self.buildIndex()
         self.initializeStacks(shuffle=True)
         self.sourceid = sourceid
         self.gc()
+        self.checksum = 0
+        for card in self.index:
+            self.checksum += self.cardChecksum(card)
+        self.checksum &= 0xffffffff
+
+    def cardChecksum(self, card):
+        loc_type, loc = self.index[card]
+        return CardChecksum(card, loc_type, loc, self.cards[card].orient)
 
     def gc(self):
-        for s in ['orientations', 'urls_small', 'urls']:
-            for card in self.data[s].keys():
-                if not self.containsCard(card):
-                    del self.data[s][card]
+        for card in self.cards.ids():
+            if not self.containsCard(card):
+                self.cards.remove(card)
 
     def containsCard(self, card):
         return card in self.index
@@ -139,14 +202,14 @@ class KansasGameState(object):
         for loc, stack in self.data['board'].iteritems():
             assert type(loc) is int, "card locs must be int"
             if shuffle:
-                random.shuffle(stack)
+                stack.shuffle()
             for card in stack:
-                if card not in self.data['orientations']:
-                    self.data['orientations'][card] = -1
+                if card not in self.cards:
+                    self.cards.add(card)
         for user, hand in self.data['hands'].iteritems():
             for card in hand:
-                if card not in self.data['orientations']:
-                    self.data['orientations'][card] = -1
+                if card not in self.cards:
+                    self.cards.add(card)
         self.gc()
 
     def buildIndex(self):
@@ -159,6 +222,29 @@ class KansasGameState(object):
                 index[card] = ('hands', user)
         return index
 
+    def export(self):
+        """Returns a copy of the game data with stacks as lists, and the
+           card table in packed form for persistence. Nothing in it is
+           shared with the live state, so it may be written off the loop."""
+        data = {}
+        for key, value in self.data.iteritems():
+            if key in ['board', 'hands']:
+                data[key] = dict(
+                    (loc, stack.tolist()) for loc, stack in value.iteritems())
+            elif isinstance(value, (dict, list)):
+                data[key] = copy.deepcopy(value)
+            else:
+                data[key] = value
+        data['cards'] = self.cards.pack()
+        return data
+
+    def view(self):
+        """Returns the game data in the format expected by clients."""
+        data = self.export()
+        del data['cards']
+        data.update(self.cards.view())
+        return data
+
     def moveCard(self, card, dest_type, dest_key, dest_orient):
         assert dest_type in ['board', 'hands']
         if dest_type == 'board':
@@ -168,9 +254,10 @@ class KansasGameState(object):
         assert dest_orient in range(-4, 5)
 
         src_type, src_key = self.index[card]
+        self.checksum -= self.cardChecksum(card)
         # Implements Z-change on any action except pure orientation changes.
         if ((src_type, src_key) != (dest_type, dest_key)
-                or self.data['orientations'][card] == dest_orient):
+                or self.cards[card].orient == dest_orient):
             # Removes card from where it was.
             self.data[src_type][src_key].remove(card)
             if len(self.data[src_type][src_key]) == 0:
@@ -178,43 +265,62 @@ class KansasGameState(object):
 
             # Places card into new position.
             if dest_key not in self.data[dest_type]:
-                self.data[dest_type][dest_key] = []
+                self.data[dest_type][dest_key] = stacks.Stack()
             self.data[dest_type][dest_key].append(card)
             self.index[card] = (dest_type, dest_key)
 
-        self.data['orientations'][card] = dest_orient
+        self.cards[card].orient = dest_orient
+        self.checksum = (self.checksum + self.cardChecksum(card)) & 0xffffffff
 
         return src_type, src_key
 
     def remove_card(self, card):
         loc_type, loc = self.index[card]
+        self.checksum = (self.checksum - self.cardChecksum(card)) & 0xffffffff
         del self.index[card]
         self.data[loc_type][loc].remove(card)
         if len(self.data[loc_type][loc]) == 0:
             del self.data[loc_type][loc]
         
-    def add_card(self, card):
-        tohand = card.get('tohand')
-        loc = card['loc']
+    def fetch_card(self, card):
+        """Looks up and caches the images for a card, without changing state.
+           This may block on the datasource and on image downloads."""
+
         name = card['name']
         stream, _ = datasource.Find(self.sourceid, name, exact=True)
         if stream:
             url = stream[0]['img_url']
         else:
             raise Exception("Cannot find '%s'" % name);
-        card_id = self.data.new_card(url)
+        return url, self.data.fetch(url)
+
+    def add_card(self, card, fetched=None):
+        tohand = card.get('tohand')
+        loc = card['loc']
+        url, images = fetched or self.fetch_card(card)
+        card_id = self.data.new_card(url, images)
         if tohand:
             key = 'hands'
+            self.cards[card_id].orient = 1
         else:
             key = 'board'
-        if loc in self.data[key]:
-            self.data[key][loc].append(card_id)
-        else:
-            self.data[key][loc] = [card_id]
-        self.index[card_id] = (key, loc)
-        if tohand:
-            self.data['orientations'][card_id] = 1
+        self.place_card(card_id, key, loc)
         return card_id
+
+    def place_card(self, card_id, key, loc):
+        if loc not in self.data[key]:
+            self.data[key][loc] = stacks.Stack()
+        self.data[key][loc].append(card_id)
+        self.index[card_id] = (key, loc)
+        self.checksum = (self.checksum + self.cardChecksum(card_id)) & 0xffffffff
+
+    def restore_card(self, added):
+        """Re-adds a card previously returned in a bulk_add broadcast."""
+
+        card_id = added['id']
+        self.cards.add(
+            card_id, added['orient'], added['url'], added['small_url'])
+        self.place_card(card_id, *added['pos'])
     
 
 class KansasHandler(object):
@@ -222,15 +328,24 @@ class KansasHandler(object):
        driven by requests, and states correspond to KansasHandler classes."""
 
     def __init__(self):
-        self._lock = threading.RLock()
+        self._lock = workers.MeteredLock(type(self).__name__)
         self.handlers = {}
+        # Request types served by the worker pool, so that they don't delay
+        # later requests on the same connection. Their replies may arrive
+        # out of order, and are matched to requests by future_id.
+        self.background = set(['query', 'bulkquery', 'sleep'])
         self.handlers['ping'] = self.handle_ping
         self.handlers['keepalive'] = self.handle_keepalive
         self.handlers['query'] = self.handle_query
+        self.handlers['complete_name'] = self.handle_complete_name
         self.handlers['bulkquery'] = self.handle_bulkquery
         self.handlers['sleep'] = self.handle_sleep
         self.handlers['clone_scope'] = self.handle_clone_scope
+        self.handlers['export_scope'] = self.handle_export_scope
+        self.handlers['import_scope'] = self.handle_import_scope
         self.handlers['list_scope'] = self.handle_list_scope
+        self.handlers['stats'] = self.handle_stats
+        self.handlers['list_presence'] = self.handle_list_presence
 
     def handle_list_scope(self, request, output):
         scope = request['scope']
@@ -247,15 +362,97 @@ class KansasHandler(object):
 
         src = request['src']
         dest = request['dest']
-        dbs = [ClientDB, Games]
-        for db in dbs:
+        with namespaces.Batch(config.kDBPath):
+            for db in SCOPE_DBS.values():
+                for sourcetype in datasource.AllSources():
+                    src_space = db.Subspace(SubspaceKey(src, sourcetype))
+                    dest_space = db.Subspace(SubspaceKey(dest, sourcetype))
+                    dest_space.Clear()
+                    for k, v in src_space:
+                        dest_space.Put(k, v)
+
+    def handle_export_scope(self, request, output):
+        """Replies with the data of a scope kept by this server, so that a
+           router can clone it onto the servers owning the copies."""
+
+        entries = []
+        for name, db in SCOPE_DBS.iteritems():
             for sourcetype in datasource.AllSources():
-                src_space = db.Subspace(SubspaceKey(src, sourcetype))
-                dest_space = db.Subspace(SubspaceKey(dest, sourcetype))
-                for k, _ in dest_space:
-                    dest_space.Delete(k)
-                for k, v in src_space:
-                    dest_space.Put(k, v)
+                space = db.Subspace(SubspaceKey(request['scope'], sourcetype))
+                for k, v in space:
+                    if db is ClientDB:
+                        gameid = ''
+                    else:
+                        # Journal keys are prefixed by their game.
+                        gameid = k.split('\0', 1)[0]
+                    entries.append({
+                        'db': name,
+                        'sourceid': sourcetype,
+                        'gameid': gameid,
+                        'key': k,
+                        'value': base64.b64encode(
+                            namespaces.BinaryPickle.dumps(v)),
+                    })
+        output.reply(entries)
+
+    def handle_import_scope(self, request, output):
+        """Stores entries replied by export_scope in a scope, clearing it
+           first if asked."""
+
+        dest = request['scope']
+        with namespaces.Batch(config.kDBPath):
+            if request['clear']:
+                for db in SCOPE_DBS.values():
+                    for sourcetype in datasource.AllSources():
+                        db.Subspace(SubspaceKey(dest, sourcetype)).Clear()
+            for entry in request['entries']:
+                space = SCOPE_DBS[entry['db']].Subspace(
+                    SubspaceKey(dest, entry['sourceid']))
+                space.Put(entry['key'], namespaces.LoadBuiltins(
+                    base64.b64decode(entry['value'])))
+        output.reply(len(request['entries']))
+
+    def handle_stats(self, request, output):
+        """Replies with the server's metrics - for sysadmin purposes."""
+        output.reply(metrics.Snapshot())
+
+    def handle_list_presence(self, request, output):
+        """Replies with the players in each game - for sysadmin purposes.
+           Their addresses and profiles are left out, as anyone may ask."""
+        entries = []
+        breakdown = initHandler.presence_breakdown()
+        for (scope, sourceid), games in breakdown.iteritems():
+            for gameid, players in games.iteritems():
+                entries.append({
+                    'scope': scope,
+                    'datasource': sourceid,
+                    'gameid': gameid,
+                    'players': [
+                        dict((k, p.get(k)) for k in PUBLIC_PRESENCE)
+                        for p in players],
+                })
+        output.reply(entries)
+
+    def handle_kvop(self, req, output):
+        """Serves the ClientDB of the scope, for handlers that have one."""
+        op = req['op']
+        ns = self.ScopedClientDB.Subspace(req['namespace'])
+        resp = None
+        if op == 'Put':
+            with ns.Batch():
+                resp = ns.Put(req['key'], req.get('value'))
+        elif op == 'Delete':
+            with ns.Batch():
+                resp = ns.Delete(req['key'])
+        elif op == 'Get':
+            resp = ns.Get(req['key'])
+        elif op == 'List':
+            resp = []
+            for k, _ in ns:
+                resp.append(k)
+        else:
+            raise Exception("invalid kvop")
+        output.reply({'req': req, 'resp': resp})
 
     def handle_ping(self, request, output):
         logging.debug("served ping")
@@ -263,7 +460,7 @@ class KansasHandler(object):
 
     def handle_keepalive(self, req, output):
         logging.debug('keepalive from ' + str(output.stream));
-        self.streams[output.stream]['last_keepalive'] = time.time()
+        registry.touch(output.stream)
         output.reply('acked')
 
     def handle_sleep(self, request, output):
@@ -298,15 +495,16 @@ class KansasHandler(object):
         elif request['term'] == 'sleepsleepsleep':
             time.sleep(5)
         lim = request.get('limit')
+        cursor = request.get('cursor')
         if request.get('allow_inexact'):
             logging.info("Trying inexact match")
             stream, meta = datasource.Find(
-                request['datasource'], request['_RAW']['term'], exact=False,
-                limit=lim)
+                request['datasource'], request['term'], exact=False,
+                limit=lim, cursor=cursor)
         else:
             logging.info("Trying exact match")
             stream, meta = datasource.Find(
-                request['datasource'], request['_RAW']['term'], exact=True)
+                request['datasource'], request['term'], exact=True)
         if lim and len(stream) > lim:
             stream = stream[:lim]
             meta['has_more'] = True
@@ -315,25 +513,58 @@ class KansasHandler(object):
         else:
             num = 2
         meta['server_latency'] = time.time() - start
+        # Decks are only suggested with the first page of results.
+        if cursor:
+            decks = {}
+        else:
+            decks = datasource.SampleDeck(
+                request['datasource'], request['term'], num)
         output.reply({
             'stream': stream,
             'meta': meta,
-            'deck_suggestions': datasource.SampleDeck(
-                request['datasource'], request['_RAW']['term'], num),
-            'req': request['_RAW']})
+            'deck_suggestions': decks,
+            'req': request})
+
+    def handle_complete_name(self, request, output):
+        output.reply({
+            'names': datasource.CompleteName(
+                request['datasource'], request['term'],
+                request.get('limit')),
+            'req': request})
 
     def notify_closed(self, stream):
         """Callback for when a stream has been closed."""
         pass
 
+    def serve(self, reqtype, request, output):
+        """Serves a request away from its connection, replying with any
+           error since there is no read loop to do so."""
+        if reqtype not in self.handlers:
+            logging.warning("%s: Unexpected request type '%s'" % (self, reqtype))
+            metrics.Count('request.unexpected')
+            return
+        try:
+            with metrics.Timer('request.%s_ms' % reqtype):
+                self.handlers[reqtype](request, output)
+        except Exception, e:
+            logging.exception(e)
+            output.stream.send_message(
+               json.dumps({'type': 'error', 'msg': str(e)}),
+               binary=False)
+
     def transition(self, reqtype, request, output):
         """Returns the handler instance that should serve future requests."""
 
-        if reqtype in self.handlers:
+        if reqtype in self.background:
+            logging.debug("queueing %s", reqtype)
+            slowpool.submit(self.serve, reqtype, request, output)
+        elif reqtype in self.handlers:
             logging.debug("serving %s", reqtype)
-            self.handlers[reqtype](request, output)
+            with metrics.Timer('request.%s_ms' % reqtype):
+                self.handlers[reqtype](request, output)
         else:
             logging.warning("%s: Unexpected request type '%s'" % (self, reqtype))
+            metrics.Count('request.unexpected')
         
         # Transitions to the current state by default.
         return self
@@ -348,18 +579,12 @@ class KansasInitHandler(KansasHandler):
         self.handlers['set_scope'] = self.handle_set_scope
 
     def presence_count(self):
-        count = 0
-        with self._lock:
-            for handler in self.spaces.values():
-                count += handler.presence_count()
-        return count
+        return registry.count()
 
     def presence_breakdown(self):
-        stats = {}
         with self._lock:
-            for k, handler in self.spaces.iteritems():
-                stats[k] = handler.presence_breakdown()
-        return stats
+            spaces = self.spaces.items()
+        return dict((k, handler.presence_breakdown()) for k, handler in spaces)
 
     def handle_set_scope(self, request, output):
         scope = request['scope']
@@ -374,9 +599,13 @@ class KansasInitHandler(KansasHandler):
             if (scope, sourceid) not in self.spaces:
                 self.spaces[scope, sourceid] = KansasSpaceHandler(scope, sourceid)
 
+        encoding = wire.Negotiate(request.get('encodings'))
         output.reply({
-            'client_version_required': config.kClientVersion
+            'client_version_required': config.kClientVersion,
+            'encoding': encoding,
         })
+        # Takes effect after the reply, which is always sent as JSON.
+        wire.SetEncoding(output.stream, encoding)
 
     def transition(self, reqtype, request, output):
         if reqtype == 'set_scope':
@@ -389,7 +618,8 @@ class KansasInitHandler(KansasHandler):
 
 
 class KansasSpaceHandler(KansasHandler):
-    """The request handler created for Kansas scope."""
+    """The request handler created for Kansas scope. It only routes players
+       to games, whose state is left to the games' own actors."""
 
     MAX_GAMES = 5
 
@@ -399,120 +629,136 @@ class KansasSpaceHandler(KansasHandler):
         self.handlers['connect'] = self.handle_connect
         self.handlers['list_games'] = self.handle_list_games
         self.handlers['end_game'] = self.handle_end_game
+        self.handlers['kvop'] = self.handle_kvop
         self.subspaceKey = SubspaceKey(scope, sourceid)
+        self.ScopedClientDB = ClientDB.Subspace(self.subspaceKey)
         self.scope = scope
         self.games = {}
-        self.ScopedGames = Games.Subspace(self.subspaceKey)
-        for gameid, snapshot in self.ScopedGames:
-            logging.debug("Restoring %s as %s" % (gameid, str(snapshot)))
-            game = self.new_game(gameid)
-            game.restore(snapshot)
-            self.games[gameid] = game
-            
+        # Games deleted whose actors may not yet have erased them.
+        self.ending = {}
+        self.store = ScopedGameStore(self.subspaceKey)
+        # Persisted games not yet loaded, which are restored on first use.
+        self.summaries = self.store.Summaries()
 
     def handle_end_game(self, request, output):
         with self._lock:
-            self.games[request].terminate()
-        self.garbage_collect_games()
+            if request in self.games or request in self.summaries:
+                self.delete_game(request)
 
     def presence_count(self):
-        count = 0
-        with self._lock:
-            for handler in self.games.values():
-                count += handler.presence_count()
-        return count
+        return registry.count(self.subspaceKey)
 
     def presence_breakdown(self):
-        stats = {}
         with self._lock:
-            for k, handler in self.games.iteritems():
-                stats[k] = handler.presence_breakdown()
-        return stats
+            games = self.games.items()
+        return dict((k, handler.presence_breakdown()) for k, handler in games)
+
+    def ranked_games(self):
+        """Returns [(gameid, presence, last_used)] of loaded and unloaded
+           games, ordered from most to least recently used."""
+        with self._lock:
+            ranked = [(gameid, handler.presence_count(), handler.last_used)
+                      for gameid, handler in self.games.iteritems()]
+            ranked.extend((gameid, 0, summary['last_used'])
+                          for gameid, summary in self.summaries.iteritems())
+        ranked.sort(key=lambda (k, presence, last_used):
+                        (not presence, -last_used))
+        return ranked
 
     def handle_list_games(self, request, output):
         self.garbage_collect_games()
-        with self._lock:
-            resp = []
-            ranked = sorted(
-                self.games.items(),
-                key=lambda (k, v): (bool(not v.presence_count()), -v.last_used))
-            for gameid, handler in ranked:
-                orients = set()
-                for p in handler.presence_breakdown():
-                    orients.add(p['orient'])
-                resp.append({
-                    'gameid': gameid,
-                    'presence': handler.presence_count(),
-                    'orients': list(orients)})
-            output.reply(resp)
+        resp = []
+        for gameid, count, _ in self.ranked_games():
+            resp.append({
+                'gameid': gameid,
+                'presence': count,
+                'orients': registry.orients(self.subspaceKey, gameid)})
+        output.reply(resp)
 
     def garbage_collect_games(self):
-        if len(self.games) > self.MAX_GAMES:
-            ranked = sorted(
-                self.games.items(),
-                key=lambda (k, v): (bool(not v.presence_count()), -v.last_used))
-            while len(self.games) > self.MAX_GAMES:
-                victim_id, victim = ranked.pop()
-                self.delete_game(victim_id)
-        for gameid, game in self.games.items():
-            if game.terminated:
-                self.delete_game(gameid)
-    
-    def new_game(self, gameid):
-        logging.info("Creating new game '%s'", gameid)
-        game = KansasGameHandler(gameid, self.scope, self.sourceid)
-        self.games[gameid] = game
-        return game
+        with self._lock:
+            if len(self.games) + len(self.summaries) > self.MAX_GAMES:
+                for victim_id, _, _ in self.ranked_games()[self.MAX_GAMES:]:
+                    self.delete_game(victim_id)
+            for gameid, game in self.games.items():
+                if game.terminated:
+                    del self.games[gameid]
+            for gameid, game in self.ending.items():
+                if game.terminated:
+                    del self.ending[gameid]
+
+    def open_game(self, gameid):
+        """Returns the handler for gameid, creating it if needed. A persisted
+           game is restored by the handler's actor rather than here.
+
+           A game replacing an ended one shares its actor, so that the old
+           game is erased before the new one loads."""
+        with self._lock:
+            game = self.games.get(gameid)
+            # A game ended by its players stays here until collected.
+            if game is None or game.terminated:
+                if gameid in self.summaries:
+                    logging.info("Restoring game '%s'", gameid)
+                else:
+                    logging.info("Creating new game '%s'", gameid)
+                self.summaries.pop(gameid, None)
+                ended = self.ending.pop(gameid, game)
+                game = KansasGameHandler(
+                    gameid, self.scope, self.sourceid,
+                    ended and ended.actor)
+                game.actor.submit(game.load)
+                self.games[gameid] = game
+            return game
 
     def delete_game(self, gameid):
         logging.info("Deleting game '%s'", gameid)
-        self.games[gameid].terminate()
-        del self.games[gameid]
-
-    def handle_connect(self, request, output):
         with self._lock:
-            logging.info(request)
-            ipv4addr = (output.stream._request.connection
-                              .remote_addr[0].replace('::ffff:', ''))
-            presence = {
-                'uuid': request['uuid'],
-                'name': request['user'],
-                'profile_pic': request['profile'].get('image', {}).get('url'),
-                'profile_url': request['profile'].get(
-                    'url', 'http://freegeoip.net/?q=%s&map=1' % ipv4addr),
-                'orient': request['orient'],
-                'addr': ipv4addr,
-            }
-            if request['gameid'] in self.games:
-                logging.info("Joining existing game '%s'", request['gameid'])
-                game = self.games[request['gameid']]
+            if gameid in self.summaries:
+                del self.summaries[gameid]
+                self.store.Delete(gameid)
             else:
-                game = self.new_game(request['gameid'])
-                self.games[request['gameid']] = game
-                game.save()
-            game.add_stream(output.stream, presence)
-            game.notify_presence()
+                game = self.games.pop(gameid)
+                self.ending[gameid] = game
+                game.actor.submit(game.terminate)
 
-        # Atomically registers the player with the game handler.
-        with game._lock:
-            output.reply(game.snapshot())
-
-        with self._lock:
-            self.garbage_collect_games()
+    def handle_connect(self, request, output):
+        logging.info(request)
+        ipv4addr = (output.stream._request.connection
+                          .remote_addr[0].replace('::ffff:', ''))
+        presence = {
+            'uuid': request['uuid'],
+            'name': request['user'],
+            'profile_pic': request['profile'].get('image', {}).get('url'),
+            'profile_url': request['profile'].get(
+                'url', 'http://freegeoip.net/?q=%s&map=1' % ipv4addr),
+            'orient': request['orient'],
+            'addr': ipv4addr,
+        }
+        game = self.open_game(request['gameid'])
+        game.arriving.append(output.stream)
+        # Queued ahead of the player's later requests, which go to the game.
+        game.actor.submit(
+            game.join, output.stream, presence, request.get('seqno'), output)
+        self.garbage_collect_games()
+        return game
 
     def transition(self, reqtype, request, output):
         if reqtype == 'connect':
-            KansasHandler.transition(self, reqtype, request, output)
-            return self.games[request['gameid']]
+            with metrics.Timer('request.connect_ms'):
+                return self.handle_connect(request, output)
         else:
             return KansasHandler.transition(self, reqtype, request, output)
 
 
 class KansasGameHandler(KansasHandler):
     """There is single game handler for each game, shared among all players.
-       Enforces a global ordering on game-state update broadcasts."""
+       Enforces a global ordering on game-state update broadcasts.
 
-    def __init__(self, gameid, scope, sourceid):
+       The game is an actor: its requests, timers and callbacks all run on
+       self.actor one at a time, so its state needs no lock. Other threads
+       only read presence, last_used and terminated."""
+
+    def __init__(self, gameid, scope, sourceid, actor=None):
         KansasHandler.__init__(self)
         self._seqno = 1000
         self._state = KansasGameState(sourceid=sourceid)
@@ -525,226 +771,456 @@ class KansasGameHandler(KansasHandler):
         self.handlers['add'] = self.handle_add
         self.handlers['kvop'] = self.handle_kvop
         self.handlers['samplecards'] = self.handle_samplecards
+        self.handlers['resync'] = self.handle_resync
+        self.background.update(['add', 'samplecards'])
         self.ScopedClientDB = ClientDB.Subspace(self.subspaceKey)
-        self.ScopedGames = Games.Subspace(self.subspaceKey)
+        self.store = ScopedGameStore(self.subspaceKey)
         self.streams = {}
+        self.outboxes = {}
         self.sourceid = sourceid
         self.last_used = time.time()
+        self.last_checkpoint = self.last_used
+        self.ops_since_checkpoint = 0
+        self.checkpoint_requested = False
+        self.pending = []
+        self._flush_lock = threading.Lock()
+        # Held while writing to the store, which is erased on termination.
+        self._store_lock = threading.Lock()
+        # Recent state broadcasts, as (prev_seqno, seqno, type, data).
+        self.history = collections.deque(maxlen=config.kResyncWindow)
+        # Window in which bulkupdates and presence changes are merged.
+        self.coalesce_window = config.kCoalesceMillis / 1000.0
+        self.coalesced = collections.OrderedDict()
+        self.coalesced_cards = {}
+        self.coalesced_prev_seqno = None
+        # Presence changes not yet broadcast, by pid, with None for leaving.
+        self.presence_changes = collections.OrderedDict()
+        self.flush_timer = None
         self.terminated = False
+        # Presence of each stream, replaced rather than mutated.
+        self.presence = []
+        # Streams whose join() is queued, which count as present so that the
+        # game is not evicted before they arrive.
+        self.arriving = collections.deque()
+        self.actor = actor or workers.Serial(actorpool, gameid)
+
+    def transition(self, reqtype, request, output):
+        if reqtype in self.background:
+            return KansasHandler.transition(self, reqtype, request, output)
+        self.actor.submit(self.serve, reqtype, request, output)
+        return self
+
+    def load(self):
+        """Restores the game if it was saved, and otherwise saves it."""
+        saved = self.store.Load(self.gameid)
+        if saved is None:
+            self.save()
+        else:
+            self.restore(*saved)
+
+    def join(self, stream, presence_info, seqno, output):
+        """Registers a player and replies with what it needs to catch up."""
+        self.arriving.popleft()
+        self.add_stream(stream, presence_info)
+        output.reply(self.resume(seqno))
+        # Others are sent only the change, and the new player everyone.
+        self.broadcast(set([stream]), 'presence', self.presence)
+        self.notify_presence(presence_info['pid'], presence_info)
 
     def save(self):
-        logging.info("Saving snapshot of %s." % self.gameid)
-        self.ScopedGames.Put(self.gameid, self.snapshot())
+        """Schedules a full checkpoint of the game."""
+        self.checkpoint_requested = True
+        persister.mark_dirty(self)
+
+    def record(self, op, args):
+        """Journals an applied operation under the current seqno."""
+        self.pending.append((self._seqno, (op, args)))
+        self.ops_since_checkpoint += 1
+        persister.mark_dirty(self)
+
+    def flush(self):
+        """Writes operations buffered by record(), or a full checkpoint
+           instead every kCheckpointOps ops or kCheckpointSecs seconds.
+           Only the in-memory copy is made on the game's actor."""
+        with self._flush_lock:
+            taken = self.actor.call(self.take_pending)
+            if taken is None:
+                return
+            pending, checkpoint, summary = taken
+            with self._store_lock:
+                # The game may have been erased since the copy was taken.
+                if self.terminated:
+                    return
+                if checkpoint:
+                    logging.info("Saving snapshot of %s." % self.gameid)
+                    self.store.Checkpoint(self.gameid, checkpoint, summary)
+                elif pending:
+                    self.store.Append(self.gameid, pending, summary)
+
+    def take_pending(self):
+        """Returns (pending, checkpoint, summary) for flush() to write, or
+           None if the game has ended."""
+        if self.terminated:
+            return None
+        pending, self.pending = self.pending, []
+        checkpoint = None
+        if (self.checkpoint_requested
+                or self.ops_since_checkpoint >= config.kCheckpointOps
+                or time.time() - self.last_checkpoint
+                    >= config.kCheckpointSecs):
+            checkpoint = self.snapshot()
+            self.checkpoint_requested = False
+            self.last_checkpoint = time.time()
+            self.ops_since_checkpoint = 0
+        return pending, checkpoint, self.summary()
+
+    def summary(self):
+        """Returns the record used to list this game without loading it."""
+        return {
+            'last_used': self.last_used,
+            'num_cards': len(self._state.index),
+        }
+
+    def replay(self, journal):
+        """Reapplies operations journaled by record()."""
+        for seqno, (op, args) in journal:
+            if op == 'bulkmove':
+                for card, dest_type, dest_key, dest_orient in args:
+                    self._state.moveCard(
+                        card, dest_type, dest_key, dest_orient)
+            elif op == 'remove':
+                for card in args:
+                    if self._state.containsCard(card):
+                        self._state.remove_card(card)
+                self._state.gc()
+            elif op == 'add':
+                for added in args:
+                    self._state.restore_card(added)
+            else:
+                logging.warning("Skipping unknown journal op %s", op)
+            self._seqno = seqno
 
     def add_stream(self, stream, presence_info):
+        presence_info['pid'] = registry.add(
+            stream, self.subspaceKey, self.gameid, presence_info['orient'],
+            self.expire_stream)
         self.streams[stream] = presence_info
-        self.streams[stream]['last_keepalive'] = time.time()
+        self.presence = self.streams.values()
+        if stream not in self.outboxes:
+            self.outboxes[stream] = fanout.OutboxFor(
+                stream, config.kOutboxSize, self.notify_closed)
+
+    def remove_stream(self, stream, disconnect=False):
+        """Returns the presence id of the removed stream."""
+        registry.remove(stream)
+        presence_info = self.streams.pop(stream)
+        self.presence = self.streams.values()
+        outbox = self.outboxes.pop(stream, None)
+        if outbox:
+            outbox.close(disconnect)
+        return presence_info['pid']
 
     def handle_bulkmove(self, req, output):
-        with self._lock:
-            logging.info("Starting bulk move.")
-            updatebuffer = collections.defaultdict(list)
-            for move in req['moves']:
-                try:
-                    dest_t = move['dest_type']
-                    dest_k = move['dest_key']
-                    src_type, src_key, seqno = self.apply_move(move)
-                    updatebuffer[dest_t, dest_k].append({
-                        'move': move,
-                        'old_type': src_type,
-                        'old_key': src_key,
-                    })
-                except Exception, e:
-                    logging.exception(e);
-                    logging.warning("Ignoring bad move: " + str(move));
-            msg = []
-            for (dest_t, dest_k), updates in updatebuffer.iteritems():
-                msg.append({
-                    'dest_type': dest_t,
-                    'dest_key': dest_k,
-                    'updates': updates,
-                    'z_stack': self._state.data[dest_t][dest_k],
+        logging.info("Starting bulk move.")
+        updatebuffer = collections.defaultdict(list)
+        applied = []
+        prev_seqno = self._seqno
+        for move in req['moves']:
+            try:
+                dest_t = move['dest_type']
+                dest_k = move['dest_key']
+                src_type, src_key, seqno = self.apply_move(move)
+                updatebuffer[dest_t, dest_k].append({
+                    'move': move,
+                    'old_type': src_type,
+                    'old_key': src_key,
                 })
-            self.broadcast(set(self.streams.keys()), 'bulkupdate', msg)
-            self.save()
+                applied.append((
+                    move['card'], dest_t, dest_k, move['dest_orient']))
+            except Exception, e:
+                logging.exception(e);
+                logging.warning("Ignoring bad move: " + str(move));
+        msg = []
+        for (dest_t, dest_k), updates in updatebuffer.iteritems():
+            msg.append({
+                'dest_type': dest_t,
+                'dest_key': dest_k,
+                'updates': updates,
+                'z_stack': self._state.data[dest_t][dest_k].tolist(),
+            })
+        self.publish(prev_seqno, 'bulkupdate', msg)
+        if applied:
+            self.record('bulkmove', applied)
 
     def handle_broadcast(self, req, output):
-        with self._lock:
-            if req.get('include_self'):
-                exclude = set()
-            else:
-                exclude = {output.stream}
-            self.broadcast(
-                set(self.streams.keys()) - exclude,
-                'broadcast_message',
-                req)
+        if req.get('include_self'):
+            exclude = set()
+        else:
+            exclude = {output.stream}
+        self.broadcast(
+            set(self.streams.keys()) - exclude,
+            'broadcast_message',
+            req)
         output.reply("ok")
 
     def handle_remove(self, req, output):
-        with self._lock:
-            removed = set()
-            for card in req:
-                if self._state.containsCard(card):
-                    removed.add(card)
-                    self._state.remove_card(card)
-            self._state.gc()
-            self.broadcast(
-                set(self.streams.keys()),
-                'bulk_remove', list(removed))
-        self.save()
+        removed = set()
+        for card in req:
+            if self._state.containsCard(card):
+                removed.add(card)
+                self._state.remove_card(card)
+        self._state.gc()
+        prev_seqno = self._seqno
+        if removed:
+            self.nextseqno()
+            self.record('remove', list(removed))
+        self.publish(prev_seqno, 'bulk_remove', list(removed))
         output.reply("done")
 
     def handle_add(self, req, output):
-        with self._lock:
-            added = []
-            requestor = req['requestor']
-            for card in req['cards']:
-                new_id = self._state.add_card(card)
-                added.append({
-                    'id': new_id,
-                    'orient': self._state.data['orientations'][new_id],
-                    'url': self._state.data['urls'][new_id],
-                    'small_url': self._state.data['urls_small'][new_id],
-                    'pos': self._state.index[new_id],
-                })
-            self._state.initializeStacks()
-            self.broadcast(
-                set(self.streams.keys()),
-                'bulk_add', {
-                    'cards': added,
-                    'requestor': requestor,
-                })
-            self.save()
+        # Images are fetched on the worker pool, so that moves by other
+        # players are not held up by downloads, then placed by the actor.
+        fetched = [self._state.fetch_card(card) for card in req['cards']]
+        self.actor.submit(self.add_cards, req, fetched, output)
+
+    def add_cards(self, req, fetched, output):
+        added = []
+        requestor = req['requestor']
+        for card, found in zip(req['cards'], fetched):
+            new_id = self._state.add_card(card, found)
+            new_card = self._state.cards[new_id]
+            added.append({
+                'id': new_id,
+                'orient': new_card.orient,
+                'url': new_card.url,
+                'small_url': new_card.small_url,
+                'pos': self._state.index[new_id],
+            })
+        self._state.initializeStacks()
+        prev_seqno = self._seqno
+        if added:
+            self.nextseqno()
+            self.record('add', added)
+        self.publish(prev_seqno, 'bulk_add', {
+            'cards': added,
+            'requestor': requestor,
+        })
         output.reply("done")
 
     def handle_samplecards(self, req, output):
         output.reply(datasource.Sample(self.sourceid))
     
-    def handle_kvop(self, req, output):
-        op = req['op']
-        ns = self.ScopedClientDB.Subspace(req['namespace'])
-        resp = None
-        if op == 'Put':
-            resp = ns.Put(req['key'], req['_RAW']['value'])
-        elif op == 'Delete':
-            resp = ns.Delete(req['key'])
-        elif op == 'Get':
-            resp = ns.Get(req['key'])
-        elif op == 'List':
-            resp = []
-            for k, _ in ns:
-                resp.append(k)
-        else:
-            raise Exception("invalid kvop")
-        output.reply({'req': req, 'resp': resp})
-
     def snapshot(self):
-        with self._lock:
-            return dict(self._state.data), self._seqno
+        return self._state.export(), self._seqno
+
+    def view(self):
+        """Returns the snapshot in the format expected by clients."""
+        return self._state.view(), self._seqno, self._state.checksum
+
+    def resume(self, seqno=None):
+        """Returns what a client at seqno needs to catch up: the state
+           broadcasts it missed if they are all still in history, or else a
+           full snapshot as returned by view()."""
+        self.flush_coalesced()
+        if (seqno is not None and self.history
+                and self.history[0][0] <= seqno <= self._seqno):
+            return {
+                'deltas': [
+                    {'type': reqtype, 'data': data, 'seqno': s}
+                    for _, s, reqtype, data in self.history if s > seqno],
+                'seqno': self._seqno,
+                'checksum': self._state.checksum,
+            }
+        return self.view()
 
-    def restore(self, snapshot):
-        with self._lock:
-            self._state = KansasGameState(sourceid=self.sourceid, data=snapshot[0])
-            self._seqno = snapshot[1]
+    def handle_resync(self, req, output):
+        output.reply(self.resume((req or {}).get('seqno')))
+
+    def restore(self, snapshot, journal=()):
+        self._state = KansasGameState(sourceid=self.sourceid, data=snapshot[0])
+        self._seqno = snapshot[1]
+        self.replay(journal)
+        self.ops_since_checkpoint = len(journal)
 
     def handle_end(self, req, output):
         self.terminate()
     
     def terminate(self):
+        if self.terminated:
+            return
         logging.info("Terminating game.")
-        with self._lock:
+        persister.forget(self)
+        with self._store_lock:
+            self.store.Delete(self.gameid)
             self.terminated = True
-            self.ScopedGames.Delete(self.gameid)
-            msg = "This game has been ended."
-            for s in self.streams:
-                try:
-                    s.send_message(
-                       json.dumps({
-                            'type': 'redirect',
-                            'msg': msg,
-                            'url': "/",
-                       }),
-                       binary=False)
-                    s.close_connection(wait_response=False)
-                except Exception, e:
-                    logging.exception(e)
-            self.streams = {}
+        self.pending = []
+        if self.flush_timer is not None:
+            timers.cancel(self.flush_timer)
+        msg = "This game has been ended."
+        frame = fanout.Frame({
+            'type': 'redirect',
+            'msg': msg,
+            'url': "/",
+        }, map(wire.EncodingOf, self.outboxes))
+        for outbox in self.outboxes.values():
+            outbox.offer(frame)
+            outbox.close(disconnect=True)
+        for stream in self.streams:
+            registry.remove(stream)
+        self.streams = {}
+        self.presence = []
+        self.outboxes = {}
 
     def nextseqno(self):
-        with self._lock:
-            self._seqno += 1
-            return self._seqno
-
-    def broadcast(self, streamSet, reqtype, data):
+        self._seqno += 1
+        return self._seqno
+
+    def publish(self, prev_seqno, reqtype, data):
+        """Broadcasts a state change that advanced the game from prev_seqno,
+           keeping it in history for clients that later resume."""
+        if reqtype == 'bulkupdate' and self.coalesce_window:
+            self.coalesce(prev_seqno, data)
+            return
+        self.flush_coalesced()
+        if prev_seqno != self._seqno:
+            self.history.append((prev_seqno, self._seqno, reqtype, data))
+        self.broadcast(
+            set(self.streams.keys()), reqtype, data, seqno=self._seqno)
+
+    def coalesce(self, prev_seqno, stacks):
+        """Buffers the stack updates of a bulkupdate until the coalescing
+           window closes. Each card keeps only its latest update, under its
+           latest destination but with its original source."""
+        if self.coalesced_prev_seqno is None:
+            self.coalesced_prev_seqno = prev_seqno
+        for entry in stacks:
+            key = entry['dest_type'], entry['dest_key']
+            updates = self.coalesced.setdefault(key, [])
+            for update in entry['updates']:
+                card = update['move']['card']
+                if card in self.coalesced_cards:
+                    prev_key, prev_update = self.coalesced_cards[card]
+                    self.coalesced[prev_key].remove(prev_update)
+                    update = dict(
+                        update,
+                        old_type=prev_update['old_type'],
+                        old_key=prev_update['old_key'])
+                updates.append(update)
+                self.coalesced_cards[card] = key, update
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_timer is None:
+            self.flush_timer = timers.schedule(
+                self.coalesce_window, self.actor.submit, self.flush_coalesced)
+
+    def flush_coalesced(self):
+        """Broadcasts buffered updates, with the final z_stack of each
+           touched stack, followed by the latest presence if it changed."""
+        if self.flush_timer is not None:
+            timers.cancel(self.flush_timer)
+            self.flush_timer = None
+        if self.coalesced:
+            msg = []
+            for (dest_t, dest_k), updates in self.coalesced.iteritems():
+                stack = self._state.data[dest_t].get(dest_k)
+                if stack is None and not updates:
+                    continue
+                msg.append({
+                    'dest_type': dest_t,
+                    'dest_key': dest_k,
+                    'updates': updates,
+                    'z_stack': stack.tolist() if stack else [],
+                })
+            prev_seqno = self.coalesced_prev_seqno
+            self.coalesced = collections.OrderedDict()
+            self.coalesced_cards = {}
+            self.coalesced_prev_seqno = None
+            if prev_seqno != self._seqno:
+                self.history.append(
+                    (prev_seqno, self._seqno, 'bulkupdate', msg))
+            self.broadcast(
+                set(self.streams.keys()), 'bulkupdate', msg,
+                seqno=self._seqno)
+        if self.presence_changes:
+            changes = self.presence_changes
+            self.presence_changes = collections.OrderedDict()
+            self.broadcast_presence(changes)
+
+    def broadcast(self, streamSet, reqtype, data, seqno=None):
+        """Queues a message to each stream without blocking. The message is
+           encoded once for all recipients. Streams that fail are removed by
+           their outbox via notify_closed()."""
         logging.info("Broadcasting %s", reqtype)
         start = time.time()
         self.last_used = start
-        presence_changed = False
+        message = {'type': reqtype, 'data': data, 'time': start}
+        if seqno is not None:
+            message['seqno'] = seqno
+            message['checksum'] = self._state.checksum
+        frame = fanout.Frame(message, map(wire.EncodingOf, streamSet))
         for stream in streamSet:
-            try:
-                stream.send_message(
-                    json.dumps({
-                        'type': reqtype,
-                        'data': data,
-                        'time': time.time(),
-                    }),
-                    binary=False)
-            except Exception, e:
-                logging.exception(e)
-                logging.warning("Removing broken stream %s", stream)
-                presence_changed = True
-                del self.streams[stream]
-        logging.info("Broadcast took %.2fms" % (1000*(time.time() - start)))
-        if presence_changed:
-            self.notify_presence()
-
-    def gc_streams(self):
-        with self._lock:
-            for stream in self.streams.keys():
-                last = self.streams[stream]['last_keepalive']
-                if time.time() - last > 60:
-                    try:
-                        del self.streams[stream]
-                        stream.close_connection(wait_response=False)
-                    except Exception, e:
-                        logging.exception(e)
+            outbox = self.outboxes.get(stream)
+            if outbox is None:
+                continue
+            if not outbox.offer(frame):
+                logging.warning("Slow consumer %s must resync", stream)
+        elapsed = 1000 * (time.time() - start)
+        metrics.Record('broadcast_ms', elapsed)
+        metrics.Record('broadcast_fanout', len(streamSet))
+        logging.info("Broadcast took %.2fms" % elapsed)
 
     def presence_count(self):
-        with self._lock:
-            self.gc_streams()
-            return len(self.streams)
+        return (registry.count(self.subspaceKey, self.gameid)
+                + len(self.arriving))
 
     def presence_breakdown(self):
-        with self._lock:
-            self.gc_streams()
-            return self.streams.values()
+        return self.presence
 
-    def notify_presence(self):
-        with self._lock:
-            self.broadcast(
-                set(self.streams.keys()),
-                'presence',
-                self.streams.values())
+    def notify_presence(self, pid, presence_info):
+        """Broadcasts that player pid joined, or left if presence_info is
+           None. A join and leave merged in the same window cancel out."""
+        if not self.coalesce_window:
+            self.broadcast_presence({pid: presence_info})
+            return
+        if presence_info is None and self.presence_changes.get(pid):
+            del self.presence_changes[pid]
+        else:
+            self.presence_changes[pid] = presence_info
+        self.schedule_flush()
+
+    def broadcast_presence(self, changes):
+        self.broadcast(
+            set(self.streams.keys()),
+            'presence_delta',
+            {
+                'joined': [p for p in changes.itervalues() if p is not None],
+                'left': [pid for pid, p in changes.iteritems() if p is None],
+            })
 
     def notify_closed(self, stream):
-        with self._lock:
-            if stream in self.streams:
-                del self.streams[stream]
-                self.notify_presence()
-            else:
-                logging.warning("Stream already closed.")
+        self.actor.submit(self.drop_stream, stream)
+
+    def expire_stream(self, stream):
+        """Callback for a stream that has stopped sending keepalives."""
+        self.actor.submit(self.drop_stream, stream, True)
+
+    def drop_stream(self, stream, disconnect=False):
+        if stream in self.streams:
+            self.notify_presence(self.remove_stream(stream, disconnect), None)
+        else:
+            logging.warning("Stream already closed.")
 
     def apply_move(self, move):
         """Applies move and increments seqno, returning True on success."""
 
-        with self._lock:
-            card = move['card']
-            dest_type = move['dest_type']
-            dest_key = move['dest_key']
-            dest_orient = move['dest_orient']
-            src_type, src_key = self._state.moveCard(
-                card, dest_type, dest_key, dest_orient)
-            return src_type, src_key, self.nextseqno()
+        card = move['card']
+        dest_type = move['dest_type']
+        dest_key = move['dest_key']
+        dest_orient = move['dest_orient']
+        src_type, src_key = self._state.moveCard(
+            card, dest_type, dest_key, dest_orient)
+        return src_type, src_key, self.nextseqno()
 
 
 class BackgroundStats(threading.Thread):
@@ -763,31 +1239,164 @@ class BackgroundStats(threading.Thread):
                 old_count = count
                 self.logger.info("%d online users", count)
                 self.logger.info("presence: %s", self.target.presence_breakdown())
+            self.logger.info("metrics: %s", json.dumps(metrics.Snapshot()))
 
 
 initHandler = KansasInitHandler()
 stats = BackgroundStats(initHandler)
 stats.start()
+persister = gamestore.Persister(config.kFlushIntervalSecs)
+persister.start()
+atexit.register(persister.flush_all)
+registry = presence.Registry(config.kKeepaliveSecs, config.kPresenceTickSecs)
+registry.start()
+slowpool = workers.Pool(config.kWorkerThreads, config.kWorkerQueueSize)
+actorpool = workers.Pool(config.kActorThreads)
+# Closes the coalescing windows of every game.
+timers = workers.Timers(max(config.kCoalesceMillis, 1) / 1000.0)
+timers.start()
+metrics.Source('persister', persister.stats)
+metrics.Source('fanout', fanout.Stats)
+metrics.Source('workers', workers.Stats)
+metrics.Gauge('slowpool_depth', slowpool.depth)
+metrics.Gauge('actorpool_depth', actorpool.depth)
+metrics.Gauge('timers_pending', timers.depth)
+metrics.Gauge('presence', registry.count)
+metrics.Gauge('presence_expired', lambda: registry.expired)
+
+
+# Schemas of request data by type. Strings are escaped only where clients
+# render them or they are re-broadcast, and other fields are passed as sent.
+_Text = schema.Str(escape=True)
+_Key = schema.Scalar(escape=True)
+
+REQUESTS = {
+    'ping': schema.Any(),
+    'keepalive': schema.Any(),
+    'sleep': schema.Any(),
+    'list_games': schema.Any(),
+    'samplecards': schema.Any(),
+    'set_scope': schema.Dict({
+        'scope': schema.Maybe(_Text),
+        'datasource': schema.Maybe(schema.Str()),
+        'encodings': schema.Maybe(schema.List(schema.Str())),
+    }, optional=['encodings']),
+    'list_scope': schema.Dict({'scope': _Text, 'sourceid': _Text}),
+    'clone_scope': schema.Dict({'src': _Text, 'dest': _Text}),
+    'export_scope': schema.Dict({'scope': _Text}),
+    'import_scope': schema.Dict({
+        'scope': _Text,
+        'clear': schema.Bool(),
+        'entries': schema.List(schema.Dict({
+            'db': schema.OneOf(*SCOPE_DBS),
+            'sourceid': schema.OneOf(*datasource.AllSources()),
+            'key': schema.Str(),
+            'value': schema.Str(),
+        })),
+    }),
+    'query': schema.Dict({
+        'datasource': schema.Str(),
+        'term': schema.Str(),
+        'limit': schema.Maybe(schema.Int()),
+        'allow_inexact': schema.Maybe(schema.Bool()),
+        'tags': schema.Maybe(schema.Str()),
+        'cursor': schema.Maybe(schema.Str()),
+    }, optional=['limit', 'allow_inexact', 'tags', 'cursor']),
+    'complete_name': schema.Dict({
+        'datasource': schema.Str(),
+        'term': schema.Str(),
+        'limit': schema.Maybe(schema.Int()),
+    }, optional=['limit']),
+    'bulkquery': schema.Dict({
+        'terms': schema.List(schema.Tuple(schema.Number(), _Text)),
+    }),
+    'connect': schema.Dict({
+        'uuid': _Text,
+        'user': _Text,
+        'profile': schema.Dict({
+            'image': schema.Dict({'url': _Text}, optional=['url']),
+            'url': _Text,
+        }, optional=['image', 'url']),
+        'orient': _Key,
+        'gameid': _Key,
+        'seqno': schema.Maybe(schema.Int()),
+    }, optional=['seqno']),
+    'end_game': _Key,
+    'bulkmove': schema.Dict({
+        'moves': schema.List(schema.Dict({
+            'card': schema.Int(),
+            'dest_type': schema.OneOf('board', 'hands'),
+            'dest_key': _Key,
+            'dest_orient': schema.Int(),
+        })),
+    }),
+    'broadcast': schema.Escaped(),
+    'remove': schema.List(schema.Int()),
+    'add': schema.Dict({
+        'cards': schema.List(schema.Dict({
+            'loc': _Key,
+            'name': schema.Str(),
+            'tohand': schema.Maybe(schema.Bool()),
+        }, optional=['tohand'])),
+        'requestor': _Text,
+    }),
+    'kvop': schema.Dict({
+        'namespace': _Text,
+        'op': schema.OneOf('Put', 'Delete', 'Get', 'List'),
+        'key': _Text,
+        'value': schema.Any(),
+    }, optional=['key', 'value']),
+    'resync': schema.Maybe(schema.Dict({
+        'seqno': schema.Maybe(schema.Int()),
+    }, optional=['seqno'])),
+}
 
-
-def recursiveEscape(obj):
-    if type(obj) in [str, unicode]:
-        return cgi.escape(obj).replace('"', "'")
-    elif type(obj) is dict:
-        out = {}
-        for k, v in obj.items():
-            out[cgi.escape(k)] = recursiveEscape(v)
-        return out
-    elif type(obj) is list:
-        return [recursiveEscape(x) for x in obj]
-    else:
-        return obj
+# Requests of other types are escaped throughout.
+DEFAULT_REQUEST = schema.Escaped()
 
 
 def web_socket_do_extra_handshake(request):
     pass
 
 
+def handle_message(handler, stream, line):
+    """Serves one message from stream, returning the handler for the next."""
+
+    try:
+        req = json.loads(line)
+        logging.debug("Parsed json %s", req)
+        logging.debug("Handler %s", type(handler))
+        logging.debug("Request type %s", req['type'])
+        output = JSONOutput(stream, req['type'], req.get('future_id'))
+        data = REQUESTS.get(req['type'], DEFAULT_REQUEST)(req.get('data'))
+        return handler.transition(req['type'], data, output)
+    except schema.Invalid, e:
+        logging.warning("Rejected %s request: %s", req['type'], e)
+        stream.send_message(
+           json.dumps({
+                'type': 'error',
+                'msg': 'Invalid %s request: %s' % (req['type'], e),
+                'request': req['type'],
+                'field': e.path,
+           }),
+           binary=False)
+    except KansasRedirect, e:
+        logging.info("redirecting to: " + e.url)
+        stream.send_message(
+           json.dumps({
+                'type': 'redirect',
+                'msg': e.message,
+                'url': e.url,
+           }),
+           binary=False)
+    except Exception, e:
+        logging.exception(e)
+        stream.send_message(
+           json.dumps({'type': 'error', 'msg': str(e)}),
+           binary=False)
+    return handler
+
+
 def web_socket_transfer_data(request):
     """Drives the state machine for each connected client."""
 
@@ -798,36 +1407,8 @@ def web_socket_transfer_data(request):
             logging.info("Socket closed")
             currentHandler.notify_closed(request.ws_stream)
             return
-        try:
-            req = json.loads(line)
-            logging.debug("Parsed json %s", req)
-            logging.debug("Handler %s", type(currentHandler))
-            logging.debug("Request type %s", req['type'])
-            output = JSONOutput(
-                request.ws_stream,
-                req['type'],
-                req.get('future_id'))
-            data = recursiveEscape(req.get('data'))
-            if type(data) is dict:
-                data['_RAW'] = req.get('data')
-            currentHandler = currentHandler.transition(
-                req['type'],
-                data,
-                output)
-        except KansasRedirect, e:
-            logging.info("redirecting to: " + e.url)
-            request.ws_stream.send_message(
-               json.dumps({
-                    'type': 'redirect',
-                    'msg': e.message,
-                    'url': e.url,
-               }),
-               binary=False)
-        except Exception, e:
-            logging.exception(e)
-            request.ws_stream.send_message(
-               json.dumps({'type': 'error', 'msg': str(e)}),
-               binary=False)
+        currentHandler = handle_message(
+            currentHandler, request.ws_stream, line)
 
 
 # vim: ts=4 sw=4 et
@@ -1,9 +1,132 @@
-import kansas_wsh
+# Unit tests of the Kansas websocket handler.
+#
+# Usage: python -m unittest discover -p '*_test.py'
+
+from server import benchmark
+
+import unittest
+
+# Games are stored in a scratch database, as by the benchmarks.
+kansas_wsh = benchmark.setup()
+
 
 # TODO unit tests
 class TestJSONResponder: pass
 class TestKansasGameState: pass
 class TestKansasHandler: pass
 class TestKansasInitHandler: pass
-class TestKansasGameHandler: pass
 class TestSocketTransfer: pass
+
+
+def moves(game, cards, dest_key):
+    """Moves cards to the board stack dest_key on the game's actor."""
+    game.actor.call(game.handle_bulkmove, {'moves': [{
+        'card': card,
+        'dest_type': 'board',
+        'dest_key': dest_key,
+        'dest_orient': 1,
+    } for card in cards]}, None)
+
+
+class TestKansasGameHandler(unittest.TestCase):
+
+    def newGame(self, gameid):
+        game = benchmark.makeGame(kansas_wsh, 60, num_stacks=4)
+        game.gameid = gameid
+        game.actor.call(game.save)
+        game.flush()
+        return game
+
+    def reload(self, game):
+        loaded = kansas_wsh.KansasGameHandler(game.gameid, 'bench', 'pokerdb')
+        loaded.actor.call(loaded.load)
+        return loaded
+
+    def assertSameGame(self, loaded, game, stacks=()):
+        """Compares card positions, and the order of the given stacks. Other
+           stacks are shuffled when the checkpoint is restored."""
+        self.assertEqual(loaded.snapshot()[1], game.snapshot()[1])
+        self.assertEqual(loaded._state.index, game._state.index)
+        self.assertEqual(loaded._state.checksum, game._state.checksum)
+        for key in stacks:
+            self.assertEqual(loaded._state.data['board'][key].tolist(),
+                             game._state.data['board'][key].tolist())
+
+    def testJournalFollowsCheckpoint(self):
+        game = self.newGame('journal')
+        checkpoint = game.snapshot()[1]
+        moves(game, [0, 1, 2], 7)
+        moves(game, [3], 8)
+        game.flush()
+        # Each operation is journaled under the seqno it advanced to.
+        journal = game.store.Journal('journal', 0)
+        self.assertEqual([seqno for seqno, _ in journal],
+                         [checkpoint + 3, checkpoint + 4])
+        self.assertEqual(journal[-1][0], game.snapshot()[1])
+        self.assertSameGame(self.reload(game), game, [7, 8])
+
+    def testCheckpointTruncatesJournal(self):
+        game = self.newGame('truncate')
+        moves(game, range(10), 7)
+        game.flush()
+        game.actor.call(game.save)
+        game.flush()
+        self.assertEqual(game.store.Journal('truncate', 0), [])
+        moves(game, range(5), 8)
+        game.flush()
+        journal = game.store.Journal('truncate', 0)
+        checkpoint = game.store.Load('truncate')[0][1]
+        self.assertEqual([seqno for seqno, _ in journal], [checkpoint + 5])
+        loaded = self.reload(game)
+        self.assertSameGame(loaded, game, [8])
+        # Seqnos continue from the replayed journal.
+        moves(loaded, [20], 9)
+        self.assertEqual(loaded.snapshot()[1], game.snapshot()[1] + 1)
+
+    def testJournalOrderIsNumeric(self):
+        store = kansas_wsh.ScopedGameStore('bench::order')
+        store.Checkpoint('g', ({}, 998), {'last_used': 0})
+        store.Append('g', [(seqno, ('bulkmove', []))
+                           for seqno in [999, 1000, 1001]], {'last_used': 1})
+        self.assertEqual([seqno for seqno, _ in store.Journal('g', 998)],
+                         [999, 1000, 1001])
+        self.assertEqual([seqno for seqno, _ in store.Journal('g', 999)],
+                         [1000, 1001])
+
+
+class TestRequests(unittest.TestCase):
+
+    def check(self, reqtype, data):
+        return kansas_wsh.REQUESTS.get(
+            reqtype, kansas_wsh.DEFAULT_REQUEST)(data)
+
+    def testConnectEscapesWhatOthersSee(self):
+        req = self.check('connect', {
+            'uuid': 'u', 'user': '<img src=x>', 'orient': 1, 'gameid': 'g"',
+            'profile': {'url': 'http://x/"onload="', 'extra': 1},
+        })
+        self.assertEqual(req['user'], '&lt;img src=x&gt;')
+        self.assertEqual(req['gameid'], "g'")
+        self.assertEqual(req['profile'], {'url': "http://x/'onload='"})
+
+    def testQueryTermIsNotEscaped(self):
+        req = self.check('query', {'datasource': 'localdb', 'term': 'a & b'})
+        self.assertEqual(req['term'], 'a & b')
+
+    def testUnknownRequestsAreEscaped(self):
+        self.assertEqual(self.check('unknown', {'<': ['>']}),
+                         {'&lt;': ['&gt;']})
+
+    def testBadMoveIsRejected(self):
+        try:
+            self.check('bulkmove', {'moves': [{
+                'card': 1, 'dest_type': 'deck', 'dest_key': 1,
+                'dest_orient': 1,
+            }]})
+            self.fail()
+        except kansas_wsh.schema.Invalid, e:
+            self.assertEqual(e.path, 'moves[0].dest_type')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,395 @@
+# Load generator speaking the Kansas websocket protocol.
+#
+# Usage: python server/loadgen.py [options], e.g.
+#
+#   $ ./async_server.py 8000 &
+#   $ python server/loadgen.py --port 8000 --games 4 --players 3
+#
+# Simulates players who join games, keep alive, move cards and search at the
+# given rates, then prints throughput and latency percentiles as JSON in the
+# same format as benchmark.py, so that runs can be compared across changes.
+# Broadcast latency is measured from the server's timestamp on each update
+# to its receipt, so the server must share this machine's clock.
+
+import argparse
+import base64
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import metrics
+
+# Names that the pokerdb datasource can add.
+DECK = [rank + suit for rank in 'A 2 3 4 5 6 7 8 9 10 J Q K'.split()
+        for suit in 'CDHS']
+
+
+class Client(object):
+    """A blocking websocket client that sends and receives JSON messages."""
+
+    def __init__(self, host, port, path='/kansas'):
+        self.sock = socket.create_connection((host, port))
+        self._buf = ''
+        self._send_lock = threading.Lock()
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall(
+            'GET %s HTTP/1.1\r\n'
+            'Host: %s:%d\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: %s\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n' % (path, host, port, key))
+        while '\r\n\r\n' not in self._buf:
+            self._fill()
+        head, self._buf = self._buf.split('\r\n\r\n', 1)
+        if ' 101 ' not in head.split('\r\n')[0]:
+            raise IOError('Handshake failed: ' + head.split('\r\n')[0])
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        self._buf += data
+
+    def _read(self, n):
+        while len(self._buf) < n:
+            self._fill()
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def _send_frame(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | n)
+        elif n < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, n)
+        # Clients must mask, but a zero mask leaves the payload as is.
+        with self._send_lock:
+            self.sock.sendall(header + '\0\0\0\0' + payload)
+
+    def send(self, reqtype, data=None, future_id=None):
+        message = {'type': reqtype, 'data': data}
+        if future_id is not None:
+            message['future_id'] = future_id
+        self._send_frame(0x1, json.dumps(message))
+
+    def receive(self):
+        """Returns the next message, or None once the server has closed."""
+        fragments = []
+        while True:
+            try:
+                b0, b1 = struct.unpack('!BB', self._read(2))
+                n = b1 & 0x7f
+                if n == 126:
+                    n, = struct.unpack('!H', self._read(2))
+                elif n == 127:
+                    n, = struct.unpack('!Q', self._read(8))
+                payload = self._read(n)
+            except (EOFError, socket.error):
+                return None
+            opcode = b0 & 0xf
+            if opcode == 0x8:
+                return None
+            elif opcode == 0x9:
+                self._send_frame(0xa, payload)
+            elif opcode in (0x0, 0x1):
+                fragments.append(payload)
+                if b0 & 0x80:
+                    return json.loads(''.join(fragments))
+
+    def close(self):
+        try:
+            self._send_frame(0x8, struct.pack('!H', 1000))
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class Results(object):
+    """Measurements shared by all players."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys([
+            'moves_sent', 'queries_sent', 'updates_received',
+            'messages_received', 'errors', 'resyncs'], 0)
+        self.histograms = {
+            'broadcast_ms': metrics.Histogram(),
+            'query_ms': metrics.Histogram(),
+        }
+        # Measurements begin once every player has joined.
+        self.measuring = False
+
+    def count(self, name, n=1):
+        if self.measuring:
+            with self._lock:
+                self.counts[name] += n
+
+    def record(self, name, value):
+        if self.measuring:
+            with self._lock:
+                self.histograms[name].add(value)
+
+
+class Player(object):
+    """One simulated player, who reads on one thread and sends on another."""
+
+    def __init__(self, options, results, game, index):
+        self.options = options
+        self.results = results
+        self.game = game
+        self.index = index
+        self.cards = set()
+        self.queries = {}
+        self.joined = threading.Event()
+        self.closed = False
+        self.client = Client(options.host, options.port)
+
+    def join(self):
+        scope = '%s-%d' % (self.options.scope, self.game)
+        self.client.send('set_scope', {
+            'scope': scope,
+            'datasource': self.options.datasource,
+        })
+        name = 'load-%d-%d' % (self.game, self.index)
+        self.client.send('connect', {
+            'uuid': name,
+            'user': name,
+            'profile': {},
+            'orient': 1 if self.index % 2 else -1,
+            'gameid': 'loadgen',
+        })
+
+    def read(self):
+        while True:
+            message = self.client.receive()
+            if message is None:
+                self.closed = True
+                self.joined.set()
+                return
+            now = time.time()
+            self.results.count('messages_received')
+            reqtype = message['type']
+            if reqtype == 'connect_resp':
+                self.reset(message['data'][0])
+                self.joined.set()
+            elif reqtype == 'bulk_add':
+                self.cards.update(c['id'] for c in message['data']['cards'])
+            elif reqtype == 'bulkupdate':
+                self.results.count('updates_received')
+                self.results.record(
+                    'broadcast_ms', 1000 * (now - message['time']))
+            elif reqtype == 'query_resp':
+                sent = self.queries.pop(message.get('future_id'), None)
+                if sent is not None:
+                    self.results.record('query_ms', 1000 * (now - sent))
+            elif reqtype == 'resync_required':
+                self.results.count('resyncs')
+                self.client.send('resync', {})
+            elif reqtype == 'resync_resp':
+                self.reset(message['data'][0])
+            elif reqtype == 'error':
+                self.results.count('errors')
+
+    def reset(self, state):
+        """Learns the cards in a game from a snapshot of its state."""
+        self.cards = set()
+        for ns in ['board', 'hands']:
+            for stack in state[ns].values():
+                self.cards.update(stack)
+
+    def populate(self):
+        """Adds cards to the game if it has fewer than asked for."""
+        missing = self.options.cards - len(self.cards)
+        if missing > 0:
+            self.client.send('add', {
+                'requestor': 'loadgen',
+                'cards': [{'loc': i, 'name': DECK[i % len(DECK)]}
+                          for i in range(missing)],
+            })
+
+    def play(self, deadline):
+        """Sends moves, queries and keepalives at their rates until the
+           deadline, on a fixed schedule so that a slow server does not
+           lower the offered load."""
+        options = self.options
+        schedule = [[time.time(), 15.0, self.keepalive]]
+        for rate, fn in [(options.move_rate, self.move),
+                         (options.query_rate, self.query)]:
+            if rate:
+                # Players start out of phase, as they would in real games.
+                period = 1.0 / rate
+                schedule.append(
+                    [time.time() + random.random() * period, period, fn])
+        future_id = 0
+        while not self.closed:
+            event = min(schedule)
+            if event[0] >= deadline:
+                return
+            delay = event[0] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            future_id += 1
+            event[2](future_id)
+            event[0] += event[1]
+
+    def move(self, future_id):
+        if not self.cards:
+            return
+        cards = random.sample(
+            list(self.cards), min(self.options.batch, len(self.cards)))
+        self.client.send('bulkmove', {'moves': [{
+            'card': card,
+            'dest_type': 'board',
+            'dest_key': random.randrange(self.options.stacks),
+            'dest_orient': 1,
+        } for card in cards]})
+        self.results.count('moves_sent', len(cards))
+
+    def query(self, future_id):
+        self.queries[future_id] = time.time()
+        self.client.send('query', {
+            'datasource': self.options.datasource,
+            'term': random.choice(DECK),
+        }, future_id)
+        self.results.count('queries_sent')
+
+    def keepalive(self, future_id):
+        self.client.send('keepalive', None, future_id)
+
+
+def ServerStats(options):
+    """Returns the server's own histograms, from its stats request, or
+       those of each worker of a sharded server."""
+
+    client = Client(options.host, options.port)
+    try:
+        client.send('stats', None, 1)
+        while True:
+            message = client.receive()
+            if message is None:
+                return {}
+            if message['type'] == 'stats_resp':
+                data = message['data']
+                if 'shards' in data:
+                    return [shard['histograms'] for shard in data['shards']]
+                return data['histograms']
+    finally:
+        client.close()
+
+
+def Run(options):
+    """Runs one load test and returns its result record."""
+
+    results = Results()
+    players = [Player(options, results, game, index)
+               for game in range(options.games)
+               for index in range(options.players)]
+    for player in players:
+        reader = threading.Thread(target=player.read)
+        reader.setDaemon(True)
+        reader.start()
+        player.join()
+    for player in players:
+        player.joined.wait(options.timeout)
+    for player in players:
+        if player.index == 0:
+            player.populate()
+    # Waits for the added cards to reach every player.
+    start = time.time()
+    while time.time() - start < options.timeout:
+        if all(len(p.cards) >= options.cards for p in players):
+            break
+        time.sleep(0.05)
+
+    results.measuring = True
+    start = time.time()
+    deadline = start + options.seconds
+    senders = [threading.Thread(target=p.play, args=(deadline,))
+               for p in players]
+    for sender in senders:
+        sender.setDaemon(True)
+        sender.start()
+    for sender in senders:
+        sender.join()
+    # Allows in-flight updates to arrive before measuring stops.
+    time.sleep(0.5)
+    results.measuring = False
+    elapsed = time.time() - start
+
+    server = ServerStats(options) if options.server_stats else None
+    for player in players:
+        if player.index == 0 and not options.keep:
+            player.client.send('end')
+    for player in players:
+        player.client.close()
+
+    record = {
+        'name': 'loadgen',
+        'params': dict((k, v) for k, v in vars(options).items()
+                       if k not in ('host', 'port')),
+        'seconds': elapsed,
+        'disconnected': sum(p.closed for p in players),
+    }
+    record.update(results.counts)
+    record['moves_per_sec'] = results.counts['moves_sent'] / elapsed
+    record['updates_per_sec'] = results.counts['updates_received'] / elapsed
+    for name, histogram in results.histograms.items():
+        record[name] = histogram.summary()
+    if server is not None:
+        record['server'] = server
+    return record
+
+
+def ParseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Simulates Kansas players against a running server.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--scope', default='LOADGEN',
+                        help='prefix of the scope of each game')
+    parser.add_argument('--datasource', default='pokerdb')
+    parser.add_argument('--games', type=int, default=1)
+    parser.add_argument('--players', type=int, default=2,
+                        help='players in each game')
+    parser.add_argument('--cards', type=int, default=52,
+                        help='cards in each game')
+    parser.add_argument('--stacks', type=int, default=20,
+                        help='board positions that cards are moved between')
+    parser.add_argument('--move-rate', type=float, default=5.0,
+                        help='bulkmoves sent per second by each player')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='cards moved in each bulkmove')
+    parser.add_argument('--query-rate', type=float, default=0.0,
+                        help='queries sent per second by each player')
+    parser.add_argument('--seconds', type=float, default=10.0,
+                        help='duration of the measurement')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='time allowed for joining and adding cards')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the games rather than ending them')
+    parser.add_argument('--server-stats', action='store_true',
+                        help="include the server's latency histograms")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = ParseArgs(argv)
+    print json.dumps({'time': time.time(), 'results': [Run(options)]},
+                     indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+
+# vim: ts=4 sw=4 et
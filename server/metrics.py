@@ -0,0 +1,159 @@
+# Counters and latency histograms for the whole server.
+#
+# Values are recorded under flat names such as 'request.bulkmove_ms'.
+# Histograms count values in buckets spaced 10% apart, so that recording is
+# cheap and percentiles are accurate to within a bucket. Gauges and sources
+# are callbacks read only when a snapshot is taken, for values such as queue
+# depths that other modules already track.
+
+import bisect
+import collections
+import logging
+import threading
+import time
+
+# Bucket upper bounds, from 1us (or 0.001 of any other unit) to about 10^6.
+_BOUNDS = [0.001 * 1.1 ** i for i in range(218)]
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_histograms = {}
+_gauges = {}
+_sources = {}
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the pth percentile,
+           or the maximum if that is lower."""
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                if i < len(_BOUNDS):
+                    return min(_BOUNDS[i], self.max)
+                break
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / max(self.count, 1),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+def Count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+def Record(name, value):
+    """Adds value to the histogram called name."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(value)
+
+
+class Timer(object):
+    """Records the milliseconds spent in a with block under name."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        Record(self.name, 1000 * (time.time() - self.start))
+
+
+def Gauge(name, fn):
+    """Reports fn(), a number, under name in each snapshot."""
+    with _lock:
+        _gauges[name] = fn
+
+
+def Source(name, fn):
+    """Reports each key of fn(), a dict of numbers, as name.key."""
+    with _lock:
+        _sources[name] = fn
+
+
+def Snapshot():
+    """Returns all counters, histogram summaries and gauges, with the hit
+       rate of each pair of counters named *_hits and *_misses."""
+
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict((name, h.summary())
+                          for name, h in _histograms.iteritems())
+        gauges = _gauges.items()
+        sources = _sources.items()
+    values = {}
+    for name, fn in gauges:
+        try:
+            values[name] = fn()
+        except Exception, e:
+            logging.exception(e)
+    for prefix, fn in sources:
+        try:
+            for key, value in fn().iteritems():
+                values[prefix + '.' + key] = value
+        except Exception, e:
+            logging.exception(e)
+    for name in counters:
+        if name.endswith('_hits'):
+            prefix = name[:-len('_hits')]
+            total = counters[name] + counters.get(prefix + '_misses', 0)
+            values[prefix + '_hit_rate'] = float(counters[name]) / total
+    return {
+        'counters': counters,
+        'histograms': histograms,
+        'gauges': values,
+    }
+
+
+def Text():
+    """Returns a snapshot as sorted lines of 'name value'."""
+
+    snapshot = Snapshot()
+    lines = []
+    for name, value in snapshot['counters'].iteritems():
+        lines.append('%s %d' % (name, value))
+    for name, value in snapshot['gauges'].iteritems():
+        lines.append('%s %s' % (name, _Format(value)))
+    for name, summary in snapshot['histograms'].iteritems():
+        for key, value in summary.iteritems():
+            lines.append('%s.%s %s' % (name, key, _Format(value)))
+    lines.sort()
+    return '\n'.join(lines) + '\n'
+
+
+def _Format(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
+
+
+# vim: ts=4 sw=4 et
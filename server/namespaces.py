@@ -1,7 +1,10 @@
 # Implements simple persistence of namespaces via leveldb.
 
+import cPickle
+import cStringIO
 import leveldb
 import pickle
+import threading
 
 
 _databases = {}
@@ -22,6 +25,32 @@ def _GetMeta(dbPath):
     return _meta[dbPath]
 
 
+class BinaryPickle(object):
+    """Serializer using the most compact pickle protocol available."""
+
+    @staticmethod
+    def dumps(value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    loads = staticmethod(pickle.loads)
+
+
+def LoadBuiltins(data):
+    """Unpickles data that may come from clients, refusing any class or
+       function it names, so that only builtin types are loaded."""
+
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = None
+    return unpickler.load()
+
+
+_batches = threading.local()
+def _ActiveBatch(dbPath):
+    """Returns the batch currently entered by this thread for dbPath, if any."""
+
+    return getattr(_batches, 'active', {}).get(dbPath)
+
+
 def ListNamespaces(dbPath):
     """Lists all namespaces registered in the meta table."""
 
@@ -43,7 +72,9 @@ class Namespace(object):
         self.prefix = str(_prefix)
         if name != '__META__' and not _prefix:
             meta = _GetMeta(dbpath)
-            meta.Put(name, (name, version, str(serializer)))
+            entry = (name, version, str(serializer))
+            if meta.Get(name) != entry:
+                meta.Put(name, entry)
 
     def _key(self, key):
         if type(key) not in [unicode, str, int, float, long]:
@@ -65,11 +96,34 @@ class Namespace(object):
             self.serializer,
             self.prefix + '\0' + name)
 
+    def Batch(self, sync=True):
+        """Returns a Batch covering every namespace stored in this db."""
+        return Batch(self.dbpath, sync)
+
     def Put(self, key, value):
-        self.db.Put(self._key(key), self.serializer.dumps(value))
+        batch = _ActiveBatch(self.dbpath)
+        if batch:
+            batch.Put(self._key(key), self.serializer.dumps(value))
+        else:
+            self.db.Put(self._key(key), self.serializer.dumps(value))
 
     def Delete(self, key):
-        self.db.Delete(self._key(key))
+        batch = _ActiveBatch(self.dbpath)
+        if batch:
+            batch.Delete(self._key(key))
+        else:
+            self.db.Delete(self._key(key))
+
+    def Clear(self):
+        """Deletes every key in this namespace, including subspaces."""
+        with self.Batch():
+            for k in self.Keys():
+                self.Delete(k)
+
+    def Keys(self):
+        """Lists keys without deserializing their values."""
+        return [self._invkey(k) for k in self.db.RangeIter(
+            self._key('\x00'), self._key('\xff'), include_value=False)]
 
     def Get(self, key):
         try:
@@ -88,6 +142,55 @@ class Namespace(object):
             yield self._invkey(k), self.serializer.loads(v)
 
 
+class Batch(object):
+    """Groups writes to any number of namespaces sharing a LevelDB instance
+       into one atomic write.
+
+       While entered as a context manager, every Put/Delete made by the
+       current thread on a namespace of dbpath is buffered here, and the
+       whole batch is written when the outermost block exits cleanly.
+       Reads do not observe buffered writes. Nested batches on the same db
+       join the outer one."""
+
+    def __init__(self, dbpath, sync=True):
+        self.dbpath = dbpath
+        self.db = _GetDB(dbpath)
+        self.sync = sync
+        self.size = 0
+        self._batch = leveldb.WriteBatch()
+        self._outer = None
+
+    def Put(self, internal_key, serialized):
+        self.size += 1
+        self._batch.Put(internal_key, serialized)
+
+    def Delete(self, internal_key):
+        self.size += 1
+        self._batch.Delete(internal_key)
+
+    def Commit(self):
+        if self.size:
+            self.db.Write(self._batch, sync=self.sync)
+        self._batch = leveldb.WriteBatch()
+        self.size = 0
+
+    def __enter__(self):
+        if not hasattr(_batches, 'active'):
+            _batches.active = {}
+        self._outer = _batches.active.get(self.dbpath)
+        if self._outer is None:
+            _batches.active[self.dbpath] = self
+        return self._outer or self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._outer is not None:
+            self._outer = None
+            return
+        del _batches.active[self.dbpath]
+        if exc_type is None:
+            self.Commit()
+
+
 if __name__ == '__main__':
     path = '../db'
     print _GetDB(path).GetStats()
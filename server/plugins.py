@@ -1,9 +1,16 @@
 # Plugins for various board games compatible with Kansas.
 
+from server import metrics
+
+import base64
+import bisect
 import collections
 import csv
 import glob
+import heapq
+import json
 import logging
+import operator
 import os
 import random
 import re
@@ -11,6 +18,12 @@ import shlex
 import time
 import urllib2
 
+try:
+    import numpy
+    haveNumpy = True
+except ImportError:
+    haveNumpy = False
+
 
 kThemeBlacklist = { 'of', 'them', 'while', 'bad', 'size', 'share', 'combination', 'exactly', 'opponents', 'shuffles', 'attach', 'turned', 'lost', 'step', 'become', 'attacked', 'produces', 'shares', 'putting', 'second', 'storage', 'abilities', 'blockers', 'upkeep', 'evoke', 'rebound', 'players', 'already', 'tied', 'unpaired', 'unattached', 'deck', 'exchange', 'away', 'been', 'twice', 'returned', 'opening', 'text', 'once', 'leaves', 'leave', 'choice', 'stays', 'still', 'spent', 'returned', 'colorless', 'also', 'a', 'types', 'fewer', 'will', 'reveals', 'single', 'died', 'exchange' 'effect', 'nonbasic', 'word', 'words', 'kit', 'paid', 'random', 'sources', 'casts', 'the', 'in', 'remain', 'false', 'spend', 'total', 'move', 'played', 'entered', 'activated', 'greatest', 'affinity', 'instead', 'declare', 'which', 'attached', 'instead', 'play', 'increasing', 'does', 'assign', 'noncreature', 'unblocked', 'costs', 'kind', 'named', 'maximum', 'greatest', 'owner', 'take', 'remains', 'colors', 'common', 'rather', 'empty', 'there', 'untapped', 'form', 'source', 'flip', 'removed', 'both', 'nontoken', 'for', 'soon', 'much', 'nonwhite', 'nonblack', 'nonred', 'nonblue', 'nongreen', 'loss', 'after', 'before', 'same', 'could', 'begin', 'being', 'bottom', 'and', 'or', 'either', 'draws', 'lasts', 'comes', 'plays', 'change', 'instances', 'third', 'five', 'adds', 'since', 'targets', 'least', 'unattach', 'amount', 'game', 'they', 'one', 'pair', 'discarding', 'causes', 'convoke', 'cause', 'effects', 'back', 'most', 'enough', 'repeat', 'attackers', 'keeps', 'down', 'wins', 'blocks', 'regular', 'untaps', 'forces', 'chooses', 'many', 'enter', 'says', 'treated', 'name', 'call', 'every', 'must', 'though', 'cause', 'give' }
 
@@ -23,7 +36,10 @@ class DefaultPlugin(object):
     def Complete(self, cards):
         return []
 
-    def Fetch(self, name, exact, limit=None):
+    def CompleteName(self, prefix, limit):
+        return []
+
+    def Fetch(self, name, exact, limit=None, cursor=None):
         return []
 
     def Sample(self):
@@ -38,7 +54,7 @@ class PokerCardsPlugin(DefaultPlugin):
         cards, _ = self.Fetch("", False)
         return ["1 " + c['name'] for c in random.sample(cards, 5)]
 
-    def Fetch(self, name, exact, limit=None):
+    def Fetch(self, name, exact, limit=None, cursor=None):
         stream = []
         for card in glob.glob("../third_party/cards52/cropped/[A-Z0-9][A-Z0-9]*.png"):
             abbrev = card.split("/")[-1].split(".")[0]
@@ -138,8 +154,10 @@ class MagicCard(object):
             'Forest': 'G',
         }
         self.basicLands = ['Plains', 'Mountain', 'Island', 'Swamp', 'Forest']
+        # Deck generation asks for the colors of many cards, many times.
+        self._colors = frozenset(self._findColors())
 
-    def colors(self):
+    def _findColors(self):
         text_colors = set([c for c in 'WRBGU' if '{%s}' %c \
             if '{%s}' %c in self.text])
 
@@ -149,6 +167,9 @@ class MagicCard(object):
 
         return set(self.mana).union(text_colors).intersection(set('WRBGU'))
 
+    def colors(self):
+        return self._colors
+
     def __repr__(self):
         return str((self.name, self.type, self.mana, self.cost))
 
@@ -388,6 +409,7 @@ class CardCatalog(object):
             theme = tuple(theme)
             random.seed(hash(theme) + i)
             output[key] = self.makeThemedDeck(theme)
+        metrics.Record('deck_gen_ms', 1000*(time.time() - start))
         logging.info("Deck gen took %.2fms", 1000*(time.time() - start))
         return output
 
@@ -440,6 +462,372 @@ class CardCatalog(object):
         self.byCost[card.cost].append(card)
 
 
+class SearchIndex(object):
+    """Finds the cards whose search text may contain a term, or whose cost
+       is in a range, without scanning them all.
+
+       Cards are numbered in the order they are given, and have an entry
+       for each of their search tokens. A term matches the tokens it is a
+       substring of, which are found through the trigrams of the tokens."""
+
+    def __init__(self, titles, cards):
+        self.titles = titles
+        self.cards = cards
+        self.size = len(cards)
+        self.ids = dict((title, i) for i, title in enumerate(titles))
+        # Cards in order of cost, which sorts cards without one first.
+        costed = sorted((card.cost, i) for i, card in enumerate(cards) if card)
+        self.costs = [cost for cost, _ in costed]
+        self.byCost = [i for _, i in costed]
+        self.byToken = collections.defaultdict(list)
+        # Tokens of names and types, which are also search tokens.
+        self.byNameToken = collections.defaultdict(list)
+        for i, card in enumerate(cards):
+            if card:
+                for token in card.searchtokens:
+                    self.byToken[token].append(i)
+                for token in set(titles[i].split() + card.searchtype.split()):
+                    self.byNameToken[token].append(i)
+        self.byTrigram = collections.defaultdict(set)
+        for token in self.byToken:
+            for j in range(len(token) - 2):
+                self.byTrigram[token[j:j+3]].add(token)
+        self.columns = CardColumns(self) if haveNumpy else None
+
+    def tokensContaining(self, word):
+        if len(word) < 3:
+            return [t for t in self.byToken if word in t]
+        trigrams = sorted([self.byTrigram.get(word[j:j+3], ())
+                           for j in range(len(word) - 2)], key=len)
+        return [t for t in trigrams[0] if word in t]
+
+    def matching(self, term):
+        """Returns the set of cards whose search text may contain term, or
+           None if that may be any card."""
+        found = None
+        # Each word of a phrase lies within a token of any text containing it.
+        for word in term.split():
+            cards = set()
+            for token in self.tokensContaining(word):
+                cards.update(self.byToken[token])
+            if found is None:
+                found = cards
+            else:
+                found &= cards
+        return found
+
+    def termMatches(self, term, within=None):
+        """Returns the sets of cards, among within if given, having term in
+           their name or type, as a search token, and in their search text."""
+        if term.split() == [term]:
+            inName, inText = set(), set()
+            for token in self.tokensContaining(term):
+                inName.update(self.byNameToken.get(token, ()))
+                inText.update(self.byToken[token])
+            inTokens = set(self.byToken.get(term, ()))
+            if within is not None:
+                inName &= within
+                inTokens &= within
+                inText &= within
+            return inName, inTokens, inText
+        # Phrases may span tokens, so are looked for in each card.
+        found = self.matching(term)
+        if found is None:
+            found = within if within is not None else xrange(self.size)
+        elif within is not None:
+            found &= within
+        inName, inTokens, inText = set(), set(), set()
+        for i in found:
+            card = self.cards[i]
+            if not card:
+                continue
+            if term in self.titles[i] or term in card.searchtype:
+                inName.add(i)
+            if term in card.searchtokens:
+                inTokens.add(i)
+            if term in card.searchtext:
+                inText.add(i)
+        return inName, inTokens, inText
+
+    def withCost(self, predicates):
+        """Returns the set of cards whose cost satisfies every (op, value)
+           predicate, which each select a range of costs."""
+        lo, hi = 0, len(self.costs)
+        for op, val in predicates:
+            if op in ('==', '>='):
+                lo = max(lo, bisect.bisect_left(self.costs, val))
+            elif op == '>':
+                lo = max(lo, bisect.bisect_right(self.costs, val))
+            if op in ('==', '<='):
+                hi = min(hi, bisect.bisect_right(self.costs, val))
+            elif op == '<':
+                hi = min(hi, bisect.bisect_left(self.costs, val))
+        return set(self.byCost[lo:hi])
+
+
+class CardColumns(object):
+    """The cards of a SearchIndex as NumPy columns, so that queries can be
+       ranked over all of them at once. Token membership is kept sparse,
+       as the array of cards having each token."""
+
+    OPS = {
+        '==': operator.eq,
+        '>': operator.gt,
+        '>=': operator.ge,
+        '<': operator.lt,
+        '<=': operator.le,
+    }
+
+    def __init__(self, index):
+        self.index = index
+        cards = index.cards
+        self.hasCard = numpy.array([bool(card) for card in cards], dtype=bool)
+        # No cost compares below any, as None does.
+        self.cost = numpy.array(
+            [card.cost if card and card.cost is not None else -numpy.inf
+             for card in cards], dtype=float)
+        self.quality = numpy.array(
+            [0.5 if card and card.goodQuality else 0.0 for card in cards])
+        self.byToken = dict(
+            (token, numpy.array(ids, dtype=numpy.int32))
+            for token, ids in index.byToken.iteritems())
+        self.byNameToken = dict(
+            (token, numpy.array(ids, dtype=numpy.int32))
+            for token, ids in index.byNameToken.iteritems())
+
+    def withCost(self, predicates):
+        """Returns whether each card's cost satisfies every predicate."""
+        ok = self.hasCard.copy()
+        for op, val in predicates:
+            ok &= self.OPS[op](self.cost, val)
+        return ok
+
+    def termMatches(self, term):
+        """Returns the cards having term in their name or type, as a search
+           token, and in their search text, as arrays of ids."""
+        if term.split() == [term]:
+            tokens = self.index.tokensContaining(term)
+            return (
+                _Concat([self.byNameToken[t] for t in tokens
+                         if t in self.byNameToken]),
+                self.byToken.get(term, _Concat([])),
+                _Concat([self.byToken[t] for t in tokens]))
+        return [numpy.fromiter(found, dtype=numpy.int32, count=len(found))
+                for found in self.index.termMatches(term)]
+
+
+def _Concat(arrays):
+    if not arrays:
+        return numpy.zeros(0, dtype=numpy.int32)
+    return numpy.concatenate(arrays)
+
+
+# Cost expressions, which become predicates rather than search terms.
+kRangeExpr = re.compile("(\d+)\s*(to|-)\s*(\d+)\s*(mana|cost|cmc)")
+kManaExpr = re.compile("(mana|cost|cmc)\s*(>|<|>=|<=|=|==|)\s*(\d+)")
+kManaExpr2 = re.compile("(\d+)\s*(mana|cost|cmc)")
+
+kMana = {'red', 'blue', 'white', 'black', 'green'}
+kOtherMana = {'dual', 'mono', 'multi', 'colored', 'colorless', 'single', 'two', 'three', 'tri', 'quad', 'four', 'five', 'all', 'rainbow'}
+
+
+def expand(parts):
+    """Splits query words into text terms and mana= terms."""
+    core = []
+    out = []
+    num_mana = 0
+    num_other_mana = 0
+    for p in parts:
+        if p in kMana:
+            num_mana += 1
+        if p in kOtherMana:
+            num_other_mana += 1
+        if p in kMana or p in kOtherMana or p == 'x':
+            out.append('mana=' + p)
+        else:
+            core.append(p)
+    if num_other_mana == 0:
+        if num_mana == 1:
+            out.append('mana=mono')
+        elif num_mana == 2:
+            out.append('mana=dual')
+        elif num_mana == 3:
+            out.append('mana=tri')
+        elif num_mana == 4:
+            out.append('mana=quad')
+        elif num_mana == 5:
+            out.append('mana=all')
+    return core, out
+
+
+class QueryPlan(object):
+    """An inexact query compiled against a SearchIndex, and the ranks of
+       the cards it matches, from which pages of results are taken.
+
+       Cards that may rank, having passed the cost predicates, get a mask
+       of the terms they match: for term k, bit 3k if it is in the card's
+       name or type, 3k+1 if it is one of its tokens and 3k+2 if it is in
+       its search text. A card's rank from its terms depends only on that
+       mask."""
+
+    # Masks of more terms do not fit in the 64 bits of a NumPy column.
+    MAX_COLUMN_TERMS = 21
+
+    def __init__(self, needle, index):
+        self.predicates = []
+        for match in kRangeExpr.finditer(needle):
+            lo, hi = int(match.group(1)), int(match.group(3))
+            if lo > hi:
+                lo, hi = hi, lo
+            logging.info("Using predicate: cost in [%d, %d]" % (lo, hi))
+            self.predicates.extend([('>=', lo), ('<=', hi)])
+        needle = kRangeExpr.sub('', needle)
+        for match in kManaExpr.finditer(needle):
+            op, val = match.group(2), int(match.group(3))
+            if op == '=' or op == '':
+                op = '=='
+            logging.info("Using predicate: cost %s %d" % (op, val))
+            self.predicates.append((op, val))
+        needle = kManaExpr.sub('', needle)
+        for match in kManaExpr2.finditer(needle):
+            op, val = '==', int(match.group(1))
+            logging.info("Using predicate: cost %s %d" % (op, val))
+            self.predicates.append((op, val))
+        needle = kManaExpr2.sub('', needle)
+        self.needle = needle
+        try:
+            parts = shlex.split(needle)
+        except ValueError:
+            parts = needle.split()
+        self.parts, self.expanded = expand(parts)
+        logging.info("Expanded query: " + str(self.parts) + " " + str(self.expanded))
+        self.terms = self.parts + self.expanded
+        self.ranks = {}
+        self.order = None
+        named = index.ids.get(needle)
+        if index.columns is not None and \
+                len(self.terms) <= self.MAX_COLUMN_TERMS:
+            self.rankColumns(index.columns, named)
+        else:
+            self.rankCards(index, named)
+
+    def rankCards(self, index, named):
+        masks = {}
+        passing = None
+        if self.predicates:
+            passing = index.withCost(self.predicates)
+        for k, term in enumerate(self.terms):
+            for bit, found in enumerate(index.termMatches(term, passing)):
+                bit = 1 << 3 * k + bit
+                for i in found:
+                    masks[i] = masks.get(i, 0) | bit
+
+        # Only cards matching some term can rank, except that every card
+        # passing the cost predicates does, and the card named by the query.
+        candidates = set(masks) if passing is None else passing
+        if named is not None and (passing is None or not index.cards[named]):
+            candidates.add(named)
+        # (-rank, id) of each card ranked, so that ties keep catalog order.
+        self.scored = []
+        for i in candidates:
+            card = index.cards[i]
+            rank = 0.0
+            if card and passing is not None:
+                rank += 1
+            if i == named:
+                rank += 20
+            if card:
+                if card.goodQuality:
+                    rank += 0.5
+                rank += self.termRank(masks.get(i, 0))
+            if rank >= 1:
+                self.scored.append((-rank, i))
+        self.columns = None
+
+    def rankColumns(self, columns, named):
+        """Ranks every card at once, as rankCards() ranks each card."""
+        masks = numpy.zeros(len(columns.quality), dtype=numpy.int64)
+        for k, term in enumerate(self.terms):
+            for bit, found in enumerate(columns.termMatches(term)):
+                masks[found] |= 1 << 3 * k + bit
+        masks, inverse = numpy.unique(masks, return_inverse=True)
+        ranks = numpy.array(map(self.termRank, masks.tolist()), dtype=float)
+        ranks = ranks[inverse] + columns.quality
+        if self.predicates:
+            passing = columns.withCost(self.predicates)
+            ranks += 1
+            ranks[~passing] = 0
+        if named is not None and \
+                (not self.predicates or not columns.hasCard[named]):
+            ranks[named] += 20
+        ids = numpy.flatnonzero(ranks >= 1)
+        self.columns = ids, ranks[ids]
+
+    def top(self, k=None):
+        """Returns the ids of the k best ranked cards, or all in order."""
+        if self.columns is None:
+            if k is None:
+                return [i for _, i in sorted(self.scored)]
+            return [i for _, i in heapq.nsmallest(k, self.scored)]
+        ids, ranks = self.columns
+        if k is not None and k < len(ids):
+            # Cards ranked at least as well as the kth, ties included.
+            kth = numpy.partition(-ranks, k - 1)[k - 1]
+            best = numpy.flatnonzero(-ranks <= kth)
+            ids, ranks = ids[best], ranks[best]
+        return ids[numpy.lexsort((ids, -ranks))][:k].tolist()
+
+    def page(self, offset, limit=None):
+        """Returns the ids of the cards ranked from offset, up to limit of
+           them, and whether more follow."""
+        if offset == 0 and limit is not None:
+            top = self.top(limit + 1)
+            return top[:limit], len(top) > limit
+        # Later pages are taken from all the results, sorted once.
+        if self.order is None:
+            self.order = self.top()
+        end = len(self.order) if limit is None else offset + limit
+        return self.order[offset:end], end < len(self.order)
+
+    def termRank(self, mask):
+        rank = self.ranks.get(mask)
+        if rank is None:
+            rank = 0
+            has = 0
+            for k, term in enumerate(self.terms):
+                bits = mask >> 3 * k
+                rank += (bits & 1) + (bits >> 1 & 1)
+                if bits & 4:
+                    if ' ' in term:
+                        rank += len(term.split())
+                    else:
+                        rank += 1
+                    if k < len(self.parts):
+                        has += 1
+            rank += 3 * has
+            self.ranks[mask] = rank
+        return rank
+
+
+def encodeCursor(query, offset):
+    """Returns an opaque token for the results of query from offset."""
+    return base64.urlsafe_b64encode(json.dumps([query, offset]))
+
+
+def decodeCursor(cursor, query):
+    """Returns the offset a cursor from encodeCursor() resumes query at."""
+    if not cursor:
+        return 0
+    try:
+        cursor_query, offset = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    # A cursor for another query starts this one over.
+    if cursor_query != query:
+        return 0
+    return offset
+
+
 Catalog = None
 def initCatalog():
     global Catalog
@@ -448,24 +836,60 @@ def initCatalog():
 
 class LocalDBPlugin(DefaultPlugin):
     DB_PATH = '../localdb'
+    # Plans of popular queries may hold most of the catalog.
+    PLAN_CACHE_SIZE = 32
 
     def __init__(self):
         initCatalog()
         self.catalog = {}
         self.index = {}
         self.fullnames = {}
-        if not os.path.isdir(self.DB_PATH):
-            return
-        for f in os.listdir(self.DB_PATH):
-            name = f.replace('_', '/').replace('.jpg', '')
-            key = sanitize(name).lower()
-            self.catalog[key] = urllib2.quote(os.path.join(self.DB_PATH, f))
-            self.fullnames[key] = sanitize(name)
-            self.index[key] = name
+        self.plans = {}
+        if os.path.isdir(self.DB_PATH):
+            for f in os.listdir(self.DB_PATH):
+                name = f.replace('_', '/').replace('.jpg', '')
+                key = sanitize(name).lower()
+                self.catalog[key] = urllib2.quote(os.path.join(self.DB_PATH, f))
+                self.fullnames[key] = sanitize(name)
+                self.index[key] = name
+        # Cards are scored in catalog order, so that ties rank as they did.
+        self.titles = list(self.catalog)
+        self.cards = [Catalog.bySlug.get(title) for title in self.titles]
+        self.searchIndex = SearchIndex(self.titles, self.cards)
+        # Names, and the rest of each name from each later word, for
+        # completing prefixes with bisect.
+        self.names = sorted(self.titles)
+        self.wordStarts = sorted(
+            (title[m.start():], title) for title in self.titles
+            for m in re.finditer(r'\w+', title) if m.start() > 0)
 
     def Complete(self, cards):
         return Catalog.complete(cards)
 
+    def CompleteName(self, prefix, limit):
+        """Returns up to limit names starting with prefix, then names with
+           a later word starting with it."""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        found = []
+        i = bisect.bisect_left(self.names, prefix)
+        while i < len(self.names) and len(found) < limit \
+                and self.names[i].startswith(prefix):
+            found.append(self.names[i])
+            i += 1
+        seen = set(found)
+        i = bisect.bisect_left(self.wordStarts, (prefix,))
+        while i < len(self.wordStarts) and len(found) < limit:
+            rest, title = self.wordStarts[i]
+            if not rest.startswith(prefix):
+                break
+            if title not in seen:
+                seen.add(title)
+                found.append(title)
+            i += 1
+        return [self.fullnames[name] for name in found]
+
     def Sample(self):
         return Catalog.makeDeck()
 
@@ -475,13 +899,25 @@ class LocalDBPlugin(DefaultPlugin):
     def GetBackUrl(self):
         return '/third_party/images/mtg_detail.jpg'
 
-    def Fetch(self, name, exact, limit=None):
+    def compileQuery(self, needle):
+        """Returns the plan of an inexact query, compiled once for each
+           query until the cache fills up and is emptied."""
+        plan = self.plans.get(needle)
+        if plan is None:
+            plan = QueryPlan(needle, self.searchIndex)
+            if len(self.plans) >= self.PLAN_CACHE_SIZE:
+                self.plans.clear()
+            self.plans[needle] = plan
+        return plan
+
+    def Fetch(self, name, exact, limit=None, cursor=None):
         start = time.time()
         stream, meta = [], {}
         if name == '':
             return stream, meta
         name = name.strip()
         needle = str(name.lower())
+        more = None
         if exact:
             if needle in self.catalog:
                 card = Catalog.byName.get(name)
@@ -494,131 +930,25 @@ class LocalDBPlugin(DefaultPlugin):
                     'type': card_type,
                 })
         else:
-            range_expr = "(\d+)\s*(to|-)\s*(\d+)\s*(mana|cost|cmc)"
-            mana_expr = "(mana|cost|cmc)\s*(>|<|>=|<=|=|==|)\s*(\d+)"
-            mana_expr2 = "(\d+)\s*(mana|cost|cmc)"
-            predicates = []
-            def add_pred(op, val):
-                if op == '==':
-                    predicates.append(lambda c: c.cost == val)
-                elif op == '>':
-                    predicates.append(lambda c: c.cost > val)
-                elif op == '>=':
-                    predicates.append(lambda c: c.cost >= val)
-                elif op == '<':
-                    predicates.append(lambda c: c.cost < val)
-                elif op == '<=':
-                    predicates.append(lambda c: c.cost <= val)
-                else:
-                    assert False, op
-            for match in re.finditer(range_expr, needle):
-                needle = re.sub(range_expr, '', needle)
-                lo, hi = int(match.group(1)), int(match.group(3))
-                if lo > hi:
-                    lo, hi = hi, lo
-                logging.info("Using predicate: cost in [%d, %d]" % (lo, hi))
-                add_pred(">=", lo)
-                add_pred("<=", hi)
-            for match in re.finditer(mana_expr, needle):
-                needle = re.sub(mana_expr, '', needle)
-                op, val = match.group(2), int(match.group(3))
-                if op == '=' or op == '':
-                    op = '=='
-                logging.info("Using predicate: cost %s %d" % (op, val))
-                add_pred(op, val)
-            for match in re.finditer(mana_expr2, needle):
-                needle = re.sub(mana_expr2, '', needle)
-                op, val = '==', int(match.group(1))
-                logging.info("Using predicate: cost %s %d" % (op, val))
-                add_pred(op, val)
-            mana = {'red', 'blue', 'white', 'black', 'green'}
-            other_mana = {'dual', 'mono', 'multi', 'colored', 'colorless', 'single', 'two', 'three', 'tri', 'quad', 'four', 'five', 'all', 'rainbow'}
-            def expand(parts):
-                core = []
-                out = []
-                num_mana = 0
-                num_other_mana = 0
-                for p in parts:
-                    if p in mana:
-                        num_mana += 1
-                    if p in other_mana:
-                        num_other_mana += 1
-                    if p in mana or p in other_mana or p == 'x':
-                        out.append('mana=' + p)
-                    else:
-                        core.append(p)
-                if num_other_mana == 0:
-                    if num_mana == 1:
-                        out.append('mana=mono')
-                    elif num_mana == 2:
-                        out.append('mana=dual')
-                    elif num_mana == 3:
-                        out.append('mana=tri')
-                    elif num_mana == 4:
-                        out.append('mana=quad')
-                    elif num_mana == 5:
-                        out.append('mana=all')
-                return core, out
-            ct = 0
-            ranked = collections.defaultdict(list)
-            try:
-                parts = shlex.split(needle)
-            except ValueError:
-                parts = needle.split()
-            parts, expanded = expand(parts)
-            logging.info("Expanded query: " + str(parts) + " " + str(expanded))
-            for title, url in self.catalog.iteritems():
-                card = Catalog.bySlug.get(title)
-                rank = 0.0
-                if card and predicates:
-                    if all([ok(card) for ok in predicates]):
-                        rank += 1
-                    else:
-                        continue
-                if needle == title:
-                    rank += 20
-                def rankit(p, has):
-                    rank = 0
-                    if p in title or p in card.searchtype:
-                        rank += 1
-                    if p in card.searchtokens:
-                        rank += 1
-                    if p in card.searchtext:
-                        if ' ' in p:
-                            rank += len(p.split())
-                        else:
-                            rank += 1
-                    else:
-                        has[0] -= 1
-                    return rank
-                if card:
-                    if card.goodQuality:
-                        rank += 0.5
-                    has_bonus = [len(parts)]
-                    for p in parts:
-                        rank += rankit(p, has_bonus)
-                    rank += 3 * has_bonus[0]
-                    for p in expanded:
-                        rank += rankit(p, has_bonus)
-                if rank >= 1:
-                    ranked[rank].append(title)
-            ranks = sorted(ranked.keys(), reverse=True)
-            for r in ranks:
-                for title in ranked[r]:
-                    stream.append({
-                        'name': self.fullnames[title],
-                        'img_url': self.catalog[title],
-                        'info_url': self.catalog[title],
-                    })
-                    ct += 1
-                    if ct >= limit:
-                        break
-                if ct >= limit:
-                    break
+            offset = decodeCursor(cursor, needle)
+            plan = self.compileQuery(needle)
+            ids, has_more = plan.page(offset, limit)
+            for i in ids:
+                title = self.titles[i]
+                stream.append({
+                    'name': self.fullnames[title],
+                    'img_url': self.catalog[title],
+                    'info_url': self.catalog[title],
+                })
+            if has_more:
+                more = encodeCursor(needle, offset + len(ids))
+            needle = plan.needle
         meta = {
-            'has_more': False,
+            'has_more': more is not None,
             'more_url': "",
+            'cursor': more,
         }
+        metrics.Record('search_ms', 1000*(time.time() - start))
         logging.info("search for '%s' took %.2f ms", needle,
                      1000*(time.time() - start))
         return stream, meta
@@ -635,7 +965,7 @@ class MagicCardsInfoPlugin(DefaultPlugin):
     def SampleDeck(self, term, num_decks):
         return Catalog.makeDecks(term, num_decks)
 
-    def Fetch(self, name, exact, limit):
+    def Fetch(self, name, exact, limit, cursor=None):
         if name == '':
             return [], {}
 
@@ -0,0 +1,117 @@
+# Unit tests of card search in the localdb plugin.
+
+from server import benchmark
+from server import plugins
+
+import copy
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+# Cards with an image but no metadata, which have no cost.
+UNLISTED = ['Nameless Relic', 'Plains Walker']
+
+
+def makePlugin():
+    """Returns a LocalDBPlugin over the benchmark catalog, in which the
+       cards of UNLISTED have images only."""
+    root = tempfile.mkdtemp(prefix='kansas-test-')
+    cwd = os.getcwd()
+    try:
+        for d in ['run', 'localdb']:
+            os.makedirs(os.path.join(root, d))
+        benchmark.makeCatalog(root, num_cards=1000)
+        for name in UNLISTED:
+            open(os.path.join(root, 'localdb', name + '.jpg'), 'w').close()
+        os.chdir(os.path.join(root, 'run'))
+        return plugins.LocalDBPlugin()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+
+class TestQueryPlan(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.catalog = plugins.Catalog
+        cls.plugin = makePlugin()
+        cls.index = cls.plugin.searchIndex
+        # The same index, ranked a card at a time.
+        cls.cardIndex = copy.copy(cls.index)
+        cls.cardIndex.columns = None
+
+    @classmethod
+    def tearDownClass(cls):
+        plugins.Catalog = cls.catalog
+
+    def words(self, n):
+        """Returns n words of card text, which are each a search term."""
+        words = sorted(t for t in self.index.byToken
+                       if re.match('^[a-z]{4,}$', t)
+                       and t not in plugins.kMana
+                       and t not in plugins.kOtherMana)
+        return words[:n]
+
+    def queries(self):
+        titles = self.plugin.titles
+        costed = [t for t, card in zip(titles, self.plugin.cards)
+                  if card and card.cost]
+        return benchmark.QUERIES + [
+            '',
+            'land',
+            'cost<=1 land',
+            '0 to 2 cost',
+            'cost>=0',
+            'nameless',
+            # Named cards, with and without cost predicates, including
+            # those without a cost or metadata.
+            costed[0],
+            'cost<=9' + costed[1],
+            'plains',
+            'cost<=9plains',
+            'nameless relic',
+            'cost<=9nameless relic',
+            'cost>=1plains walker',
+            '"%s"' % ' '.join(costed[2].split()[:2]),
+            ' '.join(self.words(21)),
+            ' '.join(self.words(22)),
+            ' '.join(self.words(19)) + ' red green',
+        ]
+
+    def testLongQueriesAreRankedByCard(self):
+        plan = plugins.QueryPlan(' '.join(self.words(22)), self.index)
+        self.assertEqual(len(plan.terms), 22)
+        self.assertIs(plan.columns, None)
+
+    @unittest.skipUnless(plugins.haveNumpy, 'needs NumPy')
+    def testColumnsRankAsCards(self):
+        for query in self.queries():
+            columns = plugins.QueryPlan(query, self.index)
+            cards = plugins.QueryPlan(query, self.cardIndex)
+            if len(columns.terms) <= plugins.QueryPlan.MAX_COLUMN_TERMS:
+                self.assertIsNot(columns.columns, None, query)
+            self.assertIs(cards.columns, None, query)
+            self.assertEqual(columns.top(), cards.top(), query)
+            for k in [1, 10, 100]:
+                self.assertEqual(columns.top(k), cards.top(k), query)
+            for offset, limit in [(0, 10), (10, 10), (0, None), (5, None)]:
+                self.assertEqual(columns.page(offset, limit),
+                                 cards.page(offset, limit), query)
+
+    def testRanking(self):
+        plan = plugins.QueryPlan('nameless relic', self.cardIndex)
+        self.assertEqual(plan.top(1), [self.index.ids['nameless relic']])
+        plan = plugins.QueryPlan('cost<=9plains', self.cardIndex)
+        self.assertEqual(plan.top(1), [self.index.ids['plains']])
+        # No cost compares below any, so fails lower bounds even if named.
+        plan = plugins.QueryPlan('cost>=1plains walker', self.cardIndex)
+        self.assertNotIn(self.index.ids['plains walker'], plan.top())
+        self.assertTrue(all(self.plugin.cards[i].cost >= 1
+                            for i in plan.top()))
+
+
+if __name__ == '__main__':
+    unittest.main()
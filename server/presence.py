@@ -0,0 +1,164 @@
+# Tracks which players are connected to which games.
+#
+# Each player's stream is registered with the game and scope it joined, and
+# must be refreshed by keepalives. Deadlines are kept in a timer wheel, so
+# that expiring stale streams costs time proportional to the streams that
+# expire rather than to all those connected, and counts are kept per game
+# and per scope so that reading them never scans streams.
+
+import collections
+import itertools
+import logging
+import threading
+import time
+
+
+class TimerWheel(object):
+    """Deadlines bucketed into num_slots slots of slot_secs each.
+
+       A deadline further away than the wheel spans is checked again each
+       time the wheel comes around to its slot, until it is due."""
+
+    def __init__(self, slot_secs, num_slots, now):
+        self.slot_secs = slot_secs
+        self._slots = [set() for i in range(num_slots)]
+        self._deadlines = {}
+        self._tick = self._slotOf(now)
+
+    def _slotOf(self, t):
+        return int(t // self.slot_secs)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline):
+        """Sets the deadline of key, replacing any earlier one."""
+        self.cancel(key)
+        # Deadlines already past are expired by the next advance().
+        tick = max(self._slotOf(deadline), self._tick)
+        self._slots[tick % len(self._slots)].add(key)
+        self._deadlines[key] = deadline, tick
+
+    def cancel(self, key):
+        entry = self._deadlines.pop(key, None)
+        if entry:
+            self._slots[entry[1] % len(self._slots)].discard(key)
+
+    def advance(self, now):
+        """Returns the keys whose deadlines are at or before now."""
+        expired = []
+        end = self._slotOf(now)
+        # Visiting each slot once is enough, however long since the last call.
+        self._tick = max(self._tick, end - len(self._slots) + 1)
+        while True:
+            slot = self._slots[self._tick % len(self._slots)]
+            for key in list(slot):
+                if self._deadlines[key][0] <= now:
+                    slot.discard(key)
+                    del self._deadlines[key]
+                    expired.append(key)
+            if self._tick >= end:
+                return expired
+            self._tick += 1
+
+
+class Registry(threading.Thread):
+    """The players present in every game, by stream.
+
+       Games add() streams as players join and remove() them as they leave.
+       A stream that is not touch()ed within timeout seconds is passed to
+       the on_expire callback it was added with, from this thread."""
+
+    def __init__(self, timeout, slot_secs):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._wheel = TimerWheel(
+            slot_secs, int(timeout / slot_secs) + 2, time.time())
+        # stream -> (scope, gameid, orient, pid, on_expire)
+        self._streams = {}
+        self._games = collections.Counter()
+        self._scopes = collections.Counter()
+        self._orients = collections.defaultdict(collections.Counter)
+        self._pids = itertools.count(1)
+        self.expired = 0
+
+    def add(self, stream, scope, gameid, orient, on_expire):
+        """Registers stream in a game, returning its presence id, which
+           identifies the player in presence updates."""
+        with self._lock:
+            self._remove(stream)
+            pid = next(self._pids)
+            self._streams[stream] = scope, gameid, orient, pid, on_expire
+            self._games[scope, gameid] += 1
+            self._scopes[scope] += 1
+            self._orients[scope, gameid][orient] += 1
+            self._wheel.schedule(stream, time.time() + self.timeout)
+            return pid
+
+    def remove(self, stream):
+        with self._lock:
+            self._remove(stream)
+
+    def _remove(self, stream):
+        entry = self._streams.pop(stream, None)
+        if entry is None:
+            return
+        scope, gameid, orient, _, _ = entry
+        self._wheel.cancel(stream)
+        _Decrement(self._games, (scope, gameid))
+        _Decrement(self._scopes, scope)
+        orients = self._orients[scope, gameid]
+        _Decrement(orients, orient)
+        if not orients:
+            del self._orients[scope, gameid]
+
+    def touch(self, stream):
+        """Postpones the expiry of stream, if it is registered."""
+        with self._lock:
+            if stream in self._streams:
+                self._wheel.schedule(stream, time.time() + self.timeout)
+
+    def count(self, scope=None, gameid=None):
+        """Returns the number of players in a game, a scope, or overall."""
+        with self._lock:
+            if gameid is not None:
+                return self._games[scope, gameid]
+            elif scope is not None:
+                return self._scopes[scope]
+            return len(self._streams)
+
+    def orients(self, scope, gameid):
+        """Returns the orientations of the players in a game."""
+        with self._lock:
+            return self._orients.get((scope, gameid), {}).keys()
+
+    def expire(self, now):
+        """Unregisters streams past their deadline, notifying their games."""
+        with self._lock:
+            expired = []
+            for stream in self._wheel.advance(now):
+                expired.append((stream, self._streams[stream][4]))
+                self._remove(stream)
+            self.expired += len(expired)
+        for stream, on_expire in expired:
+            logging.info("Keepalive expired for %s", stream)
+            try:
+                on_expire(stream)
+            except Exception, e:
+                logging.exception(e)
+
+    def run(self):
+        while True:
+            time.sleep(self._wheel.slot_secs)
+            self.expire(time.time())
+
+
+def _Decrement(counter, key):
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,564 @@
+# Routes websocket clients to the worker process that owns their game.
+#
+# One process can use only one core, so games are sharded over worker
+# processes by a hash of (scope, sourceid, gameid). Each worker is an
+# ordinary async server with its own database, listening on its own port.
+# The router is the websocket handler of a front end process: it relays each
+# client's messages to the worker of its scope until the client connects to
+# a game, then to the worker owning that game. Requests about every game,
+# such as list_games, are sent to all workers and their replies merged.
+# Saved decks belong to the scope rather than a game, so kvop requests are
+# always sent to the worker of the scope, and end_game to that of the game.
+# A client that falls behind is not read for, so that workers buffer its
+# broadcasts, and ask it to resync as they would a slow direct client.
+
+from server import asyncserver
+from server import config
+from server import metrics
+from server import wire
+
+import asyncore
+import base64
+import collections
+import functools
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+# Ports of the workers, by shard.
+_ports = []
+
+
+def ShardOf(scope, sourceid, gameid=''):
+    """Returns the shard owning a game, or the default shard of a scope."""
+    key = json.dumps([scope or 'DEFAULT', sourceid, gameid])
+    return (zlib.crc32(key) & 0xffffffff) % len(_ports)
+
+
+class Upstream(asyncore.dispatcher):
+    """A websocket connection from the router to a worker, driven by the
+       router's loop. Messages may be sent from any thread, and received
+       messages are passed to on_message(payload, binary) on the loop."""
+
+    def __init__(self, loop, port, on_message, on_close, client_addr=None):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.port = port
+        self.on_message = on_message
+        self.on_close = on_close
+        # Returns True while messages should not be read, if set.
+        self.throttle = None
+        # Replies to replayed set_scope requests, which are not relayed.
+        self.skip = 0
+        self._inbuf = ''
+        headers = ''
+        if client_addr:
+            # Workers log and locate the client rather than the router.
+            headers = 'X-Forwarded-For: %s\r\n' % client_addr
+        self._out = collections.deque([
+            'GET /kansas HTTP/1.1\r\n'
+            'Host: localhost:%d\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: %s\r\n'
+            'Sec-WebSocket-Version: 13\r\n%s\r\n'
+            % (port, base64.b64encode(os.urandom(16)), headers)])
+        self._out_lock = threading.RLock()
+        self._upgraded = False
+        self._closed = False
+        self._fragments = []
+        self._fragment_op = None
+        loop.call_soon_threadsafe(self._open)
+
+    def _open(self):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(('127.0.0.1', self.port))
+
+    def send_message(self, message, binary=False):
+        if type(message) is unicode:
+            message = message.encode('utf-8')
+        self._send_frame(
+            asyncserver.OP_BINARY if binary else asyncserver.OP_TEXT, message)
+
+    def _send_frame(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | n)
+        elif n < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, n)
+        # Clients must mask their frames.
+        mask = os.urandom(4)
+        frame = header + mask + asyncserver._Unmask(payload, mask)
+        with self._out_lock:
+            if self._closed:
+                return
+            self._out.append(frame)
+        self.loop.call_soon_threadsafe(self._flush)
+
+    def disconnect(self):
+        self.loop.call_soon_threadsafe(self.handle_close)
+
+    # Loop thread only.
+
+    def _flush(self):
+        if self.connected and not self._closed and self._out:
+            self.handle_write()
+
+    def readable(self):
+        return not (self.throttle and self.throttle())
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        with self._out_lock:
+            while self._out:
+                data = self._out[0]
+                sent = self.send(data)
+                if sent < len(data):
+                    self._out[0] = data[sent:]
+                    return
+                self._out.popleft()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self._inbuf += data
+        if not self._upgraded:
+            end = self._inbuf.find('\r\n\r\n')
+            if end < 0:
+                return
+            status = self._inbuf[:self._inbuf.find('\r\n')]
+            if ' 101 ' not in status:
+                logging.warning("Worker on port %d refused: %s",
+                                self.port, status)
+                self.handle_close()
+                return
+            self._inbuf = self._inbuf[end + 4:]
+            self._upgraded = True
+        while not self._closed and self._read_frame():
+            pass
+
+    def _read_frame(self):
+        """Consumes one unmasked frame from the input, returning False if
+           it is incomplete."""
+
+        buf = self._inbuf
+        if len(buf) < 2:
+            return False
+        b0, b1 = ord(buf[0]), ord(buf[1])
+        length = b1 & 0x7f
+        pos = 2
+        if length == 126:
+            if len(buf) < 4:
+                return False
+            length, = struct.unpack('!H', buf[2:4])
+            pos = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return False
+            length, = struct.unpack('!Q', buf[2:10])
+            pos = 10
+        if len(buf) < pos + length:
+            return False
+        payload = buf[pos:pos + length]
+        self._inbuf = buf[pos + length:]
+        opcode = b0 & 0x0f
+        if opcode == asyncserver.OP_CLOSE:
+            self.handle_close()
+        elif opcode == asyncserver.OP_PING:
+            self._send_frame(asyncserver.OP_PONG, payload)
+        elif opcode in (asyncserver.OP_TEXT, asyncserver.OP_BINARY,
+                        asyncserver.OP_CONTINUATION):
+            if opcode != asyncserver.OP_CONTINUATION:
+                self._fragment_op = opcode
+                self._fragments = []
+            self._fragments.append(payload)
+            if b0 & 0x80:
+                message = ''.join(self._fragments)
+                binary = self._fragment_op == asyncserver.OP_BINARY
+                self._fragments = []
+                self.on_message(message, binary)
+        return True
+
+    def handle_close(self):
+        with self._out_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.close()
+        self.on_close()
+
+    def handle_error(self):
+        logging.exception("Error relaying to worker on port %d", self.port)
+        self.handle_close()
+
+
+class RouterInit(object):
+    """The handler of a new client, which is given its own Route."""
+
+    def transition(self, reqtype, request, line, stream):
+        metrics.Count('router.connections')
+        route = Route(stream)
+        return route.transition(reqtype, request, line, stream)
+
+    def notify_closed(self, stream):
+        pass
+
+
+class Route(object):
+    """The upstream connections of one client, and which of them serves it.
+
+       Upstreams are kept until the client leaves, so that replies to
+       requests sent before a switch are still relayed."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.loop = stream._conn.loop
+        self.upstreams = {}
+        self.current = None
+        self.scope = None, None
+        # The client's set_scope request, replayed to each new upstream.
+        self.set_scope = None
+        self._lock = threading.Lock()
+
+    def transition(self, reqtype, request, line, stream):
+        data = request.get('data')
+        if reqtype == 'set_scope':
+            self.scope = data.get('scope'), data.get('datasource')
+            self.set_scope = None
+            self.switch(ShardOf(*self.scope))
+            self.set_scope = line
+        elif reqtype == 'connect':
+            self.switch(ShardOf(self.scope[0], self.scope[1], data['gameid']))
+        elif reqtype == 'kvop':
+            self.upstream(ShardOf(*self.scope)).send_message(line)
+            return self
+        elif reqtype == 'clone_scope':
+            CloneScope(self, data['src'], data['dest'])
+            return self
+        elif reqtype == 'end_game':
+            self.upstream(ShardOf(self.scope[0], self.scope[1], data)) \
+                .send_message(line)
+            return self
+        elif reqtype in MERGES:
+            Aggregate(self, reqtype, Everywhere(data), functools.partial(
+                self.merge, reqtype, request.get('future_id')))
+            return self
+        elif self.current is None:
+            self.switch(0)
+        self.upstreams[self.current].send_message(line)
+        return self
+
+    def switch(self, shard):
+        """Makes shard serve the client, connecting to it if needed."""
+        self.upstream(shard)
+        with self._lock:
+            self.current = shard
+
+    def upstream(self, shard):
+        """Returns the connection to shard, connecting to it if needed."""
+        with self._lock:
+            upstream = self.upstreams.get(shard)
+            if upstream:
+                return upstream
+            upstream = Upstream(self.loop, _ports[shard], None, None,
+                                self.stream._conn.addr[0])
+            upstream.on_message = functools.partial(self.relay, upstream)
+            upstream.on_close = functools.partial(self.closed, shard)
+            upstream.throttle = self.behind
+            self.upstreams[shard] = upstream
+        if self.set_scope:
+            upstream.skip += 1
+            upstream.send_message(self.set_scope)
+        return upstream
+
+    def behind(self):
+        """Returns whether the client has fallen behind, in which case its
+           upstreams are not read. Workers then buffer its messages, and
+           ask it to resync if their outboxes overflow."""
+        return self.stream.pending() >= config.kOutboxSize
+
+    def relay(self, upstream, message, binary):
+        # Replies to set_scope are always sent as JSON.
+        if not binary and '"set_scope_resp"' in message:
+            resp = json.loads(message)
+            if resp['type'] == 'set_scope_resp':
+                if upstream.skip:
+                    upstream.skip -= 1
+                    return
+                # Replies made by the router use the negotiated encoding.
+                wire.SetEncoding(self.stream, resp['data']['encoding'])
+        try:
+            self.stream.send_message(message, binary=binary)
+        except asyncserver.ConnectionClosed:
+            pass
+
+    def closed(self, shard):
+        with self._lock:
+            self.upstreams.pop(shard, None)
+            current = shard == self.current
+        if current:
+            logging.info("Worker %d closed %s", shard, self.stream)
+            self.stream.close_connection()
+
+    def reply(self, reqtype, data, future_id):
+        payload, binary = wire.Encode({
+            'type': reqtype + '_resp',
+            'data': data,
+            'time': time.time(),
+            'future_id': future_id,
+        }, wire.EncodingOf(self.stream))
+        try:
+            self.stream.send_message(payload, binary=binary)
+        except asyncserver.ConnectionClosed:
+            pass
+
+    def merge(self, reqtype, future_id, replies, errors):
+        self.reply(reqtype, MERGES[reqtype](replies), future_id)
+
+    def error(self, msg):
+        try:
+            self.stream.send_message(
+                json.dumps({'type': 'error', 'msg': msg}), binary=False)
+        except asyncserver.ConnectionClosed:
+            pass
+
+    def notify_closed(self, stream):
+        with self._lock:
+            upstreams = self.upstreams.values()
+        for upstream in upstreams:
+            upstream.disconnect()
+
+
+class Aggregate(object):
+    """Sends requests to every worker on a connection of its own, and calls
+       on_done(replies, errors) once all workers have answered. Requests
+       maps each shard to the data of the requests it is sent."""
+
+    def __init__(self, route, reqtype, requests, on_done):
+        self.reqtype = reqtype
+        self.on_done = on_done
+        self.start = time.time()
+        self.replies = []
+        self.errors = []
+        self.upstreams = {}
+        self._lock = threading.Lock()
+        # Replies are parsed here, so are requested as JSON.
+        prologue = []
+        if route.set_scope:
+            set_scope = json.loads(route.set_scope)
+            set_scope['data'].pop('encodings', None)
+            prologue.append(json.dumps(set_scope))
+        for shard, port in enumerate(_ports):
+            upstream = Upstream(
+                route.loop, port,
+                functools.partial(self.receive, shard),
+                functools.partial(self.closed, shard))
+            self.upstreams[shard] = upstream
+        for shard, upstream in self.upstreams.items():
+            messages = prologue + [
+                json.dumps({'type': reqtype, 'data': data})
+                for data in requests[shard]]
+            # Marks the end of the replies, as failed requests have none.
+            messages.append(json.dumps({'type': 'ping'}))
+            for message in messages:
+                upstream.send_message(message)
+
+    def receive(self, shard, message, binary):
+        message = json.loads(message)
+        if message['type'] == self.reqtype + '_resp':
+            self.replies.append(message['data'])
+        elif message['type'] == 'error':
+            self.errors.append(message['msg'])
+        elif message['type'] == 'ping_resp':
+            self.done(shard)
+
+    def closed(self, shard):
+        self.done(shard, "Worker %d closed" % shard)
+
+    def done(self, shard, error=None):
+        with self._lock:
+            upstream = self.upstreams.pop(shard, None)
+            if upstream is None:
+                return
+            if error:
+                self.errors.append(error)
+            finished = not self.upstreams
+        upstream.disconnect()
+        if finished:
+            metrics.Record('router.aggregate_ms',
+                           1000 * (time.time() - self.start))
+            self.on_done(self.replies, self.errors)
+
+
+def Everywhere(data):
+    """Returns the requests of an Aggregate sending data to every worker."""
+    return dict((shard, [data]) for shard in range(len(_ports)))
+
+
+class CloneScope(object):
+    """Copies scope src to dest. Each worker replies with what it keeps of
+       src, then is sent the games and decks of dest that hash to it, which
+       replace those it keeps. As unsharded, there is no reply on success."""
+
+    def __init__(self, route, src, dest):
+        self.route = route
+        self.dest = dest
+        Aggregate(route, 'export_scope', Everywhere({'scope': src}),
+                  self.exported)
+
+    def exported(self, replies, errors):
+        if errors:
+            self.route.error("clone_scope failed: %s" % errors[0])
+            return
+        entries = Rehome([entry for reply in replies for entry in reply],
+                         self.dest)
+        Aggregate(self.route, 'import_scope', dict(
+            (shard, _ImportRequests(self.dest, entries[shard]))
+            for shard in range(len(_ports))), self.imported)
+
+    def imported(self, replies, errors):
+        if errors:
+            self.route.error("clone_scope failed: %s" % errors[0])
+
+
+def Rehome(entries, dest):
+    """Returns {shard: entries} placing each exported game and deck on the
+       worker that its copy in scope dest hashes to."""
+
+    shards = dict((shard, []) for shard in range(len(_ports)))
+    for entry in entries:
+        # Decks belong to the scope, and are exported with gameid ''.
+        shards[ShardOf(dest, entry['sourceid'], entry['gameid'])].append(entry)
+    return shards
+
+
+def _ImportRequests(dest, entries):
+    """Returns the import_scope requests storing entries in scope dest,
+       split so that each is well under the largest message workers read."""
+
+    requests = [{'scope': dest, 'clear': True, 'entries': []}]
+    size = 0
+    for entry in entries:
+        n = len(entry['key']) + len(entry['value'])
+        if requests[-1]['entries'] and \
+                size + n > config.kMaxMessageBytes / 2:
+            requests.append({'scope': dest, 'clear': False, 'entries': []})
+            size = 0
+        requests[-1]['entries'].append(entry)
+        size += n
+    return requests
+
+
+def _MergeGames(replies):
+    games = [game for reply in replies for game in reply]
+    games.sort(key=lambda game: not game['presence'])
+    return games
+
+
+def _MergeScope(replies):
+    return {
+        'decks': sorted(set(k for reply in replies for k in reply['decks'])),
+        'games': sorted(set(k for reply in replies for k in reply['games'])),
+    }
+
+
+# Request types served by every worker -> function merging their replies.
+MERGES = {
+    'list_games': _MergeGames,
+    'list_scope': _MergeScope,
+    'list_presence': lambda replies: sum(replies, []),
+    'stats': lambda replies: {
+        'router': metrics.Snapshot(),
+        'shards': replies,
+    },
+}
+
+
+initHandler = RouterInit()
+
+
+def handle_message(handler, stream, line):
+    """Routes one message from stream, returning the handler for the next."""
+
+    try:
+        req = json.loads(line)
+        return handler.transition(req['type'], req, line, stream)
+    except Exception, e:
+        logging.exception(e)
+        try:
+            stream.send_message(
+               json.dumps({'type': 'error', 'msg': str(e)}),
+               binary=False)
+        except asyncserver.ConnectionClosed:
+            pass
+    return handler
+
+
+def RunWorker(shard, port):
+    """Serves the games of shard from a database of its own, until the
+       router exits and so closes its stdin."""
+
+    exiter = threading.Thread(target=_ExitOnEOF)
+    exiter.setDaemon(True)
+    exiter.start()
+    config.kDBPath = '%s-shard%d' % (config.kDBPath, shard)
+    logging.info("Serving shard %d from %s", shard, config.kDBPath)
+    asyncserver.Serve([port])
+
+
+def _ExitOnEOF():
+    sys.stdin.read()
+    os._exit(0)
+
+
+def _WaitForPort(port, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def Serve(ports, num_workers):
+    """Starts num_workers worker processes on the ports after the last of
+       ports, then routes clients connecting to ports between them."""
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [root, env.get('PYTHONPATH')]))
+    workers = []
+    for shard in range(num_workers):
+        worker_port = max(ports) + 1 + shard
+        workers.append(subprocess.Popen([
+            sys.executable, '-c',
+            'import logging; logging.basicConfig(level=logging.INFO); '
+            'from server import router; router.RunWorker(%d, %d)'
+            % (shard, worker_port)], stdin=subprocess.PIPE, env=env))
+        _ports.append(worker_port)
+    for worker_port in _ports:
+        _WaitForPort(worker_port, config.kWorkerStartSecs)
+    logging.info("Routing to workers on ports %s", _ports)
+    asyncserver.Serve(ports, {'/kansas': 'server.router'})
+
+
+# vim: ts=4 sw=4 et
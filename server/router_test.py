@@ -0,0 +1,216 @@
+# Unit tests of routing clients to sharded workers.
+
+from server import asyncserver
+from server import benchmark
+from server import router
+from server import workers
+
+import base64
+import json
+import pickle
+import threading
+import time
+import unittest
+
+# Workers serve games from a scratch database, as by the benchmarks.
+kansas_wsh = benchmark.setup()
+
+
+def setPorts(ports):
+    router._ports[:] = ports
+
+
+class TestShardOf(unittest.TestCase):
+
+    def tearDown(self):
+        setPorts([])
+
+    def testIsStable(self):
+        # Shards must not change between releases, or games would be lost.
+        setPorts(range(4))
+        self.assertEqual(router.ShardOf('scope', 'pokerdb', 'game'), 2)
+        self.assertEqual(router.ShardOf('scope', 'pokerdb'), 0)
+        self.assertEqual(router.ShardOf(None, 'pokerdb', 'game'),
+                         router.ShardOf('DEFAULT', 'pokerdb', 'game'))
+        setPorts(range(16))
+        self.assertEqual(
+            [router.ShardOf('scope', 'pokerdb', 'g%d' % i) for i in range(8)],
+            [5, 2, 11, 12, 9, 14, 7, 0])
+
+    def testSpreadsGames(self):
+        setPorts(range(4))
+        shards = [router.ShardOf('scope', 'pokerdb', 'g%d' % i)
+                  for i in range(400)]
+        for shard in range(4):
+            self.assertTrue(60 < shards.count(shard) < 140)
+
+    def testRehome(self):
+        setPorts(range(4))
+        entries = [
+            {'db': 'ClientDB', 'sourceid': 'pokerdb', 'gameid': ''},
+            {'db': 'Games', 'sourceid': 'pokerdb', 'gameid': 'g1'},
+            {'db': 'Journal', 'sourceid': 'pokerdb', 'gameid': 'g1'},
+            {'db': 'Games', 'sourceid': 'localdb', 'gameid': 'g2'},
+        ]
+        shards = router.Rehome(entries, 'dest')
+        self.assertEqual(sorted(shards), range(4))
+        self.assertIn(entries[0], shards[router.ShardOf('dest', 'pokerdb')])
+        for entry in entries[1:]:
+            self.assertIn(entry, shards[router.ShardOf(
+                'dest', entry['sourceid'], entry['gameid'])])
+        self.assertEqual(sum(map(len, shards.values())), len(entries))
+
+    def testImportRequestsAreSplit(self):
+        entries = [{'key': 'k%d' % i, 'value': 'x' * 1000000}
+                   for i in range(5)]
+        requests = router._ImportRequests('dest', entries)
+        self.assertEqual([r['clear'] for r in requests],
+                         [True, False, False])
+        self.assertEqual(sum([r['entries'] for r in requests], []), entries)
+        # A worker with nothing to import still clears its copy.
+        self.assertEqual(router._ImportRequests('dest', []),
+                         [{'scope': 'dest', 'clear': True, 'entries': []}])
+
+
+class TestMerges(unittest.TestCase):
+
+    def testListGames(self):
+        merged = router.MERGES['list_games']([
+            [{'gameid': 'a', 'presence': 0}, {'gameid': 'b', 'presence': 2}],
+            [],
+            [{'gameid': 'c', 'presence': 1}],
+        ])
+        self.assertEqual([g['gameid'] for g in merged], ['b', 'c', 'a'])
+
+    def testListScope(self):
+        merged = router.MERGES['list_scope']([
+            {'decks': ['d2', 'd1'], 'games': ['g1']},
+            {'decks': ['d1'], 'games': ['g3', 'g2']},
+        ])
+        self.assertEqual(merged, {
+            'decks': ['d1', 'd2'],
+            'games': ['g1', 'g2', 'g3'],
+        })
+
+    def testListPresence(self):
+        self.assertEqual(router.MERGES['list_presence']([[1], [], [2, 3]]),
+                         [1, 2, 3])
+
+    def testStats(self):
+        merged = router.MERGES['stats']([{'a': 1}, {'a': 2}])
+        self.assertEqual(merged['shards'], [{'a': 1}, {'a': 2}])
+        self.assertIn('gauges', merged['router'])
+
+
+class FakeRoute(object):
+    """The parts of a Route used by Aggregate, with errors kept."""
+
+    def __init__(self, loop, scope):
+        self.loop = loop
+        self.set_scope = json.dumps({
+            'type': 'set_scope',
+            'data': {'scope': scope, 'datasource': 'pokerdb'},
+        })
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+
+class TestAggregate(unittest.TestCase):
+    """Runs two workers in this process, sharing one database."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncserver.Loop()
+        executor = workers.Pool(2)
+        ports = []
+        for _ in range(2):
+            server = asyncserver.Server(
+                cls.loop, executor, 0, {'/kansas': kansas_wsh})
+            ports.append(server.socket.getsockname()[1])
+        cls.ports = ports
+        thread = threading.Thread(target=cls.loop.run)
+        thread.setDaemon(True)
+        thread.start()
+        store = kansas_wsh.ScopedGameStore(
+            kansas_wsh.SubspaceKey('routed', 'pokerdb'))
+        store.Checkpoint('g', (kansas_wsh.BLANK_DECK, 1), {'last_used': 0})
+
+    def setUp(self):
+        setPorts(self.ports)
+
+    def tearDown(self):
+        setPorts([])
+
+    def aggregate(self, route, reqtype, requests):
+        """Returns the (replies, errors) of an Aggregate."""
+        done = threading.Event()
+        result = []
+        def on_done(replies, errors):
+            result.extend([replies, errors])
+            done.set()
+        router.Aggregate(route, reqtype, requests, on_done)
+        done.wait(10)
+        self.assertTrue(done.is_set())
+        return result
+
+    def testMergesReplies(self):
+        route = FakeRoute(self.loop, 'routed')
+        replies, errors = self.aggregate(
+            route, 'list_games', router.Everywhere(None))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(replies), 2)
+        for reply in replies:
+            self.assertEqual([game['gameid'] for game in reply], ['g'])
+
+    def testRequestsPerShard(self):
+        route = FakeRoute(self.loop, 'routed')
+        replies, errors = self.aggregate(
+            route, 'list_games', {0: [None, None], 1: []})
+        self.assertEqual(errors, [])
+        self.assertEqual(len(replies), 2)
+
+    def testErrors(self):
+        route = FakeRoute(self.loop, 'routed')
+        replies, errors = self.aggregate(
+            route, 'list_scope', router.Everywhere({'scope': 'x'}))
+        self.assertEqual(replies, [])
+        self.assertEqual(len(errors), 2)
+
+    def testImportRefusesObjects(self):
+        setPorts(self.ports[:1])
+        route = FakeRoute(self.loop, 'routed')
+        value = pickle.dumps(threading.Event, pickle.HIGHEST_PROTOCOL)
+        replies, errors = self.aggregate(route, 'import_scope', {0: [{
+            'scope': 'imported',
+            'clear': False,
+            'entries': [{'db': 'ClientDB', 'sourceid': 'pokerdb',
+                         'key': 'k', 'value': base64.b64encode(value)}],
+        }]})
+        self.assertEqual(replies, [])
+        self.assertEqual(len(errors), 1)
+
+    def testCloneScope(self):
+        # Workers share a database here, so the copy must be made by one.
+        setPorts(self.ports[:1])
+        src = kansas_wsh.SubspaceKey('routed', 'pokerdb')
+        dest = kansas_wsh.SubspaceKey('copied', 'pokerdb')
+        kansas_wsh.ClientDB.Subspace(src).Subspace('decks').Put(
+            'deck', {'cards': [1, 2]})
+        kansas_wsh.Games.Subspace(dest).Put('stale', ({}, 1))
+        route = FakeRoute(self.loop, 'routed')
+        router.CloneScope(route, 'routed', 'copied')
+        games = kansas_wsh.Games.Subspace(dest)
+        deadline = time.time() + 10
+        while games.Get('g') is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(route.errors, [])
+        self.assertEqual(games.List(), [('g', (kansas_wsh.BLANK_DECK, 1))])
+        self.assertEqual(
+            kansas_wsh.ClientDB.Subspace(dest).Subspace('decks').Get('deck'),
+            {'cards': [1, 2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# Validation and escaping of client requests.
+#
+# Schemas are built once from the constructors below, each of which returns
+# a check function. Checking a request walks only the fields its schema
+# declares, escapes only the strings marked as rendered by clients, and
+# updates the parsed request in place rather than copying it.
+
+import cgi
+
+_STRINGS = (str, unicode)
+_INTS = (int, long, bool)
+_NUMBERS = (int, long, bool, float)
+_SCALARS = (str, unicode, int, long, bool, float, type(None))
+
+
+class Invalid(Exception):
+    """Raised for a request that does not match its schema."""
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.keys = []
+
+    @property
+    def path(self):
+        """Returns the location of the bad field, e.g. 'moves[3].card'."""
+        path = ''
+        for key in self.keys:
+            if type(key) is int:
+                path += '[%d]' % key
+            else:
+                path += ('.' if path else '') + key
+        return path
+
+    def __str__(self):
+        if self.keys:
+            return '%s: %s' % (self.path, self.args[0])
+        return self.args[0]
+
+
+def Escape(text):
+    return cgi.escape(text).replace('"', "'")
+
+
+def Any():
+    """Accepts any value unchanged."""
+    return lambda value: value
+
+
+def Escaped():
+    """Accepts any value, escaping all strings in it including keys."""
+
+    def check(value):
+        t = type(value)
+        if t in _STRINGS:
+            return Escape(value)
+        elif t is dict:
+            return dict((Escape(k), check(v)) for k, v in value.iteritems())
+        elif t is list:
+            return [check(x) for x in value]
+        return value
+    return check
+
+
+def Str(escape=False):
+    def check(value):
+        if type(value) not in _STRINGS:
+            raise Invalid('expected a string')
+        return Escape(value) if escape else value
+    return check
+
+
+def Int():
+    def check(value):
+        if type(value) not in _INTS:
+            raise Invalid('expected an integer')
+        return value
+    return check
+
+
+def Number():
+    def check(value):
+        if type(value) not in _NUMBERS:
+            raise Invalid('expected a number')
+        return value
+    return check
+
+
+def Bool():
+    def check(value):
+        if type(value) is not bool:
+            raise Invalid('expected true or false')
+        return value
+    return check
+
+
+def Scalar(escape=False):
+    """Accepts a string, number, boolean or null."""
+
+    def check(value):
+        t = type(value)
+        if t not in _SCALARS:
+            raise Invalid('expected a string or number')
+        if escape and t in _STRINGS:
+            return Escape(value)
+        return value
+    return check
+
+
+def OneOf(*choices):
+    choices = frozenset(choices)
+
+    def check(value):
+        if type(value) not in _SCALARS or value not in choices:
+            raise Invalid('expected one of %s' % ', '.join(sorted(choices)))
+        return value
+    return check
+
+
+def Maybe(item):
+    """Accepts null, or a value matching item."""
+    return lambda value: value if value is None else item(value)
+
+
+def List(item):
+    def check(value):
+        if type(value) is not list:
+            raise Invalid('expected a list')
+        i = 0
+        try:
+            for i, x in enumerate(value):
+                y = item(x)
+                if y is not x:
+                    value[i] = y
+        except Invalid, e:
+            e.keys.insert(0, i)
+            raise
+        return value
+    return check
+
+
+def Tuple(*items):
+    """Accepts a list with one value per item."""
+
+    def check(value):
+        if type(value) is not list or len(value) != len(items):
+            raise Invalid('expected a list of %d' % len(items))
+        i = 0
+        try:
+            for i, item in enumerate(items):
+                value[i] = item(value[i])
+        except Invalid, e:
+            e.keys.insert(0, i)
+            raise
+        return value
+    return check
+
+
+def Dict(fields, optional=()):
+    """Accepts an object with the given fields, which are required unless
+       listed in optional. Undeclared keys are dropped."""
+
+    names = frozenset(fields)
+    fields = fields.items()
+    required = [key for key, _ in fields if key not in optional]
+
+    def check(value):
+        if type(value) is not dict:
+            raise Invalid('expected an object')
+        for key in required:
+            if key not in value:
+                e = Invalid('missing')
+                e.keys.append(key)
+                raise e
+        if len(value) > len(required) and not names.issuperset(value):
+            value = dict((key, value[key])
+                         for key, _ in fields if key in value)
+        key = None
+        try:
+            for key, item in fields:
+                if key in value:
+                    value[key] = item(value[key])
+        except Invalid, e:
+            e.keys.insert(0, key)
+            raise
+        return value
+    return check
+
+
+# vim: ts=4 sw=4 et
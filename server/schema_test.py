@@ -0,0 +1,78 @@
+# Unit tests of request schemas.
+
+from server import schema
+
+import unittest
+
+
+class TestSchema(unittest.TestCase):
+
+    def testEscapesOnlyMarkedStrings(self):
+        check = schema.Dict({
+            'name': schema.Str(escape=True),
+            'term': schema.Str(),
+        })
+        value = check({'name': '<b>"x" & y</b>', 'term': '<b>'})
+        self.assertEqual(value['name'], "&lt;b&gt;'x' &amp; y&lt;/b&gt;")
+        self.assertEqual(value['term'], '<b>')
+
+    def testEscapedWalksKeysAndValues(self):
+        check = schema.Escaped()
+        self.assertEqual(
+            check({'<k>': ['<v>', 1, None, {'a': '&'}]}),
+            {'&lt;k&gt;': ['&lt;v&gt;', 1, None, {'a': '&amp;'}]})
+
+    def testScalarEscapesOnlyStrings(self):
+        check = schema.Scalar(escape=True)
+        self.assertEqual(check('<'), '&lt;')
+        self.assertEqual(check(3), 3)
+        self.assertRaises(schema.Invalid, check, [])
+
+    def testDropsUndeclaredKeys(self):
+        check = schema.Dict({'a': schema.Int()}, optional=['a'])
+        self.assertEqual(check({'a': 1, '<script>': '<script>'}), {'a': 1})
+        self.assertEqual(check({}), {})
+
+    def testMissingField(self):
+        check = schema.Dict({'a': schema.Int()})
+        try:
+            check({})
+            self.fail()
+        except schema.Invalid, e:
+            self.assertEqual(e.path, 'a')
+
+    def testPathOfBadField(self):
+        check = schema.Dict({
+            'moves': schema.List(schema.Dict({'card': schema.Int()})),
+        })
+        try:
+            check({'moves': [{'card': 1}, {'card': 'x'}]})
+            self.fail()
+        except schema.Invalid, e:
+            self.assertEqual(e.path, 'moves[1].card')
+            self.assertEqual(str(e), 'moves[1].card: expected an integer')
+
+    def testEscapesListItemsInPlace(self):
+        items = ['<', 'a']
+        self.assertIs(schema.List(schema.Str(escape=True))(items), items)
+        self.assertEqual(items, ['&lt;', 'a'])
+
+    def testTuple(self):
+        check = schema.Tuple(schema.Number(), schema.Str(escape=True))
+        self.assertEqual(check([2, '<x>']), [2, '&lt;x&gt;'])
+        self.assertRaises(schema.Invalid, check, [2])
+
+    def testOneOfAndMaybe(self):
+        check = schema.Maybe(schema.OneOf('Put', 'Get'))
+        self.assertEqual(check('Put'), 'Put')
+        self.assertEqual(check(None), None)
+        self.assertRaises(schema.Invalid, check, 'Drop')
+        self.assertRaises(schema.Invalid, check, ['Put'])
+
+    def testBoolIsNotAString(self):
+        self.assertRaises(schema.Invalid, schema.Bool(), 'true')
+        self.assertRaises(schema.Invalid, schema.Str(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# Implements ordered stacks of cards with constant time moves.
+
+import collections
+import random
+
+
+class Stack(object):
+    """An ordered set of card ids, iterated from bottom to top.
+
+       Removing a card from anywhere in the stack and placing a card on top
+       are both O(1), so bulk moves out of large piles stay linear."""
+
+    __slots__ = ('_cards',)
+
+    def __init__(self, cards=()):
+        self._cards = collections.OrderedDict.fromkeys(cards)
+
+    def append(self, card):
+        """Places card on top, moving it there if already present."""
+        self._cards.pop(card, None)
+        self._cards[card] = None
+
+    def remove(self, card):
+        del self._cards[card]
+
+    def shuffle(self):
+        cards = list(self._cards)
+        random.shuffle(cards)
+        self._cards = collections.OrderedDict.fromkeys(cards)
+
+    def tolist(self):
+        """Returns the z_stack ordering sent to clients."""
+        return list(self._cards)
+
+    def __contains__(self, card):
+        return card in self._cards
+
+    def __iter__(self):
+        return iter(self._cards)
+
+    def __len__(self):
+        return len(self._cards)
+
+    def __repr__(self):
+        return 'Stack(%r)' % self.tolist()
@@ -0,0 +1,52 @@
+# Unit tests of ordered card stacks.
+
+from server import stacks
+
+import unittest
+
+
+class TestStack(unittest.TestCase):
+
+    def testKeepsOrder(self):
+        stack = stacks.Stack([5, 3, 9])
+        self.assertEqual(stack.tolist(), [5, 3, 9])
+        self.assertEqual(list(stack), [5, 3, 9])
+        self.assertEqual(len(stack), 3)
+
+    def testAppendPlacesOnTop(self):
+        stack = stacks.Stack([5, 3, 9])
+        stack.append(1)
+        self.assertEqual(stack.tolist(), [5, 3, 9, 1])
+        # A card already in the stack moves to the top.
+        stack.append(3)
+        self.assertEqual(stack.tolist(), [5, 9, 1, 3])
+
+    def testRemoveKeepsOthersInOrder(self):
+        stack = stacks.Stack(range(10))
+        for card in [0, 5, 9]:
+            stack.remove(card)
+        self.assertEqual(stack.tolist(), [1, 2, 3, 4, 6, 7, 8])
+        self.assertNotIn(5, stack)
+        self.assertIn(6, stack)
+        self.assertRaises(KeyError, stack.remove, 5)
+
+    def testDealFromBottom(self):
+        pile = stacks.Stack(range(100))
+        dest = stacks.Stack()
+        for card in range(100):
+            pile.remove(card)
+            dest.append(card)
+        self.assertEqual(len(pile), 0)
+        self.assertEqual(dest.tolist(), range(100))
+
+    def testShuffleKeepsCards(self):
+        stack = stacks.Stack(range(52))
+        stack.shuffle()
+        self.assertEqual(sorted(stack.tolist()), range(52))
+        stack.append(0)
+        self.assertEqual(stack.tolist()[-1], 0)
+        self.assertEqual(len(stack), 52)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# Implements the wire encodings negotiated by clients in set_scope.
+#
+# The default encoding sends JSON text frames. Clients may instead offer
+# 'msgpack' and/or 'deflate', in which case messages are sent as binary frames
+# whose first byte holds FLAG_* bits describing the body that follows.
+
+from server import config
+
+import json
+import struct
+import weakref
+import zlib
+
+try:
+    import msgpack
+    haveMsgpack = True
+except ImportError:
+    haveMsgpack = False
+
+JSON = 'json'
+
+FLAG_DEFLATE = 1
+FLAG_MSGPACK = 2
+
+_encodings = weakref.WeakKeyDictionary()
+
+
+def Negotiate(offered):
+    """Returns the encoding to use given the features a client offers."""
+
+    offered = offered or []
+    encoding = 'msgpack' if 'msgpack' in offered else JSON
+    if 'deflate' in offered:
+        encoding += '+deflate'
+    return encoding
+
+
+def SetEncoding(stream, encoding):
+    _encodings[stream] = encoding
+
+
+def EncodingOf(stream):
+    return _encodings.get(stream, JSON)
+
+
+def Encode(message, encoding=JSON):
+    """Returns (payload, binary) for sending message in encoding."""
+
+    if encoding == JSON:
+        return json.dumps(message), False
+    flags = 0
+    if encoding.startswith('msgpack'):
+        flags |= FLAG_MSGPACK
+        body = PackMsgpack(message)
+    else:
+        body = json.dumps(message)
+    if encoding.endswith('+deflate') and len(body) >= config.kDeflateMinBytes:
+        flags |= FLAG_DEFLATE
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+    return chr(flags) + body, True
+
+
+def _JSONKey(key):
+    """Converts a dict key the way json.dumps does."""
+    if key is True:
+        return 'true'
+    elif key is False:
+        return 'false'
+    elif key is None:
+        return 'null'
+    elif type(key) in [str, unicode]:
+        return key
+    return str(key)
+
+
+def PackMsgpack(obj):
+    """Serializes obj as MessagePack, with the same data model as JSON."""
+
+    if haveMsgpack:
+        return msgpack.packb(_Normalize(obj), use_bin_type=True)
+    out = []
+    _Pack(obj, out.append)
+    return ''.join(out)
+
+
+def _Normalize(obj):
+    t = type(obj)
+    if t is dict:
+        return dict((_JSONKey(k), _Normalize(v)) for k, v in obj.iteritems())
+    elif t in [list, tuple]:
+        return [_Normalize(x) for x in obj]
+    elif t is str:
+        return obj.decode('utf-8')
+    return obj
+
+
+def _Pack(obj, write):
+    t = type(obj)
+    if obj is None:
+        write('\xc0')
+    elif obj is True:
+        write('\xc3')
+    elif obj is False:
+        write('\xc2')
+    elif t in [int, long]:
+        if 0 <= obj < 0x80:
+            write(chr(obj))
+        elif -0x20 <= obj < 0:
+            write(struct.pack('b', obj))
+        elif 0 <= obj < 0x100000000:
+            write(struct.pack('>BI', 0xce, obj))
+        elif -0x80000000 <= obj < 0:
+            write(struct.pack('>Bi', 0xd2, obj))
+        elif obj > 0:
+            write(struct.pack('>BQ', 0xcf, obj))
+        else:
+            write(struct.pack('>Bq', 0xd3, obj))
+    elif t is float:
+        write(struct.pack('>Bd', 0xcb, obj))
+    elif t in [str, unicode]:
+        if t is unicode:
+            obj = obj.encode('utf-8')
+        n = len(obj)
+        if n < 32:
+            write(chr(0xa0 | n))
+        elif n < 0x100:
+            write(struct.pack('>BB', 0xd9, n))
+        elif n < 0x10000:
+            write(struct.pack('>BH', 0xda, n))
+        else:
+            write(struct.pack('>BI', 0xdb, n))
+        write(obj)
+    elif t in [list, tuple]:
+        n = len(obj)
+        if n < 16:
+            write(chr(0x90 | n))
+        elif n < 0x10000:
+            write(struct.pack('>BH', 0xdc, n))
+        else:
+            write(struct.pack('>BI', 0xdd, n))
+        for x in obj:
+            _Pack(x, write)
+    elif t is dict:
+        n = len(obj)
+        if n < 16:
+            write(chr(0x80 | n))
+        elif n < 0x10000:
+            write(struct.pack('>BH', 0xde, n))
+        else:
+            write(struct.pack('>BI', 0xdf, n))
+        for k, v in obj.iteritems():
+            _Pack(_JSONKey(k), write)
+            _Pack(v, write)
+    else:
+        raise TypeError("%r is not serializable" % obj)
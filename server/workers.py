@@ -0,0 +1,205 @@
+# Pools of threads, and the serial executors and locks that share them.
+
+from server import presence
+
+import collections
+import itertools
+import logging
+import Queue
+import sys
+import thread
+import threading
+import time
+
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _Count(**deltas):
+    with _stats_lock:
+        _stats.update(deltas)
+
+
+def _Max(key, value):
+    with _stats_lock:
+        if value > _stats[key]:
+            _stats[key] = value
+
+
+def Stats():
+    """Returns counters of time spent waiting for locks and actors."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class Pool(object):
+    """A fixed set of threads running submitted calls in FIFO order.
+
+       If capacity is nonzero, submit() blocks while that many calls are
+       waiting, pushing back on whoever is submitting."""
+
+    def __init__(self, num_threads, capacity=0):
+        self._queue = Queue.Queue(capacity)
+        for i in range(num_threads):
+            worker = threading.Thread(target=self._run)
+            worker.setDaemon(True)
+            worker.start()
+
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception, e:
+                logging.exception(e)
+
+
+class Serial(object):
+    """An actor's mailbox. Runs calls one at a time in the order submitted,
+       borrowing threads from a shared pool, so that state touched only by
+       these calls needs no lock.
+
+       Code running on one Serial must not call() another, or the pool
+       could be exhausted by threads waiting on each other."""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self._mailbox = collections.deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._owner = None
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._mailbox.append((fn, args, time.time()))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.pool.submit(self._run)
+
+    def call(self, fn, *args):
+        """Runs fn on this actor and returns its result, or raises its
+           exception. Runs fn directly if already on this actor."""
+
+        if self._owner == thread.get_ident():
+            return fn(*args)
+        done = threading.Event()
+        result = []
+        def run():
+            try:
+                result.append((fn(*args), None))
+            except Exception:
+                result.append((None, sys.exc_info()))
+            finally:
+                done.set()
+        self.submit(run)
+        done.wait()
+        value, error = result[0]
+        if error:
+            raise error[0], error[1], error[2]
+        return value
+
+    def depth(self):
+        return len(self._mailbox)
+
+    def _run(self):
+        with self._lock:
+            fn, args, queued = self._mailbox.popleft()
+        start = time.time()
+        self._owner = thread.get_ident()
+        try:
+            fn(*args)
+        except Exception, e:
+            logging.exception(e)
+        finally:
+            self._owner = None
+        end = time.time()
+        _Count(actor_calls=1,
+               actor_wait_ms=1000 * (start - queued),
+               actor_run_ms=1000 * (end - start))
+        _Max('actor_max_wait_ms', 1000 * (start - queued))
+        with self._lock:
+            if not self._mailbox:
+                self._scheduled = False
+                return
+        self.pool.submit(self._run)
+
+
+class MeteredLock(object):
+    """A reentrant lock that counts how often, and for how long, threads
+       had to wait for it, under the given name."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        if self._lock.acquire(False):
+            _Count(**{self.name + '_acquired': 1})
+            return self
+        start = time.time()
+        self._lock.acquire()
+        waited = 1000 * (time.time() - start)
+        _Count(**{
+            self.name + '_acquired': 1,
+            self.name + '_contended': 1,
+            self.name + '_wait_ms': waited,
+        })
+        _Max(self.name + '_max_wait_ms', waited)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+class Timers(threading.Thread):
+    """Makes calls after a delay, all from this one thread, so that a timer
+       costs no thread of its own. Calls are made up to slot_secs late, and
+       should only hand work on to an actor or pool."""
+
+    def __init__(self, slot_secs, num_slots=100):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._cond = threading.Condition()
+        self._wheel = presence.TimerWheel(slot_secs, num_slots, time.time())
+        self._calls = {}
+        self._keys = itertools.count()
+
+    def schedule(self, delay, fn, *args):
+        """Calls fn(*args) after delay seconds, returning a key for
+           cancel()."""
+        with self._cond:
+            key = next(self._keys)
+            self._calls[key] = fn, args
+            self._wheel.schedule(key, time.time() + delay)
+            self._cond.notify()
+        return key
+
+    def cancel(self, key):
+        with self._cond:
+            if self._calls.pop(key, None):
+                self._wheel.cancel(key)
+
+    def depth(self):
+        return len(self._calls)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._calls:
+                    self._cond.wait()
+                due = [self._calls.pop(key)
+                       for key in self._wheel.advance(time.time())]
+            for fn, args in due:
+                try:
+                    fn(*args)
+                except Exception, e:
+                    logging.exception(e)
+            time.sleep(self._wheel.slot_secs)
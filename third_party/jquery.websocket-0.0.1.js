@@ -8,6 +8,10 @@
  * Copyright (c) 2010 by shootaroo (Shotaro Tsubouchi).
  *
  * Modified by Eric Liang (c 2013) to support futures.
+ *
+ * If settings.decode is given, it is called with the data of each message and
+ * must return a Promise of the parsed message. Messages are still dispatched
+ * in the order they were received.
  */
 
 (function($){
@@ -16,6 +20,7 @@ $.extend({
         open: function(){},
         close: function(){},
         message: function(){},
+        decode: null,
         options: {},
         events: {}
     },
@@ -29,23 +34,39 @@ $.extend({
         ws.lastSent = new Date();
         ws.lastAction = new Date();
         ws._settings = $.extend($.websocketSettings, s);
+        ws.binaryType = 'arraybuffer';
+        var received = typeof Promise != 'undefined' ? Promise.resolve() : null;
+        function dispatch(m) {
+            var h = $.websocketSettings.events[m.type];
+            var def = $.websocketSettings.events['_default'];
+            var fut = $.websocketSettings.events['_future_router'];
+            ws.recvCount += 1;
+            ws.lastAction = new Date();
+            if (m.future_id && fut) {
+                fut.call(this, m);
+            } else if (h) {
+                h.call(this, m)
+            } else if (def) {
+                def.call(this, m)
+            }
+        }
         $(ws)
             .bind('open', $.websocketSettings.open)
             .bind('close', $.websocketSettings.close)
             .bind('message', $.websocketSettings.message)
             .bind('message', function(e) {
-                var m = JSON.parse(e.originalEvent.data);
-                var h = $.websocketSettings.events[m.type];
-                var def = $.websocketSettings.events['_default'];
-                var fut = $.websocketSettings.events['_future_router'];
-                ws.recvCount += 1;
-                ws.lastAction = new Date();
-                if (m.future_id && fut) {
-                    fut.call(this, m);
-                } else if (h) {
-                    h.call(this, m)
-                } else if (def) {
-                    def.call(this, m)
+                var decode = $.websocketSettings.decode;
+                var data = e.originalEvent.data;
+                if (decode && received) {
+                    received = received.then(function() {
+                        return decode(data);
+                    }).then(function(m) {
+                        dispatch.call(ws, m);
+                    })['catch'](function(err) {
+                        console.log("Failed to handle message: " + err);
+                    });
+                } else {
+                    dispatch.call(this, JSON.parse(data));
                 }
             });
         ws._send = ws.send;